@@ -0,0 +1,113 @@
+# benchmarks/chunkers.py
+# =============================================================================
+# CHUNKER THROUGHPUT (MB/s) AND CHUNK SHAPE PER STRATEGY
+# =============================================================================
+# Usage (from RAG-Chatbot/Backend; no database needed):
+#   python -m benchmarks.chunkers --folder documents --repeat 3
+#   python -m benchmarks.chunkers --synthetic-mb 20 --strategies chars,sentences,tokens
+#
+# Files are loaded into memory first (extraction isn't timed), then every
+# strategy in parsing.CHUNKERS chunks the same segments; "chars" is the fixed
+# character slicer used so far. Throughput is the best of --repeat runs after
+# one warm-up (which also loads the tokenizer and fills its per-word memo).
+# Token statistics use the embedding model's tokenizer, so they show how many
+# chunks of each strategy the model would truncate at --max-tokens.
+import argparse
+import os
+import random
+import time
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from parsing import CHUNKERS, CHUNK_TOKENS, iter_file_pages, token_counts
+
+Segments = List[Tuple[Optional[int], str]]
+
+WORDS = (
+    "the index stores one row per chunk and the planner picks an approximate "
+    "nearest neighbour scan when the filter is selective enough to keep recall"
+).split()
+
+
+def _synthetic(mb: float, seed: int) -> List[Segments]:
+    """Pages of sentences and paragraphs, ~`mb` MB in total."""
+    rng = random.Random(seed)
+    docs: List[Segments] = []
+    target = int(mb * 2**20)
+    size = 0
+    while size < target:
+        pages: Segments = []
+        for page in range(1, 21):
+            paras = []
+            for _ in range(rng.randint(2, 6)):
+                sents = [
+                    " ".join(rng.choice(WORDS) for _ in range(rng.randint(5, 30))).capitalize() + "."
+                    for _ in range(rng.randint(1, 8))
+                ]
+                paras.append(" ".join(sents))
+            text = "\n\n".join(paras)
+            pages.append((page, text))
+            size += len(text)
+        docs.append(pages)
+    return docs
+
+
+def _load(folder: str) -> List[Segments]:
+    docs: List[Segments] = []
+    for name in sorted(os.listdir(folder)):
+        path = os.path.join(folder, name)
+        if os.path.isfile(path) and name.lower().endswith((".txt", ".pdf")):
+            docs.append(list(iter_file_pages(path)))
+    return docs
+
+
+def _run(name: str, docs: List[Segments], size: int, overlap: int) -> List[str]:
+    chunker = CHUNKERS[name]
+    return [c for doc in docs for c, _ in chunker.chunk(iter(doc), size, overlap)]
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="Chunker throughput per strategy")
+    ap.add_argument("--folder", default=os.getenv("DOCUMENTS_DIR", "documents"))
+    ap.add_argument("--synthetic-mb", type=float, default=0.0, help="use generated text instead of --folder")
+    ap.add_argument("--strategies", default=",".join(CHUNKERS))
+    ap.add_argument("--size", type=int, default=None, help="override each strategy's default chunk size")
+    ap.add_argument("--overlap", type=int, default=None)
+    ap.add_argument("--max-tokens", type=int, default=CHUNK_TOKENS, help="model window without special tokens")
+    ap.add_argument("--repeat", type=int, default=3)
+    ap.add_argument("--seed", type=int, default=7)
+    args = ap.parse_args()
+
+    docs = _synthetic(args.synthetic_mb, args.seed) if args.synthetic_mb > 0 else _load(args.folder)
+    mb = sum(len(t.encode("utf-8")) for doc in docs for _, t in doc) / 2**20
+    if not mb:
+        raise SystemExit(f"no text in {args.folder}; pass --synthetic-mb")
+    print(f"{len(docs)} documents, {mb:.2f} MB of text\n")
+    print(f"{'strategy':<11} {'unit':<6} {'size':>5} {'MB/s':>8} {'chunks':>8} "
+          f"{'chars p50/max':>14} {'tokens p50/p99/max':>19} {'truncated':>9}")
+
+    for name in (s.strip() for s in args.strategies.split(",")):
+        chunker = CHUNKERS[name]
+        size = chunker.size if args.size is None else args.size
+        overlap = chunker.overlap if args.overlap is None else args.overlap
+        chunks = _run(name, docs, size, overlap)  # warm-up
+        best = float("inf")
+        for _ in range(args.repeat):
+            t0 = time.perf_counter()
+            _run(name, docs, size, overlap)
+            best = min(best, time.perf_counter() - t0)
+
+        chars = np.array([len(c) for c in chunks])
+        tokens = np.array([int(token_counts(c.split()).sum()) for c in chunks])
+        truncated = float(np.mean(tokens > args.max_tokens)) if len(tokens) else 0.0
+        print(
+            f"{name:<11} {chunker.unit:<6} {size:>5} {mb / best:>8.2f} {len(chunks):>8} "
+            f"{int(np.median(chars)):>6}/{chars.max():<7} "
+            f"{int(np.median(tokens)):>6}/{int(np.percentile(tokens, 99))}/{tokens.max():<5} "
+            f"{truncated:>8.1%}"
+        )
+
+
+if __name__ == "__main__":
+    main()
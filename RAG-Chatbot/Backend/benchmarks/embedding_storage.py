@@ -0,0 +1,170 @@
+# benchmarks/embedding_storage.py
+# =============================================================================
+# vector vs halfvec vs binary-quantized (bit + float re-rank) STORAGE LAYOUTS
+# =============================================================================
+# Usage (from RAG-Chatbot/Backend, pgvector >= 0.7):
+#   python -m benchmarks.embedding_storage --rows 100000 --index hnsw
+#   python -m benchmarks.embedding_storage --source existing   # copy CHUNKS_TABLE embeddings
+#
+# Each layout gets its own scratch table (_bench_store_*), dropped at the end, so
+# document_chunks is only ever read. Reports table size, index build time, index
+# size, recall@k against exact float32 search, and query latency.
+import argparse
+import asyncio
+import json
+import time
+from typing import Dict, List, Set
+
+import asyncpg
+import numpy as np
+
+from db import (
+    CHUNKS_TABLE,
+    DB_URL,
+    EMBED_DIM,
+    HNSW_EF_CONSTRUCTION,
+    HNSW_EF_SEARCH,
+    HNSW_M,
+    _safe_table_name,
+    _to_pgvector,
+    ivfflat_lists_for,
+)
+
+LAYOUTS = ("vector", "halfvec", "bit")
+
+
+def _layout_sql(layout: str, dim: int, index: str, lists: int) -> Dict[str, str]:
+    """Column type, index DDL and top-k query (ids) for one layout (cosine distance)."""
+    t = f"_bench_store_{layout}"
+    with_ = f"m = {HNSW_M}, ef_construction = {HNSW_EF_CONSTRUCTION}" if index == "hnsw" else f"lists = {lists}"
+    if layout == "halfvec":
+        col = f"halfvec({dim})"
+        idx_expr = "embedding halfvec_cosine_ops"
+        query = f"SELECT id FROM {t} ORDER BY embedding <=> $1::vector::halfvec({dim}) LIMIT $2"
+    elif layout == "bit":
+        col = f"vector({dim})"
+        bits = f"(binary_quantize(embedding)::bit({dim}))"
+        idx_expr = f"{bits} bit_hamming_ops"
+        query = f"""
+            SELECT id FROM (
+                SELECT id, embedding FROM {t}
+                ORDER BY {bits} <~> binary_quantize($1::vector)
+                LIMIT $2 * $3
+            ) c
+            ORDER BY embedding <=> $1::vector
+            LIMIT $2
+        """
+    else:
+        col = f"vector({dim})"
+        idx_expr = "embedding vector_cosine_ops"
+        query = f"SELECT id FROM {t} ORDER BY embedding <=> $1::vector LIMIT $2"
+    return {
+        "table": t,
+        "create": f"CREATE TABLE {t} (id int PRIMARY KEY, embedding {col})",
+        "index": f"CREATE INDEX {t}_ann ON {t} USING {index} ({idx_expr}) WITH ({with_})",
+        "query": query,
+    }
+
+
+async def _load_corpus(conn, args, rng) -> np.ndarray:
+    if args.source == "existing":
+        table = _safe_table_name(CHUNKS_TABLE)
+        rows = await conn.fetch(f"SELECT embedding::text AS e FROM {table} LIMIT $1", args.rows)
+        if not rows:
+            raise RuntimeError(f"{table} is empty; use --source synthetic")
+        return np.array([json.loads(r["e"]) for r in rows], dtype=np.float32)
+    centers = rng.standard_normal((200, args.dim)).astype(np.float32)
+    emb = centers[rng.integers(0, 200, size=args.rows)]
+    emb = emb + 0.35 * rng.standard_normal(emb.shape).astype(np.float32)
+    return emb / np.linalg.norm(emb, axis=1, keepdims=True)
+
+
+async def _exact_truth(conn, table: str, queries: List[str], k: int) -> List[Set[int]]:
+    truth = []
+    for q in queries:
+        rows = await conn.fetch(
+            f"SELECT id FROM {table} ORDER BY (embedding <=> $1::vector) + 0 LIMIT $2", q, k
+        )
+        truth.append({r["id"] for r in rows})
+    return truth
+
+
+async def main_async(args) -> None:
+    if not DB_URL:
+        raise RuntimeError("DATABASE_URL is not set")
+    rng = np.random.default_rng(args.seed)
+    conn = await asyncpg.connect(DB_URL)
+    try:
+        await conn.execute("CREATE EXTENSION IF NOT EXISTS vector;")
+        corpus = await _load_corpus(conn, args, rng)
+        dim = corpus.shape[1]
+        lists = args.lists or ivfflat_lists_for(len(corpus))
+        literals = [_to_pgvector(e) for e in corpus.tolist()]
+        qidx = rng.integers(0, len(corpus), size=args.queries)
+        queries = corpus[qidx] + 0.1 * rng.standard_normal((args.queries, dim)).astype(np.float32)
+        queries = [_to_pgvector(q) for q in (queries / np.linalg.norm(queries, axis=1, keepdims=True)).tolist()]
+
+        truth = None
+        print(f"[corpus] {len(corpus)} x {dim}, index={args.index}, k={args.k}, queries={args.queries}")
+        for layout in (name.strip() for name in args.layouts.split(",")):
+            sql = _layout_sql(layout, dim, args.index, lists)
+            t = sql["table"]
+            await conn.execute(f"DROP TABLE IF EXISTS {t}")
+            await conn.execute(sql["create"])
+            # vector -> halfvec is an assignment cast, so one INSERT serves every layout
+            await conn.executemany(
+                f"INSERT INTO {t} (id, embedding) VALUES ($1, $2::text::vector)", list(enumerate(literals))
+            )
+            if truth is None:
+                truth = await _exact_truth(conn, t, queries, args.k)
+
+            t0 = time.perf_counter()
+            await conn.execute(sql["index"])
+            build_s = time.perf_counter() - t0
+            table_mb = await conn.fetchval("SELECT pg_table_size($1::regclass)", t) / 2**20
+            index_mb = await conn.fetchval("SELECT pg_relation_size($1::regclass)", f"{t}_ann") / 2**20
+
+            recalls, lat = [], []
+            async with conn.transaction():
+                if args.index == "hnsw":
+                    await conn.execute(f"SET LOCAL hnsw.ef_search = {args.ef_search}")
+                else:
+                    await conn.execute(f"SET LOCAL ivfflat.probes = {args.probes}")
+                for q, gt in zip(queries, truth):
+                    params = (q, args.k, args.rerank) if layout == "bit" else (q, args.k)
+                    t0 = time.perf_counter()
+                    rows = await conn.fetch(sql["query"], *params)
+                    lat.append((time.perf_counter() - t0) * 1000)
+                    recalls.append(len({r["id"] for r in rows} & gt) / max(1, len(gt)))
+
+            print(
+                f"  {layout:8s} table={table_mb:8.1f}MB  index={index_mb:8.1f}MB  build={build_s:7.2f}s  "
+                f"recall@{args.k}={np.mean(recalls):.3f}  p50={np.percentile(lat, 50):6.2f}ms  "
+                f"p99={np.percentile(lat, 99):6.2f}ms"
+            )
+            if not args.keep:
+                await conn.execute(f"DROP TABLE {t}")
+    finally:
+        await conn.close()
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="Embedding storage layout benchmark")
+    ap.add_argument("--source", choices=["synthetic", "existing"], default="synthetic")
+    ap.add_argument("--rows", type=int, default=100000)
+    ap.add_argument("--dim", type=int, default=EMBED_DIM)
+    ap.add_argument("--queries", type=int, default=200)
+    ap.add_argument("-k", type=int, default=5)
+    ap.add_argument("--index", choices=["hnsw", "ivfflat"], default="hnsw")
+    ap.add_argument("--lists", type=int, default=None, help="ivfflat lists (default: from row count)")
+    ap.add_argument("--probes", type=int, default=10)
+    ap.add_argument("--ef-search", type=int, default=HNSW_EF_SEARCH)
+    ap.add_argument("--rerank", type=int, default=4, help="bit layout: candidates per result row")
+    ap.add_argument("--layouts", default=",".join(LAYOUTS))
+    ap.add_argument("--seed", type=int, default=42)
+    ap.add_argument("--keep", action="store_true", help="keep the scratch tables")
+    asyncio.run(main_async(ap.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+# benchmarks/mixed_load.py
+# =============================================================================
+# QUERY LATENCY UNDER CONCURRENT INGEST: BLOCKING encode vs EmbeddingService
+# =============================================================================
+# Usage (from RAG-Chatbot/Backend, against an ingested DATABASE_URL):
+#   python -m benchmarks.mixed_load --concurrency 16 --duration 30 --ingest-files 200
+#
+# Runs in one event loop, the way the FastAPI app does: `--concurrency` query
+# workers (embed + fetch_similar) while an ingest of freshly generated .txt files
+# runs alongside. Modes:
+#   blocking - embed_text() called inline in the coroutine (the old handlers)
+#   service  - await aembed_text(): encode on the bounded thread pool
+# Every query string is unique (worker id + counter appended), so service mode
+# never hits the query-embedding cache (utils.query_cache) and both modes
+# encode every query: the comparison measures offloading, not cache hits.
+# Also reports event-loop lag (how late a 10ms sleep wakes up), which is what
+# every other request on the server would feel. Generated documents are removed
+# afterwards.
+import argparse
+import asyncio
+import os
+import random
+import shutil
+import tempfile
+import time
+from typing import List
+
+import numpy as np
+
+from db import DOCUMENTS_TABLE, _safe_table_name, fetch_similar, get_pool, init_db
+from ingest import index_folder
+from utils import aembed_text, embed_text
+
+WORDS = (
+    "vector index query latency document chunk embedding model pool batch "
+    "search recall filter postgres planner cosine distance ingest writer queue"
+).split()
+
+
+def _make_corpus(folder: str, n_files: int, words_per_file: int, seed: int) -> None:
+    rng = random.Random(seed)
+    for i in range(n_files):
+        text = " ".join(rng.choice(WORDS) for _ in range(words_per_file))
+        with open(os.path.join(folder, f"load_{i:05d}.txt"), "w", encoding="utf-8") as f:
+            f.write(f"{i} {time.time()} {text}")
+
+
+async def _loop_lag(stop: asyncio.Event, out: List[float]) -> None:
+    while not stop.is_set():
+        t0 = time.perf_counter()
+        await asyncio.sleep(0.01)
+        out.append(time.perf_counter() - t0 - 0.01)
+
+
+async def _query_worker(
+    pool, mode: str, wid: int, queries: List[str], stop: asyncio.Event, out: List[float]
+) -> None:
+    i = 0
+    while not stop.is_set():
+        q = f"{queries[i % len(queries)]} {wid}-{i}"  # unique: no cache hits
+        i += 1
+        t0 = time.perf_counter()
+        emb = embed_text(q) if mode == "blocking" else await aembed_text(q)
+        await fetch_similar(pool, emb, limit=5)
+        out.append(time.perf_counter() - t0)
+
+
+def _pct(xs: List[float]) -> str:
+    if not xs:
+        return "n=0"
+    ms = np.array(xs) * 1000
+    return (
+        f"n={len(ms):6d}  p50={np.percentile(ms, 50):8.2f}ms  p95={np.percentile(ms, 95):8.2f}ms  "
+        f"p99={np.percentile(ms, 99):8.2f}ms  max={ms.max():8.2f}ms"
+    )
+
+
+async def run_mode(pool, mode: str, args) -> None:
+    folder = tempfile.mkdtemp(prefix=f"mixed_load_{mode}_")
+    _make_corpus(folder, args.ingest_files, args.words_per_file, args.seed)
+    queries = [" ".join(random.Random(k).sample(WORDS, 6)) for k in range(64)]
+    stop = asyncio.Event()
+    lat: List[float] = []
+    lag: List[float] = []
+    try:
+        workers = [
+            asyncio.create_task(_query_worker(pool, mode, wid, queries, stop, lat))
+            for wid in range(args.concurrency)
+        ]
+        workers.append(asyncio.create_task(_loop_lag(stop, lag)))
+        t0 = time.perf_counter()
+        stats = await index_folder(pool, folder) if args.ingest_files else {}
+        ingest_s = time.perf_counter() - t0
+        await asyncio.sleep(max(0.0, args.duration - ingest_s))
+        stop.set()
+        await asyncio.gather(*workers)
+    finally:
+        async with pool.acquire() as conn:
+            docs = _safe_table_name(DOCUMENTS_TABLE)
+            await conn.execute(f"DELETE FROM {docs} WHERE path LIKE $1", folder + "%")
+        shutil.rmtree(folder, ignore_errors=True)
+
+    print(f"[{mode}] ingest {stats.get('ingested', 0)} files / {stats.get('chunks', 0)} chunks in {ingest_s:.1f}s")
+    print(f"  query     {_pct(lat)}")
+    print(f"  loop lag  {_pct(lag)}")
+
+
+async def main_async(args) -> None:
+    pool = await get_pool(min_size=args.concurrency + 2, max_size=args.concurrency + 4)
+    try:
+        await init_db(pool)
+        for mode in args.modes.split(","):
+            await run_mode(pool, mode.strip(), args)
+    finally:
+        await pool.close()
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="Query latency under concurrent ingest")
+    ap.add_argument("--concurrency", type=int, default=16)
+    ap.add_argument("--duration", type=float, default=30.0, help="seconds of query load per mode")
+    ap.add_argument("--ingest-files", type=int, default=200)
+    ap.add_argument("--words-per-file", type=int, default=2000)
+    ap.add_argument("--modes", default="blocking,service")
+    ap.add_argument("--seed", type=int, default=7)
+    asyncio.run(main_async(ap.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+# benchmarks/prepared_statements.py
+# =============================================================================
+# PER-QUERY LATENCY: AD HOC vs asyncpg LRU CACHE vs PREPARED-STATEMENT REGISTRY
+# =============================================================================
+# Usage (from RAG-Chatbot/Backend, against an ingested DATABASE_URL):
+#   python -m benchmarks.prepared_statements --concurrency 32 --requests 5000
+#
+# Modes:
+#   adhoc    - statement_cache_size=0: every call is parsed and planned again
+#   lru      - plain asyncpg pool: its built-in per-connection LRU statement cache
+#   registry - db.get_pool(): RagConnection prepares the hot queries in the init hook
+import argparse
+import asyncio
+import time
+from typing import List
+
+import asyncpg
+import numpy as np
+
+from db import (
+    DB_URL,
+    DOCUMENTS_TABLE,
+    EMBED_DIM,
+    _init_connection,
+    _safe_table_name,
+    fetch_similar,
+    get_document_by_path,
+    get_pool,
+)
+
+
+async def _make_pool(mode: str, size: int) -> asyncpg.Pool:
+    if mode == "registry":
+        return await get_pool(min_size=size, max_size=size)
+    cache = 0 if mode == "adhoc" else 100
+    return await asyncpg.create_pool(
+        dsn=DB_URL, min_size=size, max_size=size, statement_cache_size=cache, init=_init_connection
+    )
+
+
+async def run_mode(mode: str, args, paths: List[str], queries: np.ndarray) -> None:
+    pool = await _make_pool(mode, args.concurrency)
+    lat = {"fetch_similar": [], "get_document_by_path": []}
+    remaining = args.requests
+
+    async def worker(wid: int):
+        nonlocal remaining
+        i = wid
+        while remaining > 0:
+            remaining -= 1
+            t0 = time.perf_counter()
+            await fetch_similar(pool, queries[i % len(queries)], limit=5)
+            lat["fetch_similar"].append(time.perf_counter() - t0)
+            if paths:
+                t0 = time.perf_counter()
+                await get_document_by_path(pool, paths[i % len(paths)])
+                lat["get_document_by_path"].append(time.perf_counter() - t0)
+            i += args.concurrency
+
+    try:
+        # One warm-up pass so every mode starts with open connections
+        await asyncio.gather(*(fetch_similar(pool, queries[0]) for _ in range(args.concurrency)))
+        t0 = time.perf_counter()
+        await asyncio.gather(*(worker(w) for w in range(args.concurrency)))
+        wall = time.perf_counter() - t0
+    finally:
+        await pool.close()
+
+    print(f"[{mode}] {args.requests} requests, concurrency={args.concurrency}, {args.requests / wall:.0f} req/s")
+    for name, xs in lat.items():
+        if not xs:
+            continue
+        ms = np.array(xs) * 1000
+        print(
+            f"  {name:22s} mean={ms.mean():6.2f}ms  p50={np.percentile(ms, 50):6.2f}ms  "
+            f"p99={np.percentile(ms, 99):6.2f}ms"
+        )
+
+
+async def main_async(args) -> None:
+    if not DB_URL:
+        raise RuntimeError("DATABASE_URL is not set")
+    docs = _safe_table_name(DOCUMENTS_TABLE)
+    conn = await asyncpg.connect(DB_URL)
+    try:
+        paths = [r["path"] for r in await conn.fetch(f"SELECT path FROM {docs} LIMIT 1000")]
+    finally:
+        await conn.close()
+
+    rng = np.random.default_rng(0)
+    queries = rng.standard_normal((256, args.dim)).astype(np.float32)
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+    queries = queries.tolist()
+
+    for mode in args.modes.split(","):
+        await run_mode(mode.strip(), args, paths, queries)
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="Prepared-statement registry latency benchmark")
+    ap.add_argument("--requests", type=int, default=5000)
+    ap.add_argument("--concurrency", type=int, default=16)
+    ap.add_argument("--dim", type=int, default=EMBED_DIM)
+    ap.add_argument("--modes", default="adhoc,lru,registry")
+    asyncio.run(main_async(ap.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+# benchmarks/vector_codec.py
+# =============================================================================
+# TEXT LITERAL vs BINARY CODEC FOR pgvector PARAMETERS
+# =============================================================================
+# Usage (from RAG-Chatbot/Backend):
+#   python -m benchmarks.vector_codec                 # client-side encode cost only
+#   python -m benchmarks.vector_codec --db --rows 20000
+#
+# The --db mode needs DATABASE_URL and inserts into a throwaway TEMP table, so it
+# never touches document_chunks.
+import argparse
+import asyncio
+import time
+
+import asyncpg
+import numpy as np
+
+from db import (
+    DB_URL,
+    EMBED_DIM,
+    _encode_vector_binary,
+    _to_pgvector,
+    register_vector_codec,
+)
+
+
+def _random_embeddings(n: int, dim: int) -> np.ndarray:
+    rng = np.random.default_rng(42)
+    emb = rng.standard_normal((n, dim)).astype(np.float32)
+    return emb / np.linalg.norm(emb, axis=1, keepdims=True)
+
+
+def bench_encode(embs: np.ndarray) -> None:
+    as_lists = embs.tolist()  # what utils.embed_texts_batched hands to db today
+
+    t0 = time.perf_counter()
+    text_bytes = sum(len(_to_pgvector(e)) for e in as_lists)
+    t_text = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    bin_bytes = sum(len(_encode_vector_binary(e)) for e in embs)
+    t_bin = time.perf_counter() - t0
+
+    n = len(embs)
+    print(f"[encode] {n} x {embs.shape[1]}-dim vectors")
+    print(f"  text   : {t_text:8.3f}s  {n / t_text:10.0f} vec/s  {text_bytes / n:8.0f} B/vec")
+    print(f"  binary : {t_bin:8.3f}s  {n / t_bin:10.0f} vec/s  {bin_bytes / n:8.0f} B/vec")
+    print(f"  speedup: {t_text / t_bin:.1f}x")
+
+
+async def _insert_run(conn: asyncpg.Connection, rows, label: str) -> float:
+    await conn.execute("TRUNCATE _bench_vectors")
+    t0 = time.perf_counter()
+    async with conn.transaction():
+        await conn.executemany("INSERT INTO _bench_vectors (embedding) VALUES ($1::vector)", rows)
+    elapsed = time.perf_counter() - t0
+    print(f"  {label:7s}: {elapsed:8.3f}s  {len(rows) / elapsed:10.0f} rows/s")
+    return elapsed
+
+
+async def bench_db(embs: np.ndarray) -> None:
+    if not DB_URL:
+        raise RuntimeError("DATABASE_URL is not set")
+    dim = embs.shape[1]
+    print(f"[db] executemany INSERT of {len(embs)} rows")
+
+    # Separate connections: a codec registration can't be undone on a live connection.
+    text_conn = await asyncpg.connect(DB_URL)
+    bin_conn = await asyncpg.connect(DB_URL)
+    try:
+        await register_vector_codec(bin_conn)
+        for conn in (text_conn, bin_conn):
+            await conn.execute(f"CREATE TEMP TABLE _bench_vectors (embedding VECTOR({dim}))")
+
+        # Text path pays for str() on the client AND vector_in parsing on the server.
+        t_text = await _insert_run(
+            text_conn, [(_to_pgvector(e),) for e in embs.tolist()], "text"
+        )
+        t_bin = await _insert_run(bin_conn, [(e,) for e in embs], "binary")
+        print(f"  speedup: {t_text / t_bin:.1f}x")
+    finally:
+        await text_conn.close()
+        await bin_conn.close()
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="Text vs binary pgvector codec benchmark")
+    ap.add_argument("--rows", type=int, default=10000)
+    ap.add_argument("--dim", type=int, default=EMBED_DIM)
+    ap.add_argument("--db", action="store_true", help="also time inserts against DATABASE_URL")
+    args = ap.parse_args()
+
+    embs = _random_embeddings(args.rows, args.dim)
+    bench_encode(embs)
+    if args.db:
+        asyncio.run(bench_db(embs))
+
+
+if __name__ == "__main__":
+    main()
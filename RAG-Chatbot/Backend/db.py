@@ -1,11 +1,18 @@
-# db.py — uses only "document_chunks" table for all document information
+# db.py — document metadata in "documents", chunk text + embeddings in "document_chunks"
+import asyncio
 import os
 import re
-from typing import List, Optional, Tuple
+import struct
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, List, NamedTuple, Optional, Sequence, Tuple
 
 import asyncpg
+import numpy as np
 from dotenv import load_dotenv
 
+import metrics
+
 load_dotenv()
 
 # -----------------------------------------------------------------------------
@@ -14,12 +21,56 @@ load_dotenv()
 DB_URL = os.getenv("DATABASE_URL")
 EMBED_DIM = int(os.getenv("EMBED_DIM", "1024"))            # gte-large = 1024
 VECTOR_METRIC = os.getenv("VECTOR_METRIC", "cosine").lower()
+ANN_INDEX = os.getenv("ANN_INDEX", "ivfflat").lower()        # "ivfflat" or "hnsw"
 IVFFLAT_LISTS = int(os.getenv("IVFFLAT_LISTS", "100"))
+HNSW_M = int(os.getenv("HNSW_M", "16"))
+HNSW_EF_CONSTRUCTION = int(os.getenv("HNSW_EF_CONSTRUCTION", "64"))
+HNSW_EF_SEARCH = int(os.getenv("HNSW_EF_SEARCH", "40"))
 CHUNKS_TABLE = os.getenv("CHUNKS_TABLE", "document_chunks")  # keep old name by default
+DOCUMENTS_TABLE = os.getenv("DOCUMENTS_TABLE", "documents")  # one row per source file, keyed by path
+CHUNK_EMBED_CACHE_TABLE = os.getenv("CHUNK_EMBED_CACHE_TABLE", "embedding_cache")  # retired; dropped by migration 13
+VECTOR_CODEC = os.getenv("VECTOR_CODEC", "text").lower()     # "text" (default) or "binary"
+CHUNK_INSERT_MODE = os.getenv("CHUNK_INSERT_MODE", "copy").lower()  # "copy" or "executemany"
+PREPARED_STATEMENTS = os.getenv("PREPARED_STATEMENTS", "1") == "1"  # warm hot queries per connection
+FILTER_STRATEGY = os.getenv("FILTER_STRATEGY", "auto").lower()  # "auto", "iterative" or "overfetch"
+FILTER_OVERFETCH = int(os.getenv("FILTER_OVERFETCH", "10"))     # ANN candidates per requested row
+FTS_CONFIG = os.getenv("FTS_CONFIG", "english")                 # text search config for content_tsv
+RRF_K = int(os.getenv("RRF_K", "60"))                           # reciprocal rank fusion constant
+EMBED_STORAGE = os.getenv("EMBED_STORAGE", "vector").lower()    # "vector", "halfvec" or "bit"
+BIT_RERANK = int(os.getenv("BIT_RERANK", "4"))                  # bit mode: candidates per row, re-ranked in float
+
+# Pool sizing / timeouts (0 disables the corresponding limit)
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
+DB_COMMAND_TIMEOUT = float(os.getenv("DB_COMMAND_TIMEOUT", "30"))             # client-side, seconds
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "30000"))  # server-side
+DB_MAX_QUERIES = int(os.getenv("DB_MAX_QUERIES", "50000"))                    # recycle conn after N queries
+DB_MAX_INACTIVE_LIFETIME = float(os.getenv("DB_MAX_INACTIVE_LIFETIME", "300"))  # close idle conns, seconds
+DB_MAINTENANCE_TIMEOUT = float(os.getenv("DB_MAINTENANCE_TIMEOUT", "21600"))    # DDL/backfills, seconds
+DB_WRITE_TIMEOUT = float(os.getenv("DB_WRITE_TIMEOUT", "600"))  # one ingest write batch (client + server), seconds
 
 if VECTOR_METRIC not in ("cosine", "l2"):
     raise ValueError("VECTOR_METRIC must be 'cosine' or 'l2'")
-VECTOR_OPS = "vector_cosine_ops" if VECTOR_METRIC == "cosine" else "vector_l2_ops"
+if VECTOR_CODEC not in ("text", "binary"):
+    raise ValueError("VECTOR_CODEC must be 'text' or 'binary'")
+if CHUNK_INSERT_MODE not in ("copy", "executemany"):
+    raise ValueError("CHUNK_INSERT_MODE must be 'copy' or 'executemany'")
+if ANN_INDEX not in ("ivfflat", "hnsw"):
+    raise ValueError("ANN_INDEX must be 'ivfflat' or 'hnsw'")
+if FILTER_STRATEGY not in ("auto", "iterative", "overfetch"):
+    raise ValueError("FILTER_STRATEGY must be 'auto', 'iterative' or 'overfetch'")
+if not re.fullmatch(r"[A-Za-z_][A-Za-z0-9_]*", FTS_CONFIG):
+    raise ValueError("FTS_CONFIG must be a plain text search configuration name")
+if EMBED_STORAGE not in ("vector", "halfvec", "bit"):
+    raise ValueError("EMBED_STORAGE must be 'vector', 'halfvec' or 'bit'")
+# halfvec stores 2-byte floats; bit keeps float32 rows but indexes binary_quantize(embedding)
+EMBED_COLUMN_TYPE = f"HALFVEC({EMBED_DIM})" if EMBED_STORAGE == "halfvec" else f"VECTOR({EMBED_DIM})"
+_VEC_TYPE = "halfvec" if EMBED_STORAGE == "halfvec" else "vector"
+VECTOR_OPS = f"{_VEC_TYPE}_cosine_ops" if VECTOR_METRIC == "cosine" else f"{_VEC_TYPE}_l2_ops"
+_BIT_EXPR = f"(binary_quantize(embedding)::bit({EMBED_DIM}))"
+ANN_INDEX_EXPR = f"{_BIT_EXPR} bit_hamming_ops" if EMBED_STORAGE == "bit" else f"embedding {VECTOR_OPS}"
+# The ORDER BY operator must match the index opclass, or the planner ignores the index
+VECTOR_OPERATOR = "<=>" if VECTOR_METRIC == "cosine" else "<->"
 
 
 # -----------------------------------------------------------------------------
@@ -36,98 +87,493 @@ def _to_pgvector(embedding: List[float]) -> str:
     return "[" + ",".join(str(x) for x in embedding) + "]"
 
 
+# pgvector binary wire format: int16 dim, int16 unused, then dim x float32 (big-endian)
+_VECTOR_HEADER = struct.Struct(">HH")
+
+def _encode_vector_binary(embedding: Sequence[float]) -> bytes:
+    """Pack a list/ndarray of floats into pgvector's binary send format."""
+    arr = np.asarray(embedding, dtype=">f4")
+    if arr.ndim != 1:
+        raise ValueError("vector must be one-dimensional")
+    return _VECTOR_HEADER.pack(arr.shape[0], 0) + arr.tobytes()
+
+def _decode_vector_binary(data: bytes) -> np.ndarray:
+    """Unpack pgvector's binary format into a native float32 ndarray."""
+    dim, _ = _VECTOR_HEADER.unpack_from(data)
+    return np.frombuffer(data, dtype=">f4", count=dim, offset=_VECTOR_HEADER.size).astype(np.float32)
+
+def _vector_param(embedding: Sequence[float]):
+    """
+    Bind value for a `$n::vector` parameter.
+    - text codec: a '[x,y,...]' literal that Postgres parses server-side
+    - binary codec: the raw sequence; the registered codec packs it as float32
+    """
+    if VECTOR_CODEC == "binary":
+        return embedding
+    return _to_pgvector(embedding)
+
+def _vector_array_sql(n: int) -> str:
+    """SQL expression for a vector[] bind parameter `$n` (text codec goes via text[])."""
+    if VECTOR_CODEC == "binary":
+        return f"${n}::vector[]"
+    return f"${n}::text[]::vector[]"
+
+
+def _query_vec(expr: str) -> str:
+    """Cast a vector-typed query expression to the storage type of `embedding`."""
+    if EMBED_STORAGE == "halfvec":
+        return f"({expr})::halfvec({EMBED_DIM})"
+    return expr
+
+def _knn_sql(table: str, qexpr: str, cols: str, limit: str, where: str = "") -> str:
+    """
+    SELECT {cols}, distance for the `limit` rows nearest to `qexpr`, served by the ANN index.
+    bit storage: Hamming-distance candidates from the quantized index (BIT_RERANK x limit),
+    re-ranked by the full-precision distance.
+    """
+    q = _query_vec(qexpr)
+    dist = f"embedding {VECTOR_OPERATOR} {q}"
+    where_sql = f"WHERE {where}" if where else ""
+    if EMBED_STORAGE == "bit":
+        return f"""
+            SELECT {cols}, ({dist}) AS distance
+            FROM (
+                SELECT {cols}, embedding
+                FROM {table}
+                {where_sql}
+                ORDER BY {_BIT_EXPR} <~> binary_quantize({q})
+                LIMIT ({limit}) * {BIT_RERANK}
+            ) cand
+            ORDER BY distance
+            LIMIT {limit}
+        """
+    return f"""
+        SELECT {cols}, ({dist}) AS distance
+        FROM {table}
+        {where_sql}
+        ORDER BY {dist}
+        LIMIT {limit}
+    """
+
+
+# -----------------------------------------------------------------------------
+# PREPARED STATEMENTS (PARSED + PLANNED ONCE PER CONNECTION)
+# -----------------------------------------------------------------------------
+def _build_statements(table: str, docs: str) -> Dict[str, str]:
+    return {
+        "fetch_similar": _knn_sql(table, "$1::vector", "id, document_id, content", "$2"),
+        "fetch_similar_many": f"""
+            SELECT q.ord, r.content, r.distance
+            FROM unnest({_vector_array_sql(1)}) WITH ORDINALITY AS q(vec, ord)
+            CROSS JOIN LATERAL (
+                {_knn_sql(table, "q.vec", "content", "$2")}
+            ) r
+            ORDER BY q.ord, r.distance
+        """,
+        "fetch_similar_simple": f"SELECT content FROM ({_knn_sql(table, '$1::vector', 'content', '$2')}) r ORDER BY distance",
+        # Second branch: chunks written before the documents table existed, until
+        # migration 8 has linked them (UNION ALL + LIMIT stops at the first row)
+        "get_document_by_path": f"""
+            (SELECT id, sha256 FROM {docs} WHERE path = $1)
+            UNION ALL
+            (SELECT id, sha256 FROM {table} WHERE path = $1 AND document_id IS NULL LIMIT 1)
+            LIMIT 1
+        """,
+        "delete_chunks_for_document": f"""
+            DELETE FROM {table}
+            WHERE document_id = (SELECT id FROM {docs} WHERE path = $1)
+               OR (document_id IS NULL AND path = $1)
+        """,
+        "hybrid_vector": _knn_sql(table, "$1::vector", "id, document_id, content", "$2"),
+        "hybrid_lexical": f"""
+            SELECT id, document_id, content, ts_rank_cd(content_tsv, q) AS rank
+            FROM {table}, websearch_to_tsquery('{FTS_CONFIG}', $1) q
+            WHERE content_tsv @@ q
+            ORDER BY rank DESC
+            LIMIT $2
+        """,
+    }
+
+STATEMENTS = _build_statements(_safe_table_name(CHUNKS_TABLE), _safe_table_name(DOCUMENTS_TABLE))
+
+
+class RagConnection(asyncpg.Connection):
+    """asyncpg connection that keeps a registry of named prepared statements."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._statements: Dict[str, "asyncpg.prepared_stmt.PreparedStatement"] = {}
+
+    async def statement(self, name: str):
+        stmt = self._statements.get(name)
+        if stmt is None:
+            stmt = await self.prepare(STATEMENTS[name])
+            self._statements[name] = stmt
+        return stmt
+
+    async def warm_statements(self) -> None:
+        """Prepare every registered statement; the table may not exist yet on a fresh DB."""
+        for name in list(STATEMENTS):  # filtered searches register more at runtime
+            try:
+                await self.statement(name)
+            except asyncpg.PostgresError:
+                pass  # prepared lazily on first use instead
+
+async def _fetch(conn, name: str, *args) -> list:
+    """Run registered statement `name`; without the registry, asyncpg's LRU statement cache applies."""
+    if PREPARED_STATEMENTS and hasattr(conn, "statement"):
+        return await (await conn.statement(name)).fetch(*args)
+    return await conn.fetch(STATEMENTS[name], *args)
+
+async def _fetchrow(conn, name: str, *args):
+    if PREPARED_STATEMENTS and hasattr(conn, "statement"):
+        return await (await conn.statement(name)).fetchrow(*args)
+    return await conn.fetchrow(STATEMENTS[name], *args)
+
+
 # -----------------------------------------------------------------------------
 # POOL
 # -----------------------------------------------------------------------------
-async def get_pool(min_size: int = 1, max_size: int = 10) -> asyncpg.Pool:
+POOL_ACQUIRE_SECONDS = metrics.Histogram(
+    "db_pool_acquire_seconds", "Time spent waiting for a pooled connection", ["function"]
+)
+DB_CALL_SECONDS = metrics.Histogram(
+    "db_call_seconds", "Time a db.py function held its connection", ["function"]
+)
+POOL_IN_USE = metrics.Gauge("db_pool_connections_in_use", "Connections currently checked out")
+POOL_SIZE = metrics.Gauge("db_pool_connections", "Connections currently open (idle + in use)")
+POOL_MAX = metrics.Gauge("db_pool_max_connections", "Configured pool max_size")
+
+@asynccontextmanager
+async def _acquire(pool: asyncpg.Pool, function: str) -> AsyncIterator[asyncpg.Connection]:
+    """pool.acquire() that records acquire wait, hold time and in-use connections."""
+    t0 = time.perf_counter()
+    async with pool.acquire() as conn:
+        t1 = time.perf_counter()
+        POOL_ACQUIRE_SECONDS.observe(t1 - t0, function=function)
+        POOL_IN_USE.inc()
+        try:
+            yield conn
+        finally:
+            POOL_IN_USE.dec()
+            DB_CALL_SECONDS.observe(time.perf_counter() - t1, function=function)
+
+async def _maintenance(conn: asyncpg.Connection, sql: str) -> str:
+    """
+    Run DDL / backfills that may take far longer than a query: lift the server
+    statement_timeout for this session (RESET ALL on release restores it) and
+    use the maintenance client timeout instead of DB_COMMAND_TIMEOUT.
+    """
+    await conn.execute("SET statement_timeout = 0")
+    return await conn.execute(sql, timeout=DB_MAINTENANCE_TIMEOUT)
+
+def update_pool_gauges(pool: Optional[asyncpg.Pool]) -> None:
+    """Refresh size gauges from the pool (called when /metrics is scraped)."""
+    if pool is None:
+        return
+    POOL_SIZE.set(pool.get_size())
+    POOL_MAX.set(pool.get_max_size())
+
+async def register_vector_codec(conn: asyncpg.Connection) -> None:
+    """
+    Register a binary codec for the pgvector `vector` type on this connection.
+    The extension must exist before the type can be looked up, so create it here
+    if this is the very first connection against a fresh database.
+    """
+    if await conn.fetchval("SELECT to_regtype('vector') IS NULL"):
+        await conn.execute("CREATE EXTENSION IF NOT EXISTS vector;")
+    schema = await conn.fetchval(
+        "SELECT n.nspname FROM pg_type t JOIN pg_namespace n ON n.oid = t.typnamespace "
+        "WHERE t.typname = 'vector' LIMIT 1"
+    )
+    await conn.set_type_codec(
+        "vector",
+        schema=schema or "public",
+        encoder=_encode_vector_binary,
+        decoder=_decode_vector_binary,
+        format="binary",
+    )
+
+async def _init_connection(conn: asyncpg.Connection) -> None:
+    """Per-connection setup, run by the pool for every new connection."""
+    if VECTOR_CODEC == "binary":
+        await register_vector_codec(conn)
+    # After codec registration, so statements bind vectors with the right codec
+    if PREPARED_STATEMENTS and isinstance(conn, RagConnection):
+        await conn.warm_statements()
+
+async def get_pool(min_size: Optional[int] = None, max_size: Optional[int] = None) -> asyncpg.Pool:
     if not DB_URL:
         raise RuntimeError("DATABASE_URL is not set")
-    return await asyncpg.create_pool(dsn=DB_URL, min_size=min_size, max_size=max_size)
+    server_settings = {}
+    if DB_STATEMENT_TIMEOUT_MS > 0:
+        server_settings["statement_timeout"] = str(DB_STATEMENT_TIMEOUT_MS)
+    return await asyncpg.create_pool(
+        dsn=DB_URL,
+        min_size=DB_POOL_MIN if min_size is None else min_size,
+        max_size=DB_POOL_MAX if max_size is None else max_size,
+        command_timeout=DB_COMMAND_TIMEOUT or None,
+        max_queries=DB_MAX_QUERIES or 2**62,
+        max_inactive_connection_lifetime=DB_MAX_INACTIVE_LIFETIME,
+        server_settings=server_settings,
+        init=_init_connection,
+        connection_class=RagConnection,
+    )
 
 
 # -----------------------------------------------------------------------------
 # INIT (NON-FATAL IF DATA IS DIRTY)
 # -----------------------------------------------------------------------------
-async def init_db(pool: asyncpg.Pool) -> None:
+async def init_db(pool: asyncpg.Pool, background: bool = False) -> Optional[asyncio.Task]:
     """
-    Ensures extensions exist and that 'document_chunks' has the columns + ANN index we need.
+    Ensures extensions exist and that 'documents' / 'document_chunks' have the columns + indexes we need.
+    - Schema changes are versioned (migrations.py) and each runs once.
+    - Only catalog-only migrations run here, so startup time doesn't depend on table size.
+    - Backfills and CONCURRENTLY index builds (incl. the ANN index) run afterwards:
+      in a returned background task if `background`, else inline before returning.
     - Will NOT crash the app if unique index creation fails due to duplicates.
     """
+    # LAZY IMPORT TO AVOID CIRCULAR DEPENDENCIES
+    from migrations import create_index_concurrently, run_background_migrations, run_startup_migrations
+
     table = _safe_table_name(CHUNKS_TABLE)
 
-    async with pool.acquire() as conn:
+    async with _acquire(pool, "init_db") as conn:
         # Extensions we rely on
-        await conn.execute("CREATE EXTENSION IF NOT EXISTS vector;")
-        await conn.execute("CREATE EXTENSION IF NOT EXISTS pgcrypto;")  # digest(), gen_random_uuid()
-
-
-        # Ensure the chunks table exists with all necessary columns
-        await conn.execute(f"""
-            CREATE TABLE IF NOT EXISTS {table} (
-                id SERIAL PRIMARY KEY,
-                content TEXT,
-                embedding VECTOR({EMBED_DIM}),
-                path TEXT NOT NULL,
-                filename TEXT NOT NULL,
-                size_bytes BIGINT NOT NULL,
-                mtime TIMESTAMPTZ NOT NULL,
-                sha256 TEXT NOT NULL,
-                processed_at TIMESTAMPTZ NOT NULL DEFAULT now(),
-                chunk_index int NOT NULL DEFAULT 0,
-                chunk_sha256 text
-            );
-        """)
-
-        # Columns required for dedupe (no data loss)
-        await conn.execute(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS chunk_index int NOT NULL DEFAULT 0;")
-        await conn.execute(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS chunk_sha256 text;")
-
-        # Backfill per-chunk hash for existing rows (skip NULL content)
-        await conn.execute(f"""
-            UPDATE {table}
-            SET chunk_sha256 = encode(digest(content, 'sha256'), 'hex')
-            WHERE chunk_sha256 IS NULL AND content IS NOT NULL;
-        """)
-
-        # Create unique indexes IF POSSIBLE — don't crash if duplicates exist
-        # (You can run the one-time cleanup SQL I shared earlier to remove duplicates,
-        # then restart to get these uniques in place.)
-        try:
-            await conn.execute(f"""
-                CREATE UNIQUE INDEX IF NOT EXISTS uq_{table}_doc_idx
-                ON {table}(path, chunk_index);
-            """)
-        except asyncpg.PostgresError as e:
-            print(f"[init_db] WARN: couldn't create uq_{table}_doc_idx (duplicates exist?): {e}")
+        await _maintenance(conn, "CREATE EXTENSION IF NOT EXISTS vector;")
+        await _maintenance(conn, "CREATE EXTENSION IF NOT EXISTS pgcrypto;")  # digest(), gen_random_uuid()
 
-        try:
-            await conn.execute(f"""
-                CREATE UNIQUE INDEX IF NOT EXISTS uq_{table}_doc_hash
-                ON {table}(path, chunk_sha256)
-                WHERE chunk_sha256 IS NOT NULL;
-            """)
-        except asyncpg.PostgresError as e:
-            print(f"[init_db] WARN: couldn't create uq_{table}_doc_hash (duplicates exist?): {e}")
-
-        # ANN index for fast vector search
-        await conn.execute(f"""
-            CREATE INDEX IF NOT EXISTS idx_{table}_embedding
-            ON {table}
-            USING ivfflat (embedding {VECTOR_OPS})
-            WITH (lists = {IVFFLAT_LISTS});
-        """)
+    await run_startup_migrations(pool)
+
+    async with _acquire(pool, "init_db") as conn:
+        # pgvector >= 0.8 can keep scanning the ANN index until enough rows pass the filter
+        global _ITERATIVE_SCAN
+        version = await conn.fetchval("SELECT extversion FROM pg_extension WHERE extname = 'vector'")
+        _ITERATIVE_SCAN = _version_tuple(version) >= (0, 8)
+        await _refresh_ann_method(conn, table)
+
+        current = await _embedding_column_type(conn, table)
+        if current != _VEC_TYPE:
+            print(
+                f"[init_db] WARN: {table}.embedding is {current}, EMBED_STORAGE={EMBED_STORAGE} needs "
+                f"{_VEC_TYPE}; run migrate_embedding_storage() (POST /admin/migrate-storage/)"
+            )
+
+    async def ensure_ann_index(conn: asyncpg.Connection) -> None:
+        # ANN index for fast vector search. If one already exists (possibly with a
+        # different strategy) it is left alone; use reindex() to switch or rebuild.
+        if current == _VEC_TYPE:
+            index_name = f"idx_{table}_embedding"
+            await create_index_concurrently(
+                conn, index_name, _ann_index_sql(table, index_name, concurrently=True)
+            )
+            await _refresh_ann_method(conn, table)
+
+    work = run_background_migrations(pool, after=ensure_ann_index)
+    if background:
+        return asyncio.create_task(work)
+    await work
+    return None
+
+
+# -----------------------------------------------------------------------------
+# ANN INDEX (IVFFLAT / HNSW)
+# -----------------------------------------------------------------------------
+def ivfflat_lists_for(row_count: int) -> int:
+    """pgvector guidance: rows/1000 up to 1M rows, sqrt(rows) beyond that."""
+    if row_count <= 1_000_000:
+        return max(1, row_count // 1000)
+    return int(row_count ** 0.5)
+
+def _ann_index_sql(
+    table: str,
+    index_name: str,
+    strategy: Optional[str] = None,
+    lists: Optional[int] = None,
+    *,
+    if_not_exists: bool = False,
+    concurrently: bool = False,
+) -> str:
+    strategy = (strategy or ANN_INDEX).lower()
+    if strategy == "hnsw":
+        method = "hnsw"
+        params = f"m = {HNSW_M}, ef_construction = {HNSW_EF_CONSTRUCTION}"
+    elif strategy == "ivfflat":
+        method = "ivfflat"
+        params = f"lists = {int(lists or IVFFLAT_LISTS)}"
+    else:
+        raise ValueError("index strategy must be 'ivfflat' or 'hnsw'")
+    return f"""
+        CREATE INDEX {"CONCURRENTLY " if concurrently else ""}{"IF NOT EXISTS " if if_not_exists else ""}{index_name}
+        ON {table}
+        USING {method} ({ANN_INDEX_EXPR})
+        WITH ({params});
+    """
+
+async def reindex(
+    pool: asyncpg.Pool, strategy: Optional[str] = None, lists: Optional[int] = None
+) -> dict:
+    """
+    Rebuild the ANN index without blocking reads or writes.
+    Builds a new index CONCURRENTLY, then swaps it in for the old one.
+    For ivfflat, `lists` defaults to a value derived from the current row count.
+    """
+    table = _safe_table_name(CHUNKS_TABLE)
+    strategy = (strategy or ANN_INDEX).lower()
+    index_name = f"idx_{table}_embedding"
+    tmp_name = f"{index_name}_new"
+
+    # CONCURRENTLY can't run inside a transaction block, so no conn.transaction() here
+    async with _acquire(pool, "reindex") as conn:
+        row_count = await conn.fetchval(f"SELECT count(*) FROM {table}")
+        if strategy == "ivfflat" and lists is None:
+            lists = ivfflat_lists_for(row_count)
+
+        t0 = time.perf_counter()
+        # Leftover from an interrupted rebuild would be INVALID; drop it first
+        await _maintenance(conn, f"DROP INDEX CONCURRENTLY IF EXISTS {tmp_name};")
+        await _maintenance(conn, _ann_index_sql(table, tmp_name, strategy, lists, concurrently=True))
+        await _maintenance(conn, f"DROP INDEX CONCURRENTLY IF EXISTS {index_name};")
+        await _maintenance(conn, f"ALTER INDEX {tmp_name} RENAME TO {index_name};")
+        elapsed = time.perf_counter() - t0
+        await _refresh_ann_method(conn, table)
+
+    result = {"strategy": strategy, "rows": row_count, "seconds": round(elapsed, 3)}
+    if strategy == "ivfflat":
+        result["lists"] = lists
+    else:
+        result.update(m=HNSW_M, ef_construction=HNSW_EF_CONSTRUCTION)
+    print(f"[reindex] {result}")
+    return result
+
+
+async def _embedding_column_type(conn: asyncpg.Connection, table: str) -> Optional[str]:
+    """'vector' or 'halfvec' — the type the embedding column currently has."""
+    return await conn.fetchval(
+        """
+        SELECT t.typname
+        FROM pg_attribute a JOIN pg_type t ON t.oid = a.atttypid
+        WHERE a.attrelid = to_regclass($1) AND a.attname = 'embedding'
+        """,
+        table,
+    )
+
+async def migrate_embedding_storage(pool: asyncpg.Pool) -> dict:
+    """
+    Bring the embedding column and ANN index in line with EMBED_STORAGE.
+    - vector <-> halfvec: drops the ANN index and rewrites the column in place
+      (ACCESS EXCLUSIVE lock for the duration; run in a maintenance window)
+    - bit: column stays vector; the ANN index is rebuilt over binary_quantize(embedding)
+    """
+    table = _safe_table_name(CHUNKS_TABLE)
+    index_name = f"idx_{table}_embedding"
+
+    async with _acquire(pool, "migrate_embedding_storage") as conn:
+        current = await _embedding_column_type(conn, table)
+        t0 = time.perf_counter()
+        if current != _VEC_TYPE:
+            async with conn.transaction():
+                # The old opclass doesn't accept the new type, so the index can't survive ALTER
+                await _maintenance(conn, f"DROP INDEX IF EXISTS {index_name};")
+                await _maintenance(conn, f"""
+                    ALTER TABLE {table}
+                    ALTER COLUMN embedding TYPE {EMBED_COLUMN_TYPE}
+                    USING embedding::{EMBED_COLUMN_TYPE};
+                """)
+        alter_s = time.perf_counter() - t0
+
+    # Prepared plans reference the old column type; new connections re-prepare
+    await pool.expire_connections()
+
+    index_info = await reindex(pool)
+    async with _acquire(pool, "migrate_embedding_storage") as conn:
+        table_bytes = await conn.fetchval("SELECT pg_table_size(to_regclass($1))", table)
+        index_bytes = await conn.fetchval("SELECT pg_relation_size(to_regclass($1))", index_name)
+
+    result = {
+        "storage": EMBED_STORAGE,
+        "from_type": current,
+        "to_type": _VEC_TYPE,
+        "alter_seconds": round(alter_s, 3),
+        "index": index_info,
+        "table_bytes": table_bytes,
+        "index_bytes": index_bytes,
+    }
+    print(f"[migrate_embedding_storage] {result}")
+    return result
 
 
 # -----------------------------------------------------------------------------
 # DOCUMENT HELPERS
 # -----------------------------------------------------------------------------
 async def get_document_by_path(pool: asyncpg.Pool, path: str) -> Optional[dict]:
-    table = _safe_table_name(CHUNKS_TABLE)
-    q = f"SELECT DISTINCT ON (path) id, sha256 FROM {table} WHERE path = $1"
-    async with pool.acquire() as conn:
-        row = await conn.fetchrow(q, path)
+    async with _acquire(pool, "get_document_by_path") as conn:
+        row = await _fetchrow(conn, "get_document_by_path", path)
         return dict(row) if row else None
 
+async def get_document_index(pool: asyncpg.Pool, paths: Optional[Sequence[str]] = None) -> Dict[str, dict]:
+    """
+    All known documents in one query: {path: {"sha256", "size_bytes", "mtime"}}.
+    Lets the indexer decide skip/re-ingest in memory instead of one lookup per file.
+    `paths` restricts the lookup to those documents (watcher batches).
+    """
+    table = _safe_table_name(CHUNKS_TABLE)
+    docs = _safe_table_name(DOCUMENTS_TABLE)
+    where = "" if paths is None else "WHERE path = ANY($1::text[])"
+    # Second branch: legacy chunks not yet linked to a documents row (migration 8)
+    q = f"""
+        SELECT path, sha256, size_bytes, mtime FROM {docs} {where}
+        UNION ALL
+        SELECT DISTINCT ON (path) path, sha256, size_bytes, mtime
+        FROM {table}
+        WHERE document_id IS NULL AND path IS NOT NULL {"" if paths is None else "AND path = ANY($1::text[])"}
+    """
+    args = () if paths is None else (list(paths),)
+    async with _acquire(pool, "get_document_index") as conn:
+        rows = await conn.fetch(q, *args)
+    index: Dict[str, dict] = {}
+    for r in rows:
+        index.setdefault(r["path"], {"sha256": r["sha256"], "size_bytes": r["size_bytes"], "mtime": r["mtime"]})
+    return index
+
+async def get_documents_watermark(pool: asyncpg.Pool) -> list:
+    """
+    [row count, latest processed_at] of the documents table. Every document write
+    bumps processed_at and deletes change the count, so an unchanged watermark
+    means a cached copy of get_document_index() is still current.
+    """
+    docs = _safe_table_name(DOCUMENTS_TABLE)
+    async with _acquire(pool, "get_documents_watermark") as conn:
+        row = await conn.fetchrow(f"SELECT count(*) AS n, max(processed_at) AS at FROM {docs}")
+    return [row["n"], row["at"].isoformat() if row["at"] else None]
+
+async def get_document_ids(pool: asyncpg.Pool, paths: Sequence[str]) -> List[int]:
+    """documents.id for each known path (unknown paths are skipped)."""
+    if not paths:
+        return []
+    docs = _safe_table_name(DOCUMENTS_TABLE)
+    async with _acquire(pool, "get_document_ids") as conn:
+        rows = await conn.fetch(f"SELECT id FROM {docs} WHERE path = ANY($1::text[])", list(paths))
+    return [r["id"] for r in rows]
+
+async def _upsert_document(conn: asyncpg.Connection, doc: Tuple, timeout: Optional[float] = None) -> int:
+    """
+    Insert or update the documents row for doc = (path, filename, size_bytes, mtime,
+    sha256[, extractor]); returns its id. A missing/None extractor keeps the stored one.
+    """
+    docs = _safe_table_name(DOCUMENTS_TABLE)
+    if len(doc) == 5:
+        doc = tuple(doc) + (None,)
+    return await conn.fetchval(f"""
+        INSERT INTO {docs} (path, filename, size_bytes, mtime, sha256, extractor)
+        VALUES ($1, $2, $3, $4, $5, $6)
+        ON CONFLICT (path) DO UPDATE
+        SET filename = EXCLUDED.filename, size_bytes = EXCLUDED.size_bytes,
+            mtime = EXCLUDED.mtime, sha256 = EXCLUDED.sha256, processed_at = now(),
+            extractor = COALESCE(EXCLUDED.extractor, {docs}.extractor)
+        RETURNING id
+    """, *doc, timeout=timeout)
+
 async def upsert_document_metadata(
     pool: asyncpg.Pool,
     *,
@@ -136,27 +582,143 @@ async def upsert_document_metadata(
     size_bytes: int,
     mtime_dt,
     sha256: str,
-) -> None:
-    """
-    Update document metadata for all chunks of a document.
+) -> int:
     """
-    table = _safe_table_name(CHUNKS_TABLE)
-    q = f"""
-    UPDATE {table}
-    SET path = $1, filename = $2, size_bytes = $3, mtime = $4, sha256 = $5, processed_at = now()
-    WHERE path = $1
+    Upsert the single documents row for `path` (chunk rows are not touched).
+    Returns the document id.
     """
-    async with pool.acquire() as conn:
-        await conn.execute(q, path, filename, size_bytes, mtime_dt, sha256)
+    async with _acquire(pool, "upsert_document_metadata") as conn:
+        return await _upsert_document(conn, (path, filename, size_bytes, mtime_dt, sha256))
 
 
 # -----------------------------------------------------------------------------
 # CHUNK HELPERS
 # -----------------------------------------------------------------------------
 async def delete_chunks_for_document(pool: asyncpg.Pool, path: str) -> None:
-    table = _safe_table_name(CHUNKS_TABLE)
-    async with pool.acquire() as conn:
-        await conn.execute(f"DELETE FROM {table} WHERE path = $1", path)
+    async with _acquire(pool, "delete_chunks_for_document") as conn:
+        await _fetch(conn, "delete_chunks_for_document", path)
+
+def _rowcount(status: str) -> int:
+    """Parse the affected-row count out of a command tag like 'INSERT 0 42'."""
+    try:
+        return int(status.rsplit(" ", 1)[-1])
+    except (ValueError, AttributeError):
+        return 0
+
+async def _insert_chunks_executemany(
+    conn: asyncpg.Connection,
+    table: str,
+    records: List[Tuple[int, int, str, List[float], str, Optional[int]]],
+    timeout: Optional[float] = None,
+) -> int:
+    """Per-row INSERT ... ON CONFLICT via executemany (one round trip per batch, one plan per row)."""
+    upsert_sql = f"""
+        INSERT INTO {table} (document_id, chunk_index, content, embedding, chunk_sha256, page)
+        VALUES ($1, $2, $3, $4::vector, $5, $6)
+        ON CONFLICT (document_id, chunk_sha256) WHERE chunk_sha256 IS NOT NULL DO NOTHING;
+    """
+
+    fallback_sql = f"""
+        INSERT INTO {table} (document_id, chunk_index, content, embedding, chunk_sha256, page)
+        SELECT $1, $2, $3, $4::vector, $5, $6
+        WHERE NOT EXISTS (
+            SELECT 1 FROM {table}
+            WHERE document_id = $1 AND chunk_sha256 = $5
+        );
+    """
+
+    prepared = [
+        (doc_id, idx, txt, _vector_param(emb), chash, page)
+        for (doc_id, idx, txt, emb, chash, page) in records
+    ]
+    doc_ids = sorted({r[0] for r in records})
+
+    # executemany returns None, so count the documents' rows around it
+    count_sql = f"SELECT count(*) FROM {table} WHERE document_id = ANY($1::bigint[])"
+    before = await conn.fetchval(count_sql, doc_ids, timeout=timeout)
+    try:
+        # Savepoint, so a failed attempt doesn't abort the outer transaction
+        async with conn.transaction():
+            await conn.executemany(upsert_sql, prepared, timeout=timeout)
+    except asyncpg.PostgresError:
+        # Likely "there is no unique or exclusion constraint matching the ON CONFLICT"
+        await conn.executemany(fallback_sql, prepared, timeout=timeout)
+    after = await conn.fetchval(count_sql, doc_ids, timeout=timeout)
+    return after - before
+
+async def _insert_chunks_copy(
+    conn: asyncpg.Connection,
+    table: str,
+    records: List[Tuple[int, int, str, List[float], str, Optional[int]]],
+    timeout: Optional[float] = None,
+) -> int:
+    """COPY rows (any number of documents) into a temp staging table, then one set-based INSERT ... SELECT."""
+    stage = f"_stage_{table}"
+    # COPY uses the binary protocol; without the binary vector codec we stage
+    # the literal as text and let the INSERT ... SELECT cast it.
+    stage_vec_type = "vector" if VECTOR_CODEC == "binary" else "text"
+    await conn.execute(f"""
+        CREATE TEMP TABLE {stage} (
+            document_id bigint NOT NULL,
+            chunk_index int NOT NULL,
+            content text,
+            embedding {stage_vec_type},
+            chunk_sha256 text,
+            page int
+        ) ON COMMIT DROP;
+    """, timeout=timeout)
+    await conn.copy_records_to_table(
+        stage,
+        records=[
+            (doc_id, idx, txt, _vector_param(emb), chash, page)
+            for (doc_id, idx, txt, emb, chash, page) in records
+        ],
+        columns=["document_id", "chunk_index", "content", "embedding", "chunk_sha256", "page"],
+        timeout=timeout,
+    )
+
+    upsert_sql = f"""
+        INSERT INTO {table} (document_id, chunk_index, content, embedding, chunk_sha256, page)
+        SELECT s.document_id, s.chunk_index, s.content, s.embedding::vector, s.chunk_sha256, s.page
+        FROM {stage} s
+        ON CONFLICT (document_id, chunk_sha256) WHERE chunk_sha256 IS NOT NULL DO NOTHING;
+    """
+
+    fallback_sql = f"""
+        INSERT INTO {table} (document_id, chunk_index, content, embedding, chunk_sha256, page)
+        SELECT DISTINCT ON (s.document_id, s.chunk_sha256)
+               s.document_id, s.chunk_index, s.content, s.embedding::vector, s.chunk_sha256, s.page
+        FROM {stage} s
+        WHERE NOT EXISTS (
+            SELECT 1 FROM {table} t
+            WHERE t.document_id = s.document_id AND t.chunk_sha256 = s.chunk_sha256
+        )
+        ORDER BY s.document_id, s.chunk_sha256, s.chunk_index;
+    """
+
+    try:
+        async with conn.transaction():
+            status = await conn.execute(upsert_sql, timeout=timeout)
+    except asyncpg.PostgresError:
+        status = await conn.execute(fallback_sql, timeout=timeout)
+    return _rowcount(status)
+
+def _insert_mode(mode: Optional[str]) -> str:
+    mode = (mode or CHUNK_INSERT_MODE).lower()
+    if mode not in ("copy", "executemany"):
+        raise ValueError("insert mode must be 'copy' or 'executemany'")
+    return mode
+
+async def _insert_records(
+    conn: asyncpg.Connection, table: str, records: list, mode: str, timeout: Optional[float] = None
+) -> int:
+    if not records:
+        return 0
+    # page is optional on input rows (None: not a paged format)
+    records = [r if len(r) == 6 else tuple(r) + (None,) for r in records]
+    if mode == "copy":
+        return await _insert_chunks_copy(conn, table, records, timeout)
+    return await _insert_chunks_executemany(conn, table, records, timeout)
 
 async def insert_chunks(
     pool: asyncpg.Pool,
@@ -165,101 +727,446 @@ async def insert_chunks(
     size_bytes: int,
     mtime_dt,
     sha256: str,
-    rows: List[Tuple[int, str, List[float], str]],
+    rows: List[Tuple],
+    mode: Optional[str] = None,
 ) -> int:
     """
-    Insert chunk rows idempotently with document metadata.
-    rows: (chunk_index, content, embedding(list[float]), chunk_sha256)
+    Upsert the document's metadata row, then insert its chunk rows idempotently.
+    rows: (chunk_index, content, embedding(list[float]), chunk_sha256[, page])
+    mode: "copy" (COPY into a staging table + one INSERT ... SELECT) or
+          "executemany" (per-row INSERT); defaults to CHUNK_INSERT_MODE.
 
-    If the unique index on (path, chunk_sha256) isn't present yet,
+    If the unique index on (document_id, chunk_sha256) isn't present yet,
     we fall back to a NOT EXISTS guard to avoid crashing.
+    Returns the number of rows actually inserted.
     """
     table = _safe_table_name(CHUNKS_TABLE)
+    mode = _insert_mode(mode)
+    if not rows:
+        return 0
 
-    upsert_sql = f"""
-        INSERT INTO {table} (path, filename, size_bytes, mtime, sha256, chunk_index, content, embedding, chunk_sha256)
-        VALUES ($1, $2, $3, $4, $5, $6, $7, $8::vector, $9)
-        ON CONFLICT (path, chunk_sha256) DO NOTHING;
+    doc = (path, filename, size_bytes, mtime_dt, sha256)
+    async with _acquire(pool, "insert_chunks") as conn:
+        async with conn.transaction():
+            document_id = await _upsert_document(conn, doc)
+            records = [(document_id,) + tuple(r) for r in rows]
+            return await _insert_records(conn, table, records, mode)
+
+async def get_chunk_hashes(pool: asyncpg.Pool, path: str) -> Dict[str, Tuple[int, int, Optional[int]]]:
+    """
+    Stored chunks of a document as {chunk_sha256: (chunk_id, chunk_index, page)}.
+    Empty if the chunks can't be diffed by hash (unhashed or duplicate-hash rows),
+    in which case the caller should replace the whole document.
     """
+    table = _safe_table_name(CHUNKS_TABLE)
+    docs = _safe_table_name(DOCUMENTS_TABLE)
+    q = f"""
+        SELECT c.id, c.chunk_index, c.chunk_sha256, c.page
+        FROM {table} c JOIN {docs} d ON d.id = c.document_id
+        WHERE d.path = $1
+    """
+    async with _acquire(pool, "get_chunk_hashes") as conn:
+        rows = await conn.fetch(q, path)
+    stored = {r["chunk_sha256"]: (r["id"], r["chunk_index"], r["page"]) for r in rows}
+    if None in stored or len(stored) != len(rows):
+        return {}
+    return stored
 
-    fallback_sql = f"""
-        INSERT INTO {table} (path, filename, size_bytes, mtime, sha256, chunk_index, content, embedding, chunk_sha256)
-        SELECT $1, $2, $3, $4, $5, $6, $7, $8::vector, $9
-        WHERE NOT EXISTS (
-            SELECT 1 FROM {table}
-            WHERE path = $1 AND chunk_sha256 = $9
-        );
+class DocumentWrite(NamedTuple):
+    """One document for write_documents(); doc = (path, filename, size_bytes, mtime, sha256[, extractor])."""
+    doc: Tuple
+    # chunks to insert, (chunk_index, content, embedding, chunk_sha256, page); None = metadata only
+    rows: Optional[List[Tuple[int, str, List[float], str, Optional[int]]]] = None
+    replace: bool = False                     # delete ALL existing chunks first
+    delete_ids: Sequence[int] = ()            # or delete just these chunk ids ...
+    reindex: Sequence[Tuple[int, int, Optional[int]]] = ()  # ... and move kept chunks: (chunk_id, new index, page)
+
+async def _reindex_chunks(
+    conn: asyncpg.Connection,
+    table: str,
+    moves: Sequence[Tuple[int, int, Optional[int]]],
+    timeout: Optional[float] = None,
+) -> None:
+    """
+    Set chunk_index (and page) for kept chunks in place. The unique (document_id,
+    chunk_index) index is checked row by row, so go through negative indexes first:
+    no target can collide with a row that hasn't moved yet.
     """
+    ids = [cid for cid, _, _ in moves]
+    await conn.execute(
+        f"""UPDATE {table} c SET chunk_index = -1 - v.idx, page = v.page
+            FROM unnest($1::int[], $2::int[], $3::int[]) AS v(id, idx, page) WHERE c.id = v.id""",
+        ids, [idx for _, idx, _ in moves], [page for _, _, page in moves], timeout=timeout,
+    )
+    await conn.execute(
+        f"UPDATE {table} SET chunk_index = -1 - chunk_index WHERE id = ANY($1::int[])", ids, timeout=timeout
+    )
 
-    prepared = [
-        (path, filename, size_bytes, mtime_dt, sha256, idx, txt, _to_pgvector(emb), chash)
-        for (idx, txt, emb, chash) in rows
-    ]
+async def write_documents(
+    pool: asyncpg.Pool,
+    docs: Sequence[DocumentWrite],
+    mode: Optional[str] = None,
+) -> int:
+    """
+    Write several documents in ONE transaction (bulk writer for the ingest pipeline).
+    Per document: delete all (replace) or some (delete_ids) old chunks, move kept
+    chunks (reindex), upsert the metadata row, then insert `rows`.
+    All chunk rows go through a single COPY / executemany.
+    A batch (COPY + INSERT ... SELECT with the tsvector trigger and ANN index
+    upkeep) can outlast the query timeouts, so the transaction runs under
+    DB_WRITE_TIMEOUT, client and server side.
+    Returns the number of chunk rows inserted.
+    """
+    table = _safe_table_name(CHUNKS_TABLE)
+    mode = _insert_mode(mode)
+    if not docs:
+        return 0
 
-    async with pool.acquire() as conn:
+    timeout = DB_WRITE_TIMEOUT
+    async with _acquire(pool, "write_documents") as conn:
         async with conn.transaction():
-            try:
-                await conn.executemany(upsert_sql, prepared)
-            except Exception:
-                # Likely "there is no unique or exclusion constraint matching the ON CONFLICT"
-                await conn.executemany(fallback_sql, prepared)
+            await conn.execute(f"SET LOCAL statement_timeout = {int(timeout * 1000)}")
+            records: list = []
+            for w in docs:
+                if w.replace:
+                    await conn.execute(STATEMENTS["delete_chunks_for_document"], w.doc[0], timeout=timeout)
+                elif w.delete_ids:
+                    await conn.execute(
+                        f"DELETE FROM {table} WHERE id = ANY($1::int[])", list(w.delete_ids), timeout=timeout
+                    )
+                if w.reindex:
+                    await _reindex_chunks(conn, table, w.reindex, timeout)
+                document_id = await _upsert_document(conn, w.doc, timeout)
+                records.extend((document_id,) + tuple(r) for r in w.rows or ())
+            return await _insert_records(conn, table, records, mode, timeout)
+
 
-    # executemany returns None; return 0 to keep the signature stable
-    return 0
+# -----------------------------------------------------------------------------
+# CONTENT-ADDRESSED EMBEDDING CACHE
+# -----------------------------------------------------------------------------
+# Chunk embeddings keyed by (model_name, chunk_sha256), independent of documents:
+# boilerplate shared by many files (headers, disclaimers, licenses) is encoded once.
+# Deleting a document leaves its cache rows; they are content, not state.
+def _vector_value(value) -> List[float]:
+    """A selected vector column as list[float]: ndarray (binary codec) or '[x,y,...]' text."""
+    if isinstance(value, str):
+        return [float(x) for x in value.strip("[]").split(",") if x]
+    return value.tolist()
 
+async def get_stored_embeddings(pool: asyncpg.Pool, chunk_hashes: Sequence[str]) -> Dict[str, List[float]]:
+    """
+    {chunk_sha256: embedding} for hashes some stored chunk already has, in one query
+    (idx_<table>_chunk_sha256). Chunk rows are the only copy of each embedding, so
+    reuse costs no extra storage; all rows come from one model (search compares them).
+    Read as vector, so halfvec columns come back as floats too.
+    """
+    if not chunk_hashes:
+        return {}
+    table = _safe_table_name(CHUNKS_TABLE)
+    q = f"""
+        SELECT DISTINCT ON (chunk_sha256) chunk_sha256, embedding::vector AS embedding
+        FROM {table}
+        WHERE chunk_sha256 = ANY($1::text[]) AND embedding IS NOT NULL
+    """
+    async with _acquire(pool, "get_stored_embeddings") as conn:
+        rows = await conn.fetch(q, list(chunk_hashes))
+    return {r["chunk_sha256"]: _vector_value(r["embedding"]) for r in rows}
 
 # -----------------------------------------------------------------------------
 # VECTOR SEARCH (FIXES `$1` ERROR)
 # -----------------------------------------------------------------------------
+# Set by init_db from the installed pgvector version
+_ITERATIVE_SCAN = False
+# Access method of the live ANN index, read from the catalog by init_db / reindex.
+# It can differ from ANN_INDEX: an existing index is kept at startup and
+# /admin/reindex/ may build the other kind. Per process: other workers pick up
+# a strategy switch on restart.
+_ANN_METHOD = ANN_INDEX
+
+async def _refresh_ann_method(conn: asyncpg.Connection, table: str) -> str:
+    global _ANN_METHOD
+    method = await conn.fetchval(
+        """
+        SELECT am.amname
+        FROM pg_class c
+        JOIN pg_index i ON i.indexrelid = c.oid
+        JOIN pg_am am ON am.oid = c.relam
+        WHERE c.oid = to_regclass($1) AND i.indisvalid
+        """,
+        f"idx_{table}_embedding",
+    )
+    if method in ("ivfflat", "hnsw"):
+        _ANN_METHOD = method
+    return _ANN_METHOD
+
+def _version_tuple(version: Optional[str]) -> Tuple[int, ...]:
+    try:
+        return tuple(int(p) for p in (version or "0").split(".")[:3])
+    except ValueError:
+        return (0,)
+
+def _prefix_upper_bound(prefix: str) -> str:
+    """Smallest string greater than every string starting with `prefix` (byte order)."""
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+def _filter_sql(
+    filename: Optional[str],
+    path_prefix: Optional[str],
+    processed_after,
+    processed_before,
+    first_param: int,
+) -> Tuple[str, List[str], list]:
+    """
+    WHERE clause + args for the metadata filters that are set, as a
+    `document_id IN (...)` semi-join against the documents table.
+    Returns (sql, keys, args); `keys` names the filter combination so each
+    combination gets its own prepared statement and a plan that uses its index.
+    The path prefix is a ~>=~ / ~<~ range so the text_pattern_ops index applies
+    even under a generic plan (LIKE $n can't be matched to it).
+    """
+    clauses: List[str] = []
+    keys: List[str] = []
+    args: list = []
+
+    def param(value) -> str:
+        args.append(value)
+        return f"${first_param + len(args) - 1}"
+
+    if filename is not None:
+        keys.append("filename")
+        clauses.append(f"filename = {param(filename)}")
+    if path_prefix:
+        keys.append("path_prefix")
+        clauses.append(f"path ~>=~ {param(path_prefix)} AND path ~<~ {param(_prefix_upper_bound(path_prefix))}")
+    if processed_after is not None:
+        keys.append("processed_after")
+        clauses.append(f"processed_at >= {param(processed_after)}")
+    if processed_before is not None:
+        keys.append("processed_before")
+        clauses.append(f"processed_at < {param(processed_before)}")
+    if not clauses:
+        return "", keys, args
+    docs = _safe_table_name(DOCUMENTS_TABLE)
+    return f"document_id IN (SELECT id FROM {docs} WHERE {' AND '.join(clauses)})", keys, args
+
+def _filtered_statement(kind: str, table: str, where: str, keys: List[str], n_params: int) -> str:
+    """Register (once) and return the statement name for a filtered search."""
+    name = f"fetch_similar_filtered:{kind}:{','.join(keys)}"
+    if name in STATEMENTS:
+        return name
+    dist = f"embedding {VECTOR_OPERATOR} {_query_vec('$1::vector')}"
+    if kind == "iterative":
+        # relaxed_order may return rows slightly out of order; re-sort the small result
+        sql = f"""
+            WITH c AS MATERIALIZED (
+                {_knn_sql(table, "$1::vector", "id, document_id, content", "$2", where)}
+            )
+            SELECT id, document_id, content, distance FROM c ORDER BY distance
+        """
+    elif kind == "overfetch":
+        # Take FILTER_OVERFETCH x limit ANN candidates, then filter those
+        sql = f"""
+            WITH c AS MATERIALIZED (
+                {_knn_sql(table, "$1::vector", "id, document_id, content", f"${n_params + 1}")}
+            )
+            SELECT id, document_id, content, distance FROM c
+            WHERE {where}
+            ORDER BY distance
+            LIMIT $2
+        """
+    else:
+        # Exact: "+ 0" hides the ORDER BY from the ANN index, so the planner
+        # uses the B-tree pre-filters and sorts the matching rows
+        sql = f"""
+            SELECT id, document_id, content, ({dist}) AS distance
+            FROM {table}
+            WHERE {where}
+            ORDER BY ({dist}) + 0
+            LIMIT $2
+        """
+    STATEMENTS[name] = sql
+    return name
+
+def _search_setting_sql(probes: int, ef_search: Optional[int]) -> str:
+    """SET LOCAL for the live index type (probes for ivfflat, ef_search for hnsw)."""
+    if _ANN_METHOD == "hnsw":
+        return f"SET LOCAL hnsw.ef_search = {int(ef_search or HNSW_EF_SEARCH)}"
+    return f"SET LOCAL ivfflat.probes = {int(probes)}"
+
 async def fetch_similar(
-    pool: asyncpg.Pool, embedding: List[float], limit: int = 5, probes: int = 10
-) -> List[Tuple[str, float]]:
+    pool: asyncpg.Pool,
+    embedding: List[float],
+    limit: int = 5,
+    probes: int = 10,
+    ef_search: Optional[int] = None,
+    *,
+    filename: Optional[str] = None,
+    path_prefix: Optional[str] = None,
+    processed_after=None,
+    processed_before=None,
+    with_ids: bool = False,
+) -> List[Tuple]:
     """
-    Return (content, distance) for top-K nearest chunks.
+    Return (content, distance) for top-K nearest chunks,
+    or (chunk_id, document_id, content, distance) if `with_ids`.
+    `probes` applies to ivfflat, `ef_search` to hnsw (defaults to HNSW_EF_SEARCH).
+
+    Optional filters (filename, path prefix, processed_at range) are applied in SQL:
+    - pgvector >= 0.8: iterative index scan until `limit` rows pass the filter
+    - otherwise: over-fetch ANN candidates and filter them; if that yields fewer
+      than `limit` rows, fall back to an exact search over the filtered rows
 
     IMPORTANT:
     - `SET LOCAL` cannot use bind parameters and cannot be combined with SELECT
       as a single prepared statement. We run it separately with a literal int.
     """
-    table = _safe_table_name(CHUNKS_TABLE)
-    vec = _to_pgvector(embedding)
+    vec = _vector_param(embedding)
+    where, keys, fargs = _filter_sql(filename, path_prefix, processed_after, processed_before, 3)
 
-    async with pool.acquire() as conn:
+    async with _acquire(pool, "fetch_similar") as conn:
         async with conn.transaction():
             # Run as a separate statement; no bind params here.
-            await conn.execute(f"SET LOCAL ivfflat.probes = {int(probes)}")
+            await conn.execute(_search_setting_sql(probes, ef_search))
 
-            rows = await conn.fetch(
-                f"""
-                SELECT content, (embedding <-> $1::vector) AS distance
-                FROM {table}
-                ORDER BY embedding <-> $1::vector
-                LIMIT $2
-                """,
-                vec, limit
-            )
+            if not keys:
+                rows = await _fetch(conn, "fetch_similar", vec, limit)
+            else:
+                rows = await _fetch_filtered(conn, vec, limit, where, keys, fargs)
 
     # Smaller distance = closer (cosine distance in [0,2]; L2 unbounded)
+    if with_ids:
+        return [(r["id"], r["document_id"], r["content"], float(r["distance"])) for r in rows]
     return [(r["content"], float(r["distance"])) for r in rows]
 
+async def _fetch_filtered(conn, vec, limit: int, where: str, keys: List[str], fargs: list) -> list:
+    table = _safe_table_name(CHUNKS_TABLE)
+    n_params = 2 + len(fargs)
+    use_iterative = FILTER_STRATEGY == "iterative" or (FILTER_STRATEGY == "auto" and _ITERATIVE_SCAN)
+
+    if use_iterative:
+        await conn.execute(f"SET LOCAL {_ANN_METHOD}.iterative_scan = relaxed_order")
+        name = _filtered_statement("iterative", table, where, keys, n_params)
+        return await _fetch(conn, name, vec, limit, *fargs)
+
+    name = _filtered_statement("overfetch", table, where, keys, n_params)
+    rows = await _fetch(conn, name, vec, limit, *fargs, limit * max(1, FILTER_OVERFETCH))
+    if len(rows) >= limit:
+        return rows
+    # Selective filter: too few candidates survived, so rank the filtered rows exactly
+    name = _filtered_statement("exact", table, where, keys, n_params)
+    return await _fetch(conn, name, vec, limit, *fargs)
+
+async def fetch_similar_many(
+    pool: asyncpg.Pool,
+    embeddings: Sequence[Sequence[float]],
+    k: int = 5,
+    probes: int = 10,
+    ef_search: Optional[int] = None,
+) -> List[List[Tuple[str, float]]]:
+    """
+    Top-K (content, distance) for each of N query embeddings in one round trip.
+    The vectors are sent as one array, unnest'ed server-side, and each one drives
+    a LATERAL index scan. Results come back in input order.
+    """
+    if not embeddings:
+        return []
+    vecs = [_vector_param(e) for e in embeddings]
+
+    async with _acquire(pool, "fetch_similar_many") as conn:
+        async with conn.transaction():
+            await conn.execute(_search_setting_sql(probes, ef_search))
+
+            rows = await _fetch(conn, "fetch_similar_many", vecs, k)
+
+    out: List[List[Tuple[str, float]]] = [[] for _ in embeddings]
+    for r in rows:
+        out[r["ord"] - 1].append((r["content"], float(r["distance"])))
+    return out
+
+
+# -----------------------------------------------------------------------------
+# HYBRID SEARCH (FULL-TEXT + VECTOR, RECIPROCAL RANK FUSION)
+# -----------------------------------------------------------------------------
+def reciprocal_rank_fusion(ranked_lists: List[List[int]], k: int = RRF_K) -> Dict[int, float]:
+    """score(id) = sum over lists of 1 / (k + rank), rank starting at 1."""
+    scores: Dict[int, float] = {}
+    for ranked in ranked_lists:
+        for rank, doc_id in enumerate(ranked, start=1):
+            scores[doc_id] = scores.get(doc_id, 0.0) + 1.0 / (k + rank)
+    return scores
+
+async def fetch_hybrid(
+    pool: asyncpg.Pool,
+    query: str,
+    embedding: List[float],
+    limit: int = 5,
+    candidates: int = 50,
+    probes: int = 10,
+    ef_search: Optional[int] = None,
+    with_ids: bool = False,
+) -> Tuple[List[Tuple], Dict[str, float]]:
+    """
+    Lexical (tsvector) and ANN retrieval run concurrently on two connections,
+    each returning up to `candidates` rows, then fused with RRF.
+    Returns ([(content, rrf_score)], timings_ms) with per-stage timings;
+    rows are (chunk_id, document_id, content, rrf_score) if `with_ids`.
+    """
+    vec = _vector_param(embedding)
+
+    async def lexical():
+        t0 = time.perf_counter()
+        async with _acquire(pool, "fetch_hybrid_lexical") as conn:
+            rows = await _fetch(conn, "hybrid_lexical", query, candidates)
+        return rows, (time.perf_counter() - t0) * 1000
+
+    async def vector():
+        t0 = time.perf_counter()
+        async with _acquire(pool, "fetch_hybrid_vector") as conn:
+            async with conn.transaction():
+                # hnsw returns at most ef_search rows: make room for all `candidates`
+                ef = max(int(ef_search or HNSW_EF_SEARCH), candidates)
+                await conn.execute(_search_setting_sql(probes, ef))
+                rows = await _fetch(conn, "hybrid_vector", vec, candidates)
+        return rows, (time.perf_counter() - t0) * 1000
+
+    t0 = time.perf_counter()
+    (lex_rows, lex_ms), (vec_rows, vec_ms) = await asyncio.gather(lexical(), vector())
+
+    t1 = time.perf_counter()
+    by_id = {r["id"]: r for r in vec_rows}
+    by_id.update({r["id"]: r for r in lex_rows})
+    scores = reciprocal_rank_fusion([[r["id"] for r in lex_rows], [r["id"] for r in vec_rows]])
+    top = sorted(scores.items(), key=lambda kv: kv[1], reverse=True)[:limit]
+    if with_ids:
+        results = [(cid, by_id[cid]["document_id"], by_id[cid]["content"], score) for cid, score in top]
+    else:
+        results = [(by_id[cid]["content"], score) for cid, score in top]
+    t2 = time.perf_counter()
+
+    timings = {
+        "lexical_ms": round(lex_ms, 3),
+        "vector_ms": round(vec_ms, 3),
+        "fusion_ms": round((t2 - t1) * 1000, 3),
+        "total_ms": round((t2 - t0) * 1000, 3),
+        "lexical_hits": len(lex_rows),
+        "vector_hits": len(vec_rows),
+    }
+    return results, timings
+
 
 # -----------------------------------------------------------------------------
 # HEALTH
 # -----------------------------------------------------------------------------
 async def ping(pool: asyncpg.Pool) -> bool:
-    async with pool.acquire() as conn:
+    async with _acquire(pool, "ping") as conn:
         return (await conn.fetchval("SELECT 1;")) == 1
 
 
 
 # without llm
 async def fetch_similar_simple(pool, embedding, limit=5):
-    table = _safe_table_name(CHUNKS_TABLE)
-    # Convert list to Postgres vector string
-    embedding_str = "[" + ",".join(str(x) for x in embedding) + "]"
-    async with pool.acquire() as conn:
-        rows = await conn.fetch(
-            f"SELECT content FROM {table} ORDER BY embedding <-> $1::vector LIMIT $2",
-            embedding_str, limit
-        )
+    # Text literal or raw floats, depending on VECTOR_CODEC
+    vec = _vector_param(embedding)
+    async with _acquire(pool, "fetch_similar_simple") as conn:
+        rows = await _fetch(conn, "fetch_similar_simple", vec, limit)
         return [r["content"] for r in rows]
\ No newline at end of file
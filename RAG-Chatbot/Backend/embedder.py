@@ -0,0 +1,247 @@
+# embedder.py
+# =============================================================================
+# ASYNC EMBEDDING SERVICE (MODEL.ENCODE ON A BOUNDED THREAD POOL)
+# =============================================================================
+# SentenceTransformer.encode is synchronous and CPU-heavy; called straight from an
+# `async def` handler it stalls every other request on the event loop. The service
+# runs it on a small ThreadPoolExecutor (torch releases the GIL during inference).
+# A semaphore sized to the pool keeps excess callers waiting in asyncio, not in the
+# executor's unbounded queue, so the wait is measurable and cancellable.
+#
+# Query embeddings are micro-batched: concurrent embed() calls are collected for
+# up to `batch_window` seconds (or until `max_batch` are waiting) and encoded with
+# ONE model.encode call, which uses the CPU's SIMD width far better than
+# one-string calls. Each caller gets its own future resolved from the batch.
+#
+# An optional EmbeddingCache in front of embed() skips encode entirely for
+# repeated questions (LRU + TTL, keyed by model name + normalized text), and can
+# be snapshotted to disk to start warm after a restart.
+import asyncio
+import json
+import os
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Optional, Sequence, Set, Tuple
+
+import numpy as np
+
+import metrics
+from parsing import normalize_text
+
+EMBED_SECONDS = metrics.Histogram(
+    "embed_encode_seconds", "Time spent in model.encode per call", ["kind"]
+)
+EMBED_WAIT_SECONDS = metrics.Histogram(
+    "embed_queue_wait_seconds", "Time waiting for a free embedding thread", ["kind"]
+)
+EMBED_BATCH_SIZE = metrics.Histogram(
+    "embed_query_batch_size", "Query strings coalesced into one encode call",
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256),
+)
+EMBED_REQUEST_SECONDS = metrics.Histogram(
+    "embed_query_seconds", "embed() latency per caller (batch window + wait + encode)"
+)
+
+EMBED_CACHE_REQUESTS = metrics.Counter(
+    "embed_cache_requests_total", "Query embedding cache lookups", ["result"]
+)
+EMBED_CACHE_ENTRIES = metrics.Gauge("embed_cache_entries", "Query embeddings currently cached")
+
+
+class EmbeddingCache:
+    """
+    Bounded LRU of query embeddings with a TTL, keyed by (model name, normalized text).
+    Vectors are kept as float32 arrays (4 bytes/dim instead of a list of Python floats).
+    """
+
+    def __init__(self, model_name: str, max_entries: int = 10000, ttl: float = 86400.0):
+        self.model_name = model_name
+        self.max_entries = max(1, max_entries)
+        self.ttl = ttl  # seconds; <= 0 never expires
+        # key -> (vector, created_at wall-clock seconds, so TTLs survive a snapshot)
+        self._entries: "OrderedDict[str, Tuple[np.ndarray, float]]" = OrderedDict()
+
+    def key(self, text: str) -> str:
+        return f"{self.model_name}\x00{normalize_text(text)}"
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, text: str) -> Optional[List[float]]:
+        k = self.key(text)
+        item = self._entries.get(k)
+        if item is None:
+            EMBED_CACHE_REQUESTS.inc(result="miss")
+            return None
+        vector, created = item
+        if self.ttl > 0 and time.time() - created > self.ttl:
+            del self._entries[k]
+            EMBED_CACHE_ENTRIES.set(len(self._entries))
+            EMBED_CACHE_REQUESTS.inc(result="expired")
+            return None
+        self._entries.move_to_end(k)
+        EMBED_CACHE_REQUESTS.inc(result="hit")
+        return vector.tolist()
+
+    def _put_key(self, k: str, vector, created: float) -> None:
+        self._entries[k] = (np.asarray(vector, dtype=np.float32), created)
+        self._entries.move_to_end(k)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def put(self, text: str, vector: Sequence[float]) -> None:
+        self._put_key(self.key(text), vector, time.time())
+        EMBED_CACHE_ENTRIES.set(len(self._entries))
+
+    # ---- snapshot: <path>.npy (float32 matrix, memory-mapped on load) + <path>.json (keys)
+    def save(self, path: str) -> int:
+        """Write all unexpired entries (oldest first, so LRU order survives). Returns the count."""
+        now = time.time()
+        items = [
+            (k, v, t) for k, (v, t) in self._entries.items()
+            if self.ttl <= 0 or now - t <= self.ttl
+        ]
+        if not items:
+            return 0
+        matrix = np.stack([v for _, v, _ in items])
+        meta = {
+            "model_name": self.model_name,
+            "dim": int(matrix.shape[1]),
+            "keys": [k for k, _, _ in items],
+            "created": [t for _, _, t in items],
+        }
+        # Write-then-rename so a crash mid-save never leaves a torn snapshot
+        with open(path + ".npy.tmp", "wb") as f:
+            np.save(f, matrix)
+        with open(path + ".json.tmp", "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+        os.replace(path + ".npy.tmp", path + ".npy")
+        os.replace(path + ".json.tmp", path + ".json")
+        return len(items)
+
+    def load(self, path: str) -> int:
+        """Warm the cache from a snapshot written by save(); other models' snapshots are ignored."""
+        if not (os.path.exists(path + ".npy") and os.path.exists(path + ".json")):
+            return 0
+        with open(path + ".json", "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta.get("model_name") != self.model_name:
+            return 0
+        matrix = np.load(path + ".npy", mmap_mode="r")
+        if matrix.shape[0] != len(meta["keys"]):
+            return 0
+        now = time.time()
+        loaded = 0
+        for i, (k, created) in enumerate(zip(meta["keys"], meta["created"])):
+            if self.ttl > 0 and now - created > self.ttl:
+                continue
+            self._put_key(k, np.array(matrix[i]), created)
+            loaded += 1
+        EMBED_CACHE_ENTRIES.set(len(self._entries))
+        return loaded
+
+
+class EmbeddingService:
+    """Awaitable wrapper around a synchronous `encode(list[str]) -> ndarray`."""
+
+    def __init__(
+        self,
+        encode: Callable,
+        max_workers: int = 2,
+        batch_size: int = 128,
+        batch_window: float = 0.002,
+        max_batch: int = 32,
+        cache: Optional[EmbeddingCache] = None,
+    ):
+        self._encode = encode
+        self._batch_size = batch_size
+        self.cache = cache
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="embed")
+        self._slots = asyncio.Semaphore(max_workers)
+        # Micro-batching state (batch_window <= 0 disables coalescing)
+        self._window = batch_window
+        self._max_batch = max(1, max_batch)
+        self._pending: List[Tuple[str, asyncio.Future]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._inflight: Set[asyncio.Task] = set()
+
+    def _encode_batched(self, texts: Sequence[str]) -> List[List[float]]:
+        out: List[List[float]] = []
+        for i in range(0, len(texts), self._batch_size):
+            out.extend(self._encode(list(texts[i : i + self._batch_size])).tolist())
+        return out
+
+    async def _run(self, kind: str, texts: Sequence[str]) -> List[List[float]]:
+        t0 = time.perf_counter()
+        async with self._slots:
+            t1 = time.perf_counter()
+            EMBED_WAIT_SECONDS.observe(t1 - t0, kind=kind)
+            loop = asyncio.get_running_loop()
+            vectors = await loop.run_in_executor(self._executor, self._encode_batched, texts)
+            EMBED_SECONDS.observe(time.perf_counter() - t1, kind=kind)
+        return vectors
+
+    async def embed(self, text: str) -> List[float]:
+        """One query string -> embedding (cache, else coalesced with concurrent callers)."""
+        t0 = time.perf_counter()
+        try:
+            if self.cache is not None:
+                cached = self.cache.get(text)
+                if cached is not None:
+                    return cached
+            if self._window <= 0:
+                EMBED_BATCH_SIZE.observe(1)
+                vector = (await self._run("query", [text]))[0]
+            else:
+                loop = asyncio.get_running_loop()
+                fut = loop.create_future()
+                self._pending.append((text, fut))
+                if len(self._pending) >= self._max_batch:
+                    self._flush()
+                elif self._timer is None:
+                    self._timer = loop.call_later(self._window, self._flush)
+                vector = await fut
+            if self.cache is not None:
+                self.cache.put(text, vector)
+            return vector
+        finally:
+            EMBED_REQUEST_SECONDS.observe(time.perf_counter() - t0)
+
+    def _flush(self) -> None:
+        """Hand the pending callers to one encode task (timer callback or full batch)."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.get_running_loop().create_task(self._encode_pending(batch))
+            self._inflight.add(task)
+            task.add_done_callback(self._inflight.discard)
+
+    async def _encode_pending(self, batch: List[Tuple[str, asyncio.Future]]) -> None:
+        # Callers that gave up (cancelled) are dropped; identical strings are encoded once
+        batch = [(text, fut) for text, fut in batch if not fut.done()]
+        unique = list(dict.fromkeys(text for text, _ in batch))
+        if not unique:
+            return
+        EMBED_BATCH_SIZE.observe(len(batch))
+        try:
+            vectors = dict(zip(unique, await self._run("query", unique)))
+        except Exception as e:
+            for _, fut in batch:
+                if not fut.done():
+                    fut.set_exception(e)
+            return
+        for text, fut in batch:
+            if not fut.done():
+                fut.set_result(vectors[text])
+
+    async def embed_many(self, texts: Sequence[str], kind: str = "batch") -> List[List[float]]:
+        """Many strings -> embeddings, encoded in batches of `batch_size` on one thread."""
+        if not texts:
+            return []
+        return await self._run(kind, texts)
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,157 @@
+# extractors.py
+# =============================================================================
+# PDF TEXT EXTRACTION BACKENDS (FAST PATH FIRST, pdfplumber FALLBACK PER PAGE)
+# =============================================================================
+# pdfplumber is pure Python (pdfminer) and by far the slowest ingest stage.
+# pypdfium2 (PDFium) and PyMuPDF (MuPDF) are C libraries and many times faster;
+# they are optional: whichever is installed is tried first, in PDF_EXTRACTORS
+# order. A page the fast backend fails on is re-read with pdfplumber, and a file
+# it can't open at all goes to the next backend.
+# Like parsing.py this runs in ingest worker processes: no model imports.
+import importlib.util
+import os
+from typing import Callable, Dict, Iterator, List, Optional, Set, Tuple
+
+import pdfplumber
+from dotenv import load_dotenv
+
+#LOAD ENV
+load_dotenv()
+
+PDF_EXTRACTORS = [
+    b.strip() for b in os.getenv("PDF_EXTRACTORS", "pypdfium2,pymupdf,pdfplumber").split(",") if b.strip()
+]
+FALLBACK_EXTRACTOR = "pdfplumber"
+
+
+class _PdfiumDocument:
+    name = "pypdfium2"
+
+    def __init__(self, path: str):
+        import pypdfium2 as pdfium
+
+        self._pdf = pdfium.PdfDocument(path)
+
+    def __len__(self) -> int:
+        return len(self._pdf)
+
+    def text(self, index: int) -> str:
+        page = self._pdf[index]
+        try:
+            textpage = page.get_textpage()
+            try:
+                return textpage.get_text_range()
+            finally:
+                textpage.close()
+        finally:
+            page.close()
+
+    def close(self) -> None:
+        self._pdf.close()
+
+
+class _MuPdfDocument:
+    name = "pymupdf"
+
+    def __init__(self, path: str):
+        try:
+            import pymupdf
+        except ImportError:  # PyMuPDF < 1.24 only ships the `fitz` name
+            import fitz as pymupdf
+
+        self._doc = pymupdf.open(path)
+
+    def __len__(self) -> int:
+        return self._doc.page_count
+
+    def text(self, index: int) -> str:
+        return self._doc.load_page(index).get_text("text")
+
+    def close(self) -> None:
+        self._doc.close()
+
+
+class _PlumberDocument:
+    name = "pdfplumber"
+
+    def __init__(self, path: str):
+        self._pdf = pdfplumber.open(path)
+
+    def __len__(self) -> int:
+        return len(self._pdf.pages)
+
+    def text(self, index: int) -> str:
+        page = self._pdf.pages[index]
+        try:
+            return page.extract_text() or ""
+        finally:
+            page.flush_cache()  # drop the parsed layout objects of this page
+
+    def close(self) -> None:
+        self._pdf.close()
+
+
+# name -> (modules that provide it, document class)
+PDF_BACKENDS: Dict[str, Tuple[Tuple[str, ...], Callable]] = {
+    "pypdfium2": (("pypdfium2",), _PdfiumDocument),
+    "pymupdf": (("pymupdf", "fitz"), _MuPdfDocument),
+    "pdfplumber": (("pdfplumber",), _PlumberDocument),
+}
+
+_AVAILABLE: Dict[str, bool] = {}
+
+
+def available(name: str) -> bool:
+    if name not in _AVAILABLE:
+        _AVAILABLE[name] = name in PDF_BACKENDS and any(
+            importlib.util.find_spec(module) is not None for module in PDF_BACKENDS[name][0]
+        )
+    return _AVAILABLE[name]
+
+
+def available_extractors(order: Optional[List[str]] = None) -> List[str]:
+    return [b for b in (order or PDF_EXTRACTORS) if available(b)]
+
+
+def iter_pdf_pages(
+    path: str,
+    order: Optional[List[str]] = None,
+    used: Optional[Set[str]] = None,
+) -> Iterator[Tuple[int, str]]:
+    """
+    (page_number, text) one page at a time, 1-based, from the first backend in
+    `order` that opens the file; pages it fails on come from pdfplumber.
+    `used` collects the names of the backends that produced pages.
+    """
+    candidates = available_extractors(order)
+    if FALLBACK_EXTRACTOR not in candidates:
+        candidates.append(FALLBACK_EXTRACTOR)
+    doc = None
+    errors: List[str] = []
+    for name in candidates:
+        try:
+            doc = PDF_BACKENDS[name][1](path)
+            break
+        except Exception as e:  # each library has its own error types
+            errors.append(f"{name}: {e}")
+    if doc is None:
+        raise ValueError(f"could not open {path} ({'; '.join(errors)})")
+
+    fallback = None
+    try:
+        for index in range(len(doc)):
+            try:
+                text, backend = doc.text(index), doc.name
+            except Exception:
+                if doc.name == FALLBACK_EXTRACTOR:
+                    raise
+                if fallback is None:
+                    fallback = _PlumberDocument(path)
+                text, backend = fallback.text(index), FALLBACK_EXTRACTOR
+            if used is not None:
+                used.add(backend)
+            yield index + 1, text
+    finally:
+        doc.close()
+        if fallback is not None:
+            fallback.close()
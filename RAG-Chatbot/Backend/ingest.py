@@ -0,0 +1,461 @@
+# ingest.py
+# =============================================================================
+# STAGED INGEST PIPELINE: SCAN -> PARSE (PROCESSES) -> EMBED (BATCHED) -> WRITE (BULK)
+# =============================================================================
+# - scan:  walk the folder tree (scanner.iter_files, in a thread) and stat every file;
+#          size + mtime unchanged => skip, no hashing. Known documents come from the
+#          local manifest while it is in sync with the DB, else from one DB query.
+#          index_paths does the same for an explicit list of paths (watcher.py,
+#          /upload/) without walking the folder
+# - parse: INGEST_WORKERS processes hash, load and chunk files (parsing.parse_file),
+#          page by page; every chunk records the page it starts on
+#          A changed, already-known file is diffed against its stored chunk hashes:
+#          only new chunks are embedded, vanished ones deleted, kept ones re-indexed
+# - embed: one worker batches chunks ACROSS files up to EMBED_BATCH, looks their
+#          hashes up among the stored chunks (any document) in one query
+#          and encodes only the misses on the shared EmbeddingService
+#          (utils.embedding_service); being a single worker it holds at most one of
+#          the EMBED_THREADS threads, so concurrent queries always have one left
+# - write: one writer commits up to INGEST_WRITE_BATCH documents per transaction
+# Stages hand off through bounded asyncio.Queues: a slow stage backs up the ones
+# before it instead of buffering a whole folder of parsed text in memory.
+import asyncio
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timezone
+from stat import S_ISREG
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+import asyncpg
+
+from db import (
+    DOCUMENTS_TABLE,
+    DocumentWrite,
+    get_chunk_hashes,
+    get_document_index,
+    get_documents_watermark,
+    get_stored_embeddings,
+    write_documents,
+)
+from parsing import CHUNK_STRATEGY, get_chunker, parse_file
+from scanner import INGEST_MANIFEST, Manifest, in_scope, iter_files
+from utils import DOCUMENTS_DIR, EMBED_BATCH, aembed_texts_batched
+
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", str(max(1, (os.cpu_count() or 2) - 1))))
+INGEST_QUEUE_SIZE = int(os.getenv("INGEST_QUEUE_SIZE", "64"))      # items per stage queue
+INGEST_WRITE_BATCH = int(os.getenv("INGEST_WRITE_BATCH", "32"))    # documents per transaction
+# "spawn" keeps workers from inheriting the loaded model / torch threads via fork
+INGEST_START_METHOD = os.getenv("INGEST_START_METHOD", "spawn")
+# Re-embed only the chunks of a changed file that are actually new (0 = replace all)
+INCREMENTAL_REINGEST = os.getenv("INCREMENTAL_REINGEST", "1") == "1"
+# Reuse embeddings of identical chunks already stored for any document
+INGEST_EMBED_CACHE = os.getenv("INGEST_EMBED_CACHE", "1") == "1"
+
+
+class FileItem(NamedTuple):
+    path: str
+    filename: str
+    size_bytes: int
+    mtime: datetime
+    known_sha256: Optional[str]  # None for files the DB hasn't seen
+
+    def doc(self, sha256: str, extractor: Optional[str] = None) -> Tuple:
+        return (self.path, self.filename, self.size_bytes, self.mtime, sha256, extractor)
+
+
+# -----------------------------------------------------------------------------
+# SCAN
+# -----------------------------------------------------------------------------
+def _file_item(path: str, stat: os.stat_result, known: Dict[str, dict]) -> Optional[FileItem]:
+    """FileItem for a new or changed file; None if size and mtime match `known`."""
+    mtime_dt = datetime.fromtimestamp(stat.st_mtime, tz=timezone.utc)
+    existing = known.get(path)
+    if existing and existing["size_bytes"] == stat.st_size and existing["mtime"] == mtime_dt:
+        return None
+    return FileItem(
+        path, os.path.basename(path), stat.st_size, mtime_dt,
+        existing["sha256"] if existing else None,
+    )
+
+
+def scan_changed(folder: str, known: Dict[str, dict]) -> Tuple[List[FileItem], int]:
+    """Files that are new or whose size/mtime differ from `known`; plus the number scanned."""
+    items: List[FileItem] = []
+    seen = 0
+    for path, stat in iter_files(folder):
+        seen += 1
+        item = _file_item(path, stat, known)
+        if item is not None:
+            items.append(item)
+    return items, seen
+
+
+def scan_paths(paths: Iterable[str], known: Dict[str, dict]) -> Tuple[List[FileItem], int]:
+    """scan_changed for explicit file paths; paths that are gone or not regular files are skipped."""
+    items: List[FileItem] = []
+    seen = 0
+    for path in paths:
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue  # deleted / renamed away before we got to it
+        if not S_ISREG(st.st_mode):
+            continue
+        seen += 1
+        item = _file_item(path, st, known)
+        if item is not None:
+            items.append(item)
+    return items, seen
+
+
+def diff_chunks(
+    chunks: List[Tuple[int, str, str, Optional[int]]],
+    stored: Dict[str, Tuple[int, int, Optional[int]]],
+) -> Tuple[List[Tuple[int, str, str, Optional[int]]], List[int], List[Tuple[int, int, Optional[int]]], int]:
+    """
+    Compare freshly parsed chunks (chunk_index, text, chunk_sha256, page) with the
+    stored {chunk_sha256: (chunk_id, chunk_index, page)} of the same document.
+    Returns (to_embed, delete_ids, reindex, reused):
+    - to_embed:   chunks whose hash isn't stored yet
+    - delete_ids: stored chunks whose hash no longer occurs
+    - reindex:    (chunk_id, new chunk_index, page) for kept chunks that moved
+    Repeated hashes keep their first occurrence, like the (document_id, chunk_sha256) unique.
+    """
+    seen = set()
+    to_embed: List[Tuple[int, str, str, Optional[int]]] = []
+    reindex: List[Tuple[int, int, Optional[int]]] = []
+    reused = 0
+    for idx, text, chash, page in chunks:
+        if chash in seen:
+            continue
+        seen.add(chash)
+        kept = stored.get(chash)
+        if kept is None:
+            to_embed.append((idx, text, chash, page))
+            continue
+        reused += 1
+        if kept[1:] != (idx, page):
+            reindex.append((kept[0], idx, page))
+    delete_ids = [cid for chash, (cid, _, _) in stored.items() if chash not in seen]
+    return to_embed, delete_ids, reindex, reused
+
+
+# -----------------------------------------------------------------------------
+# PARSE PROCESS POOL
+# -----------------------------------------------------------------------------
+# Started on first use and kept: spawning re-imports the entry module in every
+# worker, which should happen once per process, not once per /ingest/ or watcher batch.
+_executor: Optional[ProcessPoolExecutor] = None
+
+
+def get_executor() -> ProcessPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(
+            max_workers=INGEST_WORKERS, mp_context=multiprocessing.get_context(INGEST_START_METHOD)
+        )
+    return _executor
+
+
+def shutdown_executor() -> None:
+    """Stop the parse workers (app shutdown, or after a worker died)."""
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+
+# -----------------------------------------------------------------------------
+# STAGES
+# -----------------------------------------------------------------------------
+async def _feed(items: List[FileItem], parse_q: asyncio.Queue, n_workers: int) -> None:
+    for item in items:
+        await parse_q.put(item)
+    for _ in range(n_workers):
+        await parse_q.put(None)
+
+
+async def _parse_worker(
+    pool: asyncpg.Pool,
+    executor: ProcessPoolExecutor,
+    parse_q: asyncio.Queue,
+    embed_q: asyncio.Queue,
+    write_q: asyncio.Queue,
+    stats: dict,
+) -> None:
+    loop = asyncio.get_running_loop()
+    while True:
+        item = await parse_q.get()
+        if item is None:
+            break
+        try:
+            sha, chunks, extractor = await loop.run_in_executor(
+                executor, parse_file, item.path, item.known_sha256, CHUNK_STRATEGY
+            )
+        except Exception as e:
+            if isinstance(e, BrokenProcessPool) and executor is _executor:
+                shutdown_executor()  # a worker died; the next run starts a fresh pool
+            stats["failed"] += 1
+            print(f"[ingest] WARN: could not parse {item.path}: {e}")
+            continue
+        if chunks is None:
+            # Touched but identical: refresh size/mtime only, nothing to embed
+            stats["unchanged_hash"] += 1
+            await write_q.put(DocumentWrite(item.doc(sha)))
+            continue
+
+        stats["extractors"][extractor] = stats["extractors"].get(extractor, 0) + 1
+        write = DocumentWrite(item.doc(sha, extractor), replace=item.known_sha256 is not None)
+        if item.known_sha256 is not None:
+            stats["replaced_paths"].append(item.path)
+            stored = {}
+            if INCREMENTAL_REINGEST:
+                try:
+                    stored = await get_chunk_hashes(pool, item.path)
+                except (asyncpg.PostgresError, asyncio.TimeoutError) as e:
+                    # Can't diff: replace the whole document rather than fail the run
+                    print(f"[ingest] WARN: could not read stored chunks of {item.path}: {e}")
+            if stored:
+                chunks, delete_ids, reindex, reused = diff_chunks(chunks, stored)
+                stats["chunks_reused"] += reused
+                write = DocumentWrite(item.doc(sha, extractor), delete_ids=delete_ids, reindex=reindex)
+        if chunks:
+            await embed_q.put((write, chunks))
+        else:
+            # Only deletions / moves (or an empty file): nothing to embed
+            await write_q.put(write._replace(rows=[]))
+
+
+async def _embed_chunks(pool: asyncpg.Pool, hashes: List[str], texts: List[str], stats: dict) -> List[List[float]]:
+    """
+    Embeddings for chunks given by (hash, text): hashes some stored chunk already
+    has reuse its embedding, each distinct missing hash is encoded once. A lookup
+    error only costs the reuse, never the ingest.
+    """
+    cached: Dict[str, List[float]] = {}
+    if INGEST_EMBED_CACHE:
+        try:
+            cached = await get_stored_embeddings(pool, list(set(hashes)))
+        except (asyncpg.PostgresError, asyncio.TimeoutError) as e:
+            print(f"[ingest] WARN: embedding reuse lookup failed: {e}")
+    hits = sum(1 for h in hashes if h in cached)
+    stats["embed_cache_hits"] += hits
+    stats["embed_cache_misses"] += len(hashes) - hits
+
+    missing = {h: t for h, t in zip(hashes, texts) if h not in cached}
+    if missing:
+        cached.update(zip(missing, await aembed_texts_batched(list(missing.values()), kind="ingest")))
+    return [cached[h] for h in hashes]
+
+
+async def _embed_worker(
+    pool: asyncpg.Pool,
+    embed_q: asyncio.Queue,
+    write_q: asyncio.Queue,
+    batch_size: int,
+    stats: dict,
+) -> None:
+    # batch_size only sizes the cross-file batch; the service splits by EMBED_BATCH
+    done = False
+    while not done:
+        first = await embed_q.get()
+        if first is None:
+            break
+        # Top up with whatever is already parsed, across files, up to one batch
+        batch = [first]
+        n_chunks = len(first[1])
+        while n_chunks < batch_size:
+            try:
+                nxt = embed_q.get_nowait()
+            except asyncio.QueueEmpty:
+                break
+            if nxt is None:
+                done = True
+                break
+            batch.append(nxt)
+            n_chunks += len(nxt[1])
+
+        hashes = [chash for (_, chunks) in batch for (_, _, chash, _) in chunks]
+        texts = [t for (_, chunks) in batch for (_, t, _, _) in chunks]
+        embeddings = iter(await _embed_chunks(pool, hashes, texts, stats))
+        for write, chunks in batch:
+            rows = [(idx, t, next(embeddings), chash, page) for (idx, t, chash, page) in chunks]
+            await write_q.put(write._replace(rows=rows))
+    await write_q.put(None)
+
+
+async def _writer(
+    pool: asyncpg.Pool,
+    write_q: asyncio.Queue,
+    stats: dict,
+    on_written: Optional[Callable[[Tuple], None]] = None,
+) -> None:
+    done = False
+    while not done:
+        first = await write_q.get()
+        if first is None:
+            break
+        batch = [first]
+        while len(batch) < INGEST_WRITE_BATCH:
+            try:
+                nxt = write_q.get_nowait()
+            except asyncio.QueueEmpty:
+                break
+            if nxt is None:
+                done = True
+                break
+            batch.append(nxt)
+
+        try:
+            stats["chunks"] += await write_documents(pool, batch)
+            stats["ingested"] += sum(1 for w in batch if w.rows is not None)
+            written = batch
+        except (asyncpg.PostgresError, asyncio.TimeoutError) as e:
+            # One bad document shouldn't lose the whole batch: retry one by one
+            print(f"[ingest] WARN: batch of {len(batch)} failed ({e}); retrying per document")
+            written = []
+            for entry in batch:
+                try:
+                    stats["chunks"] += await write_documents(pool, [entry])
+                    stats["ingested"] += entry.rows is not None
+                    written.append(entry)
+                except (asyncpg.PostgresError, asyncio.TimeoutError) as e2:
+                    stats["failed"] += 1
+                    print(f"[ingest] WARN: could not write {entry.doc[0]}: {e2}")
+        if on_written is not None:
+            for entry in written:
+                on_written(entry.doc)
+
+
+# -----------------------------------------------------------------------------
+# PIPELINE
+# -----------------------------------------------------------------------------
+async def run_pipeline(
+    pool: asyncpg.Pool,
+    items: List[FileItem],
+    embed_batch: int = EMBED_BATCH,
+    on_written: Optional[Callable[[Tuple], None]] = None,
+) -> dict:
+    """
+    Parse, embed and write `items` through the staged pipeline; returns counters.
+    on_written(doc) is called for every document committed to the DB.
+    """
+    # replaced_paths: already-known documents whose content changed
+    # embed_cache_hits/misses: chunks served from / not found in the embedding cache
+    # extractors: parsed files per backend, e.g. {"pypdfium2": 90, "text": 12}
+    stats = {
+        "ingested": 0, "unchanged_hash": 0, "failed": 0, "chunks": 0, "chunks_reused": 0,
+        "embed_cache_hits": 0, "embed_cache_misses": 0, "extractors": {}, "replaced_paths": [],
+    }
+    if not items:
+        return stats
+    get_chunker(CHUNK_STRATEGY)  # fail fast on a typo, not once per file in the workers
+
+    parse_q: asyncio.Queue = asyncio.Queue(maxsize=INGEST_QUEUE_SIZE)
+    embed_q: asyncio.Queue = asyncio.Queue(maxsize=INGEST_QUEUE_SIZE)
+    write_q: asyncio.Queue = asyncio.Queue(maxsize=INGEST_QUEUE_SIZE)
+    n_workers = max(1, min(INGEST_WORKERS, len(items)))
+    executor = get_executor()
+
+    async def parse_stage() -> None:
+        await asyncio.gather(*(
+            _parse_worker(pool, executor, parse_q, embed_q, write_q, stats) for _ in range(n_workers)
+        ))
+        await embed_q.put(None)
+
+    tasks = [
+        asyncio.create_task(_feed(items, parse_q, n_workers)),
+        asyncio.create_task(parse_stage()),
+        asyncio.create_task(_embed_worker(pool, embed_q, write_q, embed_batch, stats)),
+        asyncio.create_task(_writer(pool, write_q, stats, on_written)),
+    ]
+    try:
+        # A failing stage would leave its neighbours blocked on a full/empty
+        # queue, so stop everything on the first exception
+        done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        for t in done:
+            t.result()
+    finally:
+        for t in tasks:
+            t.cancel()
+    return stats
+
+
+async def _known_documents(pool: asyncpg.Pool, manifest: Optional[Manifest]) -> Tuple[Dict[str, dict], str]:
+    """Known documents from the manifest if it is in sync with the DB, else from the DB."""
+    if manifest is None:
+        return await get_document_index(pool), "off"
+    if manifest.watermark is not None and manifest.watermark == await get_documents_watermark(pool):
+        return manifest.files, "hit"
+    manifest.files = await get_document_index(pool)
+    return manifest.files, "rebuilt"
+
+
+async def index_folder(pool: asyncpg.Pool, folder: str = DOCUMENTS_DIR) -> dict:
+    """Scan `folder` (recursively) against the manifest or the DB and ingest what changed."""
+    t0 = time.perf_counter()
+    manifest = (
+        await asyncio.to_thread(Manifest.load, INGEST_MANIFEST, DOCUMENTS_TABLE) if INGEST_MANIFEST else None
+    )
+    known, manifest_state = await _known_documents(pool, manifest)
+    items, seen = await asyncio.to_thread(scan_changed, folder, known)
+    stats = await run_pipeline(pool, items, on_written=manifest.record if manifest else None)
+    if manifest is not None:
+        manifest.watermark = await get_documents_watermark(pool)
+        await asyncio.to_thread(manifest.save)
+    stats.update(
+        scanned=seen,
+        unchanged_stat=seen - len(items),
+        manifest=manifest_state,
+        seconds=round(time.perf_counter() - t0, 3),
+    )
+    _report(stats)
+    return stats
+
+
+async def index_paths(pool: asyncpg.Pool, paths: Iterable[str], folder: str = DOCUMENTS_DIR) -> dict:
+    """
+    Ingest just `paths` (new or modified files) the way index_folder would.
+    Paths a scan of `folder` would skip (INGEST_INCLUDE / INGEST_EXCLUDE) are
+    skipped here too. Known documents come from the manifest while it is in
+    sync, else from a DB lookup of those paths only; an out-of-sync manifest is
+    left for the next folder scan to rebuild rather than saved half-complete.
+    """
+    t0 = time.perf_counter()
+    paths = [p for p in dict.fromkeys(paths) if in_scope(folder, p)]
+    manifest = (
+        await asyncio.to_thread(Manifest.load, INGEST_MANIFEST, DOCUMENTS_TABLE) if INGEST_MANIFEST else None
+    )
+    if manifest is not None and manifest.watermark is not None \
+            and manifest.watermark == await get_documents_watermark(pool):
+        known, manifest_state = manifest.files, "hit"
+    else:
+        known, manifest_state = await get_document_index(pool, paths), "off" if manifest is None else "stale"
+        manifest = None
+    items, seen = await asyncio.to_thread(scan_paths, paths, known)
+    stats = await run_pipeline(pool, items, on_written=manifest.record if manifest else None)
+    if manifest is not None:
+        manifest.watermark = await get_documents_watermark(pool)
+        await asyncio.to_thread(manifest.save)
+    stats.update(
+        scanned=seen,
+        unchanged_stat=seen - len(items),
+        manifest=manifest_state,
+        seconds=round(time.perf_counter() - t0, 3),
+    )
+    _report(stats)
+    return stats
+
+
+def _report(stats: dict) -> None:
+    print(
+        f"[ingest] {stats['scanned']} files in {stats['seconds']}s: {stats['unchanged_stat']} unchanged (size+mtime), "
+        f"{stats['unchanged_hash']} unchanged (hash), {stats['ingested']} ingested "
+        f"({stats['chunks']} chunks written, {stats['chunks_reused']} reused), {stats['failed']} failed; "
+        f"embedding cache {stats['embed_cache_hits']} hits / {stats['embed_cache_misses']} misses"
+    )
+    if stats["extractors"]:
+        print(f"[ingest] extractors: {stats['extractors']}")
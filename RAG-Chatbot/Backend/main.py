@@ -1,12 +1,36 @@
 from fastapi import FastAPI, UploadFile, File, HTTPException, Body
+from fastapi.responses import PlainTextResponse
+import asyncio
 import os
-from db import get_pool, init_db, insert_chunks, fetch_similar,fetch_similar_simple
+import tempfile
+from datetime import datetime
+from typing import List, Optional
+from db import (
+    get_pool,
+    init_db,
+    insert_chunks,
+    fetch_similar,
+    fetch_similar_simple,
+    fetch_similar_many,
+    reindex,
+    migrate_embedding_storage,
+    update_pool_gauges,
+)
+import metrics
 from utils import (
     DOCUMENTS_DIR, 
+    SUPPORTED_EXTENSIONS,
     load_documents, 
     chunk_text, 
-    embed_text, 
+    aembed_text,
+    aembed_texts_batched,
+    embedding_service,
+    get_model,
+    load_query_cache,
+    save_query_cache,
+    answer_with_cache,
     get_rag_context,
+    get_rag_context_with_timings,
     process_file_to_chunks_and_embeddings
 )
 from embedding_openai import (
@@ -15,29 +39,60 @@ from embedding_openai import (
 )
 
 from groq_chat import get_groq_chat_response
+from semantic_cache import ANSWER_CACHE_ENABLED, SemanticAnswerCache
+from watcher import WATCH_DOCUMENTS, DocumentWatcher
+from scanner import in_scope
 from contextlib import asynccontextmanager
 
 pool = None
+migration_task = None
+watcher = None
+# Near-duplicate questions reuse an answer while its source chunks are unchanged
+groq_answer_cache = SemanticAnswerCache("groq")
+openai_answer_cache = SemanticAnswerCache("openai")
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Setup - runs before the application starts
-    global pool
+    global pool, migration_task, watcher
+    # Load the embedding model now rather than on the first request
+    await asyncio.to_thread(get_model)
+    warmed = load_query_cache()
+    if warmed:
+        print(f"Query embedding cache warmed with {warmed} entries")
     try:
         pool = await get_pool()
-        await init_db(pool)
+        # Backfills / index builds continue in the background after startup
+        migration_task = await init_db(pool, background=True)
         print("Database connection established successfully")
     except Exception as e:
         print(f"Error connecting to database: {str(e)}")
         print("Application will continue without database functionality")
         pool = None
+    if WATCH_DOCUMENTS and pool is not None:
+        # Ingest new / modified files under DOCUMENTS_DIR as they appear
+        from utils import index_documents_once
+        watcher = DocumentWatcher(DOCUMENTS_DIR, lambda paths: index_documents_once(pool, DOCUMENTS_DIR, paths))
+        try:
+            await watcher.start()
+        except Exception as e:
+            print(f"Error starting document watcher: {str(e)}")
+            watcher = None
     
     yield  # Application runs here
     
     # Cleanup - runs when the application is shutting down
+    if watcher:
+        await watcher.stop()
+    if migration_task and not migration_task.done():
+        migration_task.cancel()
     if pool:
         await pool.close()
         print("Database connection closed")
+    from ingest import shutdown_executor
+    shutdown_executor()
+    embedding_service.shutdown()
+    save_query_cache()
 
 app = FastAPI(lifespan=lifespan)
 
@@ -46,6 +101,12 @@ async def ragApp():
     print("welcome to rag chat bot application!")
     return {"message": "Welcome to RAG Chat Bot Application!"}
 
+# Prometheus scrape target: pool acquire wait, in-use connections, per-function DB time
+@app.get("/metrics")
+async def metrics_endpoint():
+    update_pool_gauges(pool)
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
 @app.post("/ingest/")
 async def ingest_documents():
     from utils import index_documents_once
@@ -59,19 +120,26 @@ async def ingest_documents():
         raise HTTPException(status_code=500, detail=f"Error ingesting documents: {str(e)}")
 
 
+def _write_bytes(path: str, content: bytes) -> None:
+    with open(path, "wb") as out_file:
+        out_file.write(content)
+
 @app.post("/upload/")
 async def upload_document(file: UploadFile = File(...)):
     ext = os.path.splitext(file.filename)[1].lower()
-    if ext not in [".txt", ".pdf"]:
-        raise HTTPException(status_code=400, detail="Only .txt and .pdf files supported")
+    if ext not in SUPPORTED_EXTENSIONS:
+        raise HTTPException(status_code=400, detail=f"Supported file types: {', '.join(SUPPORTED_EXTENSIONS)}")
     
     # Save the file with its original name to ensure proper tracking
     safe_filename = file.filename.replace(" ", "_")
     file_path = os.path.join(DOCUMENTS_DIR, safe_filename)
+    # Same INGEST_INCLUDE / INGEST_EXCLUDE globs as the folder scan
+    if not in_scope(DOCUMENTS_DIR, file_path):
+        raise HTTPException(status_code=400, detail=f"{safe_filename} is excluded by INGEST_INCLUDE / INGEST_EXCLUDE")
     
-    with open(file_path, "wb") as out_file:
-        content = await file.read()
-        out_file.write(content)
+    content = await file.read()
+    # Disk write off the event loop (uploads can be large PDFs)
+    await asyncio.to_thread(_write_bytes, file_path, content)
     
     try:
         # Use the index_documents_once function which handles the correct insert_chunks call
@@ -79,7 +147,12 @@ async def upload_document(file: UploadFile = File(...)):
         if pool is None:
             print("Database connection not available, file saved but not ingested")
             return {"status": "File uploaded successfully, but database not available for ingestion", "filename": safe_filename}
-        await index_documents_once(pool, DOCUMENTS_DIR)
+        # Only the uploaded file: no need to re-walk the whole folder
+        stats = await index_documents_once(pool, DOCUMENTS_DIR, paths=[file_path])
+        # The pipeline counts parse/write errors instead of raising; an identical
+        # re-upload (unchanged hash / size+mtime) is fine and keeps its file
+        if stats["failed"] or not stats["scanned"]:
+            raise ValueError(f"could not parse or store {safe_filename}")
         return {"status": "File uploaded and ingested successfully", "filename": safe_filename}
     except Exception as e:
         # If there's an error, clean up the file and raise an exception
@@ -95,14 +168,18 @@ async def openai_embedding(file: UploadFile = File(...)):
     ext = os.path.splitext(file.filename)[1].lower()
     if ext not in [".txt", ".pdf"]:
         raise HTTPException(status_code=400, detail="Only .txt and .pdf files supported")
-    temp_path = os.path.join(DOCUMENTS_DIR, "_temp_upload_openai" + ext)
-    with open(temp_path, "wb") as out_file:
-        content = await file.read()
-        out_file.write(content)
+    # Outside DOCUMENTS_DIR: the watcher / folder scan must never ingest the temp file
+    content = await file.read()
+    fd, temp_path = tempfile.mkstemp(prefix="_temp_upload_openai", suffix=ext)
+    os.close(fd)
     try:
+        await asyncio.to_thread(_write_bytes, temp_path, content)
         count = 0
-        # This function should be defined in embedding_openai.py (see note below)
-        for chunk, embedding in process_file_to_chunks_and_embeddings_openai(temp_path):
+        # PDF parsing and one blocking OpenAI request per chunk: all off the event loop
+        pairs = await asyncio.to_thread(
+            lambda: list(process_file_to_chunks_and_embeddings_openai(temp_path))
+        )
+        for chunk, embedding in pairs:
             await insert_chunk_openai(pool, chunk, embedding)
             count += 1
     finally:
@@ -111,12 +188,29 @@ async def openai_embedding(file: UploadFile = File(...)):
 
 # only context without llm
 @app.post("/query-context/")
-async def query_api(query: str = Body(..., embed=True)):
+async def query_api(
+    query: str = Body(..., embed=True),
+    filename: Optional[str] = Body(None, embed=True),
+    path_prefix: Optional[str] = Body(None, embed=True),
+    processed_after: Optional[datetime] = Body(None, embed=True),
+    processed_before: Optional[datetime] = Body(None, embed=True),
+):
     if pool is None:
         return {"context": "", "status": "Database not available"}
     try:
-        emb = embed_text(query)
-        chunks = await fetch_similar_simple(pool, emb, limit=5)
+        emb = await aembed_text(query)
+        if filename or path_prefix or processed_after or processed_before:
+            # Filters are pushed into SQL (see db.fetch_similar)
+            hits = await fetch_similar(
+                pool, emb, limit=5,
+                filename=filename,
+                path_prefix=path_prefix,
+                processed_after=processed_after,
+                processed_before=processed_before,
+            )
+            chunks = [content for content, _ in hits]
+        else:
+            chunks = await fetch_similar_simple(pool, emb, limit=5)
         # Join the content strings directly as fetch_similar_simple returns a list of strings
         context = "\n".join(chunks)
         return {"context": context}
@@ -124,6 +218,39 @@ async def query_api(query: str = Body(..., embed=True)):
         print(f"Error in query API: {str(e)}")
         return {"context": "", "error": str(e)}
 
+# lexical + vector retrieval fused with RRF; returns per-stage timings
+@app.post("/query-context/hybrid")
+async def query_hybrid_api(query: str = Body(..., embed=True), top_k: int = Body(5, embed=True)):
+    if pool is None:
+        return {"context": "", "status": "Database not available"}
+    context, timings = await get_rag_context_with_timings(query, pool, top_k=top_k, hybrid=True)
+    return {"context": context, "timings": timings}
+
+# batch of queries -> contexts in one DB round trip (offline evaluation jobs)
+@app.post("/query-context/batch")
+async def query_batch_api(
+    queries: List[str] = Body(..., embed=True),
+    top_k: int = Body(5, embed=True),
+):
+    if pool is None:
+        return {"results": [], "status": "Database not available"}
+    try:
+        embs = await aembed_texts_batched(queries)
+        hits = await fetch_similar_many(pool, embs, k=top_k)
+        return {
+            "results": [
+                {
+                    "query": q,
+                    "context": "\n".join(content for content, _ in chunks),
+                    "chunks": [{"content": c, "distance": d} for c, d in chunks],
+                }
+                for q, chunks in zip(queries, hits)
+            ]
+        }
+    except Exception as e:
+        print(f"Error in batch query API: {str(e)}")
+        return {"results": [], "error": str(e)}
+
 @app.post("/chat-openai/")
 async def chat_openai(query: str = Body(..., embed=True)):
     from openai_chat import get_openai_chat_response
@@ -131,6 +258,11 @@ async def chat_openai(query: str = Body(..., embed=True)):
         if pool is None:
             context = ""
             print("Database not available, proceeding without context")
+        elif ANSWER_CACHE_ENABLED:
+            answer, context, cached = await answer_with_cache(
+                openai_answer_cache, get_openai_chat_response, query, pool
+            )
+            return {"answer": answer, "context": context, "cached": cached}
         else:
             context = await get_rag_context(query, pool)
         answer = await get_openai_chat_response(context, query)
@@ -145,6 +277,11 @@ async def chat_groq(query: str = Body(..., embed=True)):
         if pool is None:
             context = ""
             print("Database not available, proceeding without context")
+        elif ANSWER_CACHE_ENABLED:
+            answer, context, cached = await answer_with_cache(
+                groq_answer_cache, get_groq_chat_response, query, pool
+            )
+            return {"answer": answer, "context": context, "cached": cached}
         else:
             context = await get_rag_context(query, pool)
         answer = await get_groq_chat_response(context, query)
@@ -153,6 +290,31 @@ async def chat_groq(query: str = Body(..., embed=True)):
         print(f"Error in chat-groq API: {str(e)}")
         return {"answer": f"Error processing your request: {str(e)}", "context": ""}
 
+# admin: rebuild the ANN index concurrently (ivfflat lists sized from row count)
+@app.post("/admin/reindex/")
+async def admin_reindex(
+    strategy: Optional[str] = Body(None, embed=True),
+    lists: Optional[int] = Body(None, embed=True),
+):
+    if pool is None:
+        raise HTTPException(status_code=503, detail="Database not available")
+    if strategy is not None and strategy.lower() not in ("ivfflat", "hnsw"):
+        raise HTTPException(status_code=400, detail="strategy must be 'ivfflat' or 'hnsw'")
+    try:
+        return await reindex(pool, strategy=strategy, lists=lists)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error rebuilding index: {str(e)}")
+
+# admin: convert embedding column / ANN index to EMBED_STORAGE (vector, halfvec, bit)
+@app.post("/admin/migrate-storage/")
+async def admin_migrate_storage():
+    if pool is None:
+        raise HTTPException(status_code=503, detail="Database not available")
+    try:
+        return await migrate_embedding_storage(pool)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error migrating embedding storage: {str(e)}")
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run("main:app", host="0.0.0.0", port=8080, reload=True)
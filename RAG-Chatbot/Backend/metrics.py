@@ -0,0 +1,116 @@
+# metrics.py
+# =============================================================================
+# IN-PROCESS METRICS (COUNTERS / GAUGES / HISTOGRAMS) IN PROMETHEUS TEXT FORMAT
+# =============================================================================
+# Deliberately tiny: no prometheus_client dependency, single event loop, so no locks.
+import bisect
+from typing import Dict, List, Sequence, Tuple
+
+# Seconds; tuned for DB calls and embedding work (0.5ms .. 10s)
+DEFAULT_BUCKETS: Tuple[float, ...] = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+
+_REGISTRY: List["_Metric"] = []
+
+
+def _labels_key(labelnames: Sequence[str], labels: Dict[str, str]) -> Tuple[str, ...]:
+    return tuple(str(labels.get(n, "")) for n in labelnames)
+
+
+def _fmt_labels(labelnames: Sequence[str], key: Tuple[str, ...], extra: str = "") -> str:
+    parts = [f'{n}="{v}"' for n, v in zip(labelnames, key)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        _REGISTRY.append(self)
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"] + self._samples()
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, help_text, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1.0, **labels) -> None:
+        key = _labels_key(self.labelnames, labels)
+        self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(_labels_key(self.labelnames, labels), 0.0)
+
+    def _samples(self) -> List[str]:
+        return [f"{self.name}{_fmt_labels(self.labelnames, k)} {v}" for k, v in self._values.items()]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value: float, **labels) -> None:
+        self._values[_labels_key(self.labelnames, labels)] = float(value)
+
+    def dec(self, amount: float = 1.0, **labels) -> None:
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help_text: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # per label set: [bucket counts..., +Inf count], sum
+        self._counts: Dict[Tuple[str, ...], List[int]] = {}
+        self._sums: Dict[Tuple[str, ...], float] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = _labels_key(self.labelnames, labels)
+        counts = self._counts.get(key)
+        if counts is None:
+            counts = self._counts[key] = [0] * (len(self.buckets) + 1)
+            self._sums[key] = 0.0
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        self._sums[key] += value
+
+    def _samples(self) -> List[str]:
+        out: List[str] = []
+        for key, counts in self._counts.items():
+            cumulative = 0
+            for bound, c in zip(self.buckets + (float("inf"),), counts):
+                cumulative += c
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                labels = _fmt_labels(self.labelnames, key, f'le="{le}"')
+                out.append(f"{self.name}_bucket{labels} {cumulative}")
+            out.append(f"{self.name}_sum{_fmt_labels(self.labelnames, key)} {self._sums[key]}")
+            out.append(f"{self.name}_count{_fmt_labels(self.labelnames, key)} {cumulative}")
+        return out
+
+
+def render() -> str:
+    """All registered metrics in Prometheus text exposition format."""
+    lines: List[str] = []
+    for metric in _REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
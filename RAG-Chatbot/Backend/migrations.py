@@ -0,0 +1,376 @@
+# migrations.py
+# =============================================================================
+# VERSIONED SCHEMA MIGRATIONS FOR THE CHUNKS / DOCUMENTS TABLES
+# =============================================================================
+# - Each migration runs once per CHUNKS_TABLE and is recorded in schema_migrations.
+# - "startup" migrations are catalog-only (no table scans) and run inline in init_db,
+#   so cold start doesn't depend on table size.
+# - "background" migrations (backfills, index builds) run after startup in a task:
+#   backfills go in bounded id-range batches, indexes are built CONCURRENTLY.
+# - Advisory locks keep several app instances from running the same work at once.
+import asyncio
+import os
+import time
+from typing import Awaitable, Callable, List, NamedTuple
+
+import asyncpg
+
+from db import (
+    CHUNK_EMBED_CACHE_TABLE,
+    CHUNKS_TABLE,
+    DOCUMENTS_TABLE,
+    EMBED_COLUMN_TYPE,
+    FTS_CONFIG,
+    _acquire,
+    _maintenance,
+    _safe_table_name,
+)
+
+MIGRATION_BATCH = int(os.getenv("MIGRATION_BATCH", "5000"))            # rows per backfill batch
+MIGRATION_BATCH_PAUSE = float(os.getenv("MIGRATION_BATCH_PAUSE", "0.05"))  # seconds between batches
+
+# Startup (blocking) and background work take different locks, so a running
+# backfill on one instance never holds up another instance's startup.
+_STARTUP_LOCK = "rag_migrations_startup:"
+_BACKGROUND_LOCK = "rag_migrations_background:"
+
+
+class Migration(NamedTuple):
+    version: int
+    name: str
+    background: bool
+    up: Callable[[asyncpg.Connection, str], Awaitable[None]]
+
+
+# -----------------------------------------------------------------------------
+# HELPERS
+# -----------------------------------------------------------------------------
+async def create_index_concurrently(conn: asyncpg.Connection, name: str, ddl: str) -> None:
+    """
+    CREATE INDEX CONCURRENTLY `name` unless a valid one exists. A failed concurrent
+    build leaves an INVALID index behind, which IF NOT EXISTS would then skip forever,
+    so drop that first.
+    """
+    valid = await conn.fetchval(
+        "SELECT i.indisvalid FROM pg_index i WHERE i.indexrelid = to_regclass($1)", name
+    )
+    if valid:
+        return
+    if valid is not None:
+        await _maintenance(conn, f"DROP INDEX CONCURRENTLY IF EXISTS {name};")
+    try:
+        await _maintenance(conn, ddl)
+    except asyncpg.PostgresError:
+        await _maintenance(conn, f"DROP INDEX CONCURRENTLY IF EXISTS {name};")
+        raise
+
+
+async def backfill_in_batches(
+    conn: asyncpg.Connection, table: str, set_sql: str, where_sql: str, from_sql: str = ""
+) -> int:
+    """
+    UPDATE {table} SET {set_sql} [FROM {from_sql}] WHERE {where_sql}, one primary-key
+    range at a time. Each batch is its own short transaction, so locks and WAL stay bounded.
+    """
+    from_clause = f"FROM {from_sql}" if from_sql else ""
+    bounds = await conn.fetchrow(f"SELECT min(id) AS lo, max(id) AS hi FROM {table}")
+    if bounds["lo"] is None:
+        return 0
+    total = 0
+    lo = bounds["lo"]
+    while lo <= bounds["hi"]:
+        status = await conn.execute(
+            f"UPDATE {table} SET {set_sql} {from_clause} "
+            f"WHERE {table}.id >= $1 AND {table}.id < $2 AND ({where_sql})",
+            lo, lo + MIGRATION_BATCH,
+        )
+        total += int(status.rsplit(" ", 1)[-1])
+        lo += MIGRATION_BATCH
+        await asyncio.sleep(MIGRATION_BATCH_PAUSE)
+    return total
+
+
+async def _is_generated(conn: asyncpg.Connection, table: str, column: str) -> bool:
+    return bool(await conn.fetchval(
+        "SELECT attgenerated <> '' FROM pg_attribute WHERE attrelid = to_regclass($1) AND attname = $2",
+        table, column,
+    ))
+
+
+# -----------------------------------------------------------------------------
+# MIGRATIONS
+# -----------------------------------------------------------------------------
+async def _m1_chunks_table(conn: asyncpg.Connection, table: str) -> None:
+    await conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS {table} (
+            id SERIAL PRIMARY KEY,
+            content TEXT,
+            embedding {EMBED_COLUMN_TYPE},
+            path TEXT NOT NULL,
+            filename TEXT NOT NULL,
+            size_bytes BIGINT NOT NULL,
+            mtime TIMESTAMPTZ NOT NULL,
+            sha256 TEXT NOT NULL,
+            processed_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            chunk_index int NOT NULL DEFAULT 0,
+            chunk_sha256 text
+        );
+    """)
+    # Columns required for dedupe on older tables; constant defaults are catalog-only
+    await conn.execute(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS chunk_index int NOT NULL DEFAULT 0;")
+    await conn.execute(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS chunk_sha256 text;")
+
+async def _m2_content_tsv_column(conn: asyncpg.Connection, table: str) -> None:
+    # A STORED generated column would rewrite the whole table under an exclusive
+    # lock; a plain column + trigger is catalog-only and backfilled in migration 5.
+    # Tables that already have the generated column keep it.
+    await conn.execute(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS content_tsv tsvector;")
+    if await _is_generated(conn, table, "content_tsv"):
+        return
+    await conn.execute(f"""
+        CREATE OR REPLACE FUNCTION {table}_content_tsv() RETURNS trigger AS $$
+        BEGIN
+            NEW.content_tsv := to_tsvector('{FTS_CONFIG}', coalesce(NEW.content, ''));
+            RETURN NEW;
+        END
+        $$ LANGUAGE plpgsql;
+    """)
+    await conn.execute(f"DROP TRIGGER IF EXISTS trg_{table}_content_tsv ON {table};")
+    await conn.execute(f"""
+        CREATE TRIGGER trg_{table}_content_tsv
+        BEFORE INSERT OR UPDATE OF content ON {table}
+        FOR EACH ROW EXECUTE FUNCTION {table}_content_tsv();
+    """)
+
+async def _m3_backfill_chunk_sha256(conn: asyncpg.Connection, table: str) -> None:
+    n = await backfill_in_batches(
+        conn, table,
+        "chunk_sha256 = encode(digest(content, 'sha256'), 'hex')",
+        "chunk_sha256 IS NULL AND content IS NOT NULL",
+    )
+    print(f"[migrations] backfilled chunk_sha256 on {n} rows")
+
+async def _m4_unique_indexes(conn: asyncpg.Connection, table: str) -> None:
+    # Raises (and so stays unrecorded, retried next start) if duplicates exist;
+    # clean them up and restart to get these uniques in place.
+    await create_index_concurrently(
+        conn, f"uq_{table}_doc_idx",
+        f"CREATE UNIQUE INDEX CONCURRENTLY uq_{table}_doc_idx ON {table}(path, chunk_index);",
+    )
+    await create_index_concurrently(
+        conn, f"uq_{table}_doc_hash",
+        f"""CREATE UNIQUE INDEX CONCURRENTLY uq_{table}_doc_hash
+            ON {table}(path, chunk_sha256) WHERE chunk_sha256 IS NOT NULL;""",
+    )
+
+async def _m5_backfill_content_tsv(conn: asyncpg.Connection, table: str) -> None:
+    if await _is_generated(conn, table, "content_tsv"):
+        return
+    n = await backfill_in_batches(
+        conn, table,
+        f"content_tsv = to_tsvector('{FTS_CONFIG}', coalesce(content, ''))",
+        "content_tsv IS NULL",
+    )
+    print(f"[migrations] backfilled content_tsv on {n} rows")
+
+async def _m6_search_indexes(conn: asyncpg.Connection, table: str) -> None:
+    # Lexical search (GIN) and metadata pre-filters (B-tree)
+    indexes = {
+        f"idx_{table}_content_tsv": "USING gin (content_tsv)",
+        f"idx_{table}_filename": "(filename)",
+        f"idx_{table}_path_pattern": "(path text_pattern_ops)",
+        f"idx_{table}_processed_at": "(processed_at)",
+    }
+    for name, spec in indexes.items():
+        await create_index_concurrently(conn, name, f"CREATE INDEX CONCURRENTLY {name} ON {table} {spec};")
+
+async def _m7_documents_table(conn: asyncpg.Connection, table: str) -> None:
+    # One metadata row per file instead of a copy on every chunk. All catalog-only:
+    # the new table starts empty, the FK is NOT VALID (checked for new rows only,
+    # validated by migration 8) and dropping NOT NULL doesn't scan.
+    docs = _safe_table_name(DOCUMENTS_TABLE)
+    await conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS {docs} (
+            id BIGSERIAL PRIMARY KEY,
+            path TEXT NOT NULL UNIQUE,
+            filename TEXT NOT NULL,
+            size_bytes BIGINT NOT NULL,
+            mtime TIMESTAMPTZ NOT NULL,
+            sha256 TEXT NOT NULL,
+            processed_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        );
+    """)
+    # Metadata pre-filters now join through documents
+    await conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{docs}_filename ON {docs}(filename);")
+    await conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{docs}_path_pattern ON {docs}(path text_pattern_ops);")
+    await conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{docs}_processed_at ON {docs}(processed_at);")
+
+    await conn.execute(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS document_id BIGINT;")
+    has_fk = await conn.fetchval(
+        "SELECT 1 FROM pg_constraint WHERE conname = $1 AND conrelid = to_regclass($2)",
+        f"fk_{table}_document", table,
+    )
+    if not has_fk:
+        await conn.execute(f"""
+            ALTER TABLE {table} ADD CONSTRAINT fk_{table}_document
+            FOREIGN KEY (document_id) REFERENCES {docs}(id) ON DELETE CASCADE NOT VALID;
+        """)
+    # New chunk rows carry only document_id; the per-chunk copies stay on old rows
+    await conn.execute(f"""
+        ALTER TABLE {table}
+            ALTER COLUMN path DROP NOT NULL,
+            ALTER COLUMN filename DROP NOT NULL,
+            ALTER COLUMN size_bytes DROP NOT NULL,
+            ALTER COLUMN mtime DROP NOT NULL,
+            ALTER COLUMN sha256 DROP NOT NULL;
+    """)
+
+async def _m8_backfill_documents(conn: asyncpg.Connection, table: str) -> None:
+    docs = _safe_table_name(DOCUMENTS_TABLE)
+    status = await _maintenance(conn, f"""
+        INSERT INTO {docs} (path, filename, size_bytes, mtime, sha256, processed_at)
+        SELECT DISTINCT ON (path) path, filename, size_bytes, mtime, sha256, processed_at
+        FROM {table}
+        WHERE document_id IS NULL AND path IS NOT NULL
+        ORDER BY path, processed_at DESC
+        ON CONFLICT (path) DO NOTHING;
+    """)
+    print(f"[migrations] created {status.rsplit(' ', 1)[-1]} {docs} rows from {table}")
+    n = await backfill_in_batches(
+        conn, table,
+        "document_id = d.id",
+        f"d.path = {table}.path AND {table}.document_id IS NULL",
+        from_sql=f"{docs} d",
+    )
+    print(f"[migrations] linked {n} chunk rows to {docs}")
+    # SHARE UPDATE EXCLUSIVE: scans the table but doesn't block reads or writes
+    await _maintenance(conn, f"ALTER TABLE {table} VALIDATE CONSTRAINT fk_{table}_document;")
+
+async def _m9_document_indexes(conn: asyncpg.Connection, table: str) -> None:
+    # Dedupe keys move from path to document_id; (document_id, chunk_index) also
+    # serves the FK (ON DELETE CASCADE) and per-document lookups.
+    await create_index_concurrently(
+        conn, f"uq_{table}_docid_idx",
+        f"CREATE UNIQUE INDEX CONCURRENTLY uq_{table}_docid_idx ON {table}(document_id, chunk_index);",
+    )
+    await create_index_concurrently(
+        conn, f"uq_{table}_docid_hash",
+        f"""CREATE UNIQUE INDEX CONCURRENTLY uq_{table}_docid_hash
+            ON {table}(document_id, chunk_sha256) WHERE chunk_sha256 IS NOT NULL;""",
+    )
+    # Filters read documents now; uq_{table}_doc_idx stays for the legacy path lookup
+    for name in (f"uq_{table}_doc_hash", f"idx_{table}_filename",
+                 f"idx_{table}_path_pattern", f"idx_{table}_processed_at"):
+        await _maintenance(conn, f"DROP INDEX CONCURRENTLY IF EXISTS {name};")
+
+async def _m10_embedding_cache_table(conn: asyncpg.Connection, table: str) -> None:
+    # Was: a separate (model_name, chunk_sha256) -> VECTOR embedding cache table.
+    # Superseded by migration 13 (reuse embeddings from the chunk rows); kept as a
+    # no-op so the version history stays intact
+    pass
+
+async def _m11_chunk_page_column(conn: asyncpg.Connection, table: str) -> None:
+    # Page a chunk starts on, for citations; NULL for non-paged formats and for
+    # rows ingested before this (filled when their document is re-ingested)
+    await conn.execute(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS page int;")
+
+async def _m12_document_extractor_column(conn: asyncpg.Connection, table: str) -> None:
+    # Which PDF backend(s) read each file (extractors.py); NULL until re-ingested
+    docs = _safe_table_name(DOCUMENTS_TABLE)
+    await conn.execute(f"ALTER TABLE {docs} ADD COLUMN IF NOT EXISTS extractor TEXT;")
+
+
+async def _m13_chunk_hash_lookup(conn: asyncpg.Connection, table: str) -> None:
+    # Ingest reuses the embedding of any stored chunk with the same hash
+    # (db.get_stored_embeddings); the unique indexes lead with document_id / path
+    await create_index_concurrently(
+        conn, f"idx_{table}_chunk_sha256",
+        f"CREATE INDEX CONCURRENTLY idx_{table}_chunk_sha256 ON {table}(chunk_sha256);",
+    )
+    # The separate embedding cache duplicated every embedding at full precision
+    cache = _safe_table_name(CHUNK_EMBED_CACHE_TABLE)
+    await _maintenance(conn, f"DROP TABLE IF EXISTS {cache};")
+
+
+MIGRATIONS: List[Migration] = [
+    Migration(1, "chunks_table", False, _m1_chunks_table),
+    Migration(2, "content_tsv_column", False, _m2_content_tsv_column),
+    Migration(3, "backfill_chunk_sha256", True, _m3_backfill_chunk_sha256),
+    Migration(4, "unique_indexes", True, _m4_unique_indexes),
+    Migration(5, "backfill_content_tsv", True, _m5_backfill_content_tsv),
+    Migration(6, "search_indexes", True, _m6_search_indexes),
+    Migration(7, "documents_table", False, _m7_documents_table),
+    Migration(8, "backfill_documents", True, _m8_backfill_documents),
+    Migration(9, "document_indexes", True, _m9_document_indexes),
+    Migration(10, "embedding_cache_table", False, _m10_embedding_cache_table),
+    Migration(11, "chunk_page_column", False, _m11_chunk_page_column),
+    Migration(12, "document_extractor_column", False, _m12_document_extractor_column),
+    Migration(13, "chunk_hash_lookup", True, _m13_chunk_hash_lookup),
+]
+
+
+# -----------------------------------------------------------------------------
+# RUNNER
+# -----------------------------------------------------------------------------
+async def _applied_versions(conn: asyncpg.Connection, table: str) -> set:
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            scope TEXT NOT NULL,
+            version INT NOT NULL,
+            name TEXT NOT NULL,
+            applied_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            seconds DOUBLE PRECISION,
+            PRIMARY KEY (scope, version)
+        );
+    """)
+    rows = await conn.fetch("SELECT version FROM schema_migrations WHERE scope = $1", table)
+    return {r["version"] for r in rows}
+
+async def _apply(conn: asyncpg.Connection, table: str, m: Migration) -> None:
+    t0 = time.perf_counter()
+    await m.up(conn, table)
+    elapsed = time.perf_counter() - t0
+    await conn.execute(
+        "INSERT INTO schema_migrations (scope, version, name, seconds) VALUES ($1, $2, $3, $4) "
+        "ON CONFLICT DO NOTHING",
+        table, m.version, m.name, elapsed,
+    )
+    print(f"[migrations] {table}: applied {m.version:03d}_{m.name} in {elapsed:.2f}s")
+
+async def run_startup_migrations(pool: asyncpg.Pool) -> None:
+    """Catalog-only migrations; blocks until applied (serialized across instances)."""
+    table = _safe_table_name(CHUNKS_TABLE)
+    async with _acquire(pool, "run_startup_migrations") as conn:
+        await conn.execute("SELECT pg_advisory_lock(hashtext($1))", _STARTUP_LOCK + table)
+        try:
+            applied = await _applied_versions(conn, table)
+            for m in MIGRATIONS:
+                if not m.background and m.version not in applied:
+                    async with conn.transaction():
+                        await _apply(conn, table, m)
+        finally:
+            await conn.execute("SELECT pg_advisory_unlock(hashtext($1))", _STARTUP_LOCK + table)
+
+async def run_background_migrations(pool: asyncpg.Pool, after=None) -> None:
+    """
+    Backfills and CONCURRENTLY index builds, in version order. A failing migration
+    is logged and left unrecorded (retried next start); later ones still run.
+    `after` is an optional coroutine function run once the migrations are done.
+    """
+    table = _safe_table_name(CHUNKS_TABLE)
+    async with _acquire(pool, "run_background_migrations") as conn:
+        if not await conn.fetchval("SELECT pg_try_advisory_lock(hashtext($1))", _BACKGROUND_LOCK + table):
+            print("[migrations] another instance is running background migrations")
+            return
+        try:
+            applied = await _applied_versions(conn, table)
+            for m in MIGRATIONS:
+                if m.background and m.version not in applied:
+                    try:
+                        await _apply(conn, table, m)
+                    except asyncpg.PostgresError as e:
+                        print(f"[migrations] WARN: {m.version:03d}_{m.name} failed, will retry next start: {e}")
+            if after is not None:
+                await after(conn)
+        finally:
+            await conn.execute("SELECT pg_advisory_unlock(hashtext($1))", _BACKGROUND_LOCK + table)
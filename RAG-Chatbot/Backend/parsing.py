@@ -0,0 +1,524 @@
+# parsing.py
+# =============================================================================
+# FILE LOADING + CHUNKING + HASHES (NO MODEL / TORCH IMPORTS)
+# =============================================================================
+# Kept free of heavy imports on purpose: ingest.py runs parse_file in a process
+# pool, and every worker imports this module (not utils.py and its model).
+import os
+import re
+import hashlib
+import zipfile
+from collections import deque
+from html.parser import HTMLParser
+from xml.etree import ElementTree
+from typing import Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+from dotenv import load_dotenv
+
+from extractors import iter_pdf_pages
+
+#LOAD ENV
+load_dotenv()
+
+CHUNK_SIZE = int(os.getenv("CHUNK_SIZE", "500"))        # chars ("chars", "sentences", "paragraphs")
+CHUNK_OVERLAP = int(os.getenv("CHUNK_OVERLAP", "50"))
+CHUNK_STRATEGY = os.getenv("CHUNK_STRATEGY", "chars")   # see CHUNKERS
+# "tokens": gte-large reads 512 tokens, two of them [CLS]/[SEP]
+CHUNK_TOKENS = int(os.getenv("CHUNK_TOKENS", "510"))
+CHUNK_TOKEN_OVERLAP = int(os.getenv("CHUNK_TOKEN_OVERLAP", "50"))
+CHUNK_TOKENIZER = os.getenv("CHUNK_TOKENIZER", os.getenv("EMBED_MODEL", "thenlper/gte-large"))
+
+
+# -----------------------------------------------------------------------------
+# TEXT NORMALIZATION + HASHES
+# -----------------------------------------------------------------------------
+def normalize_text(s: str) -> str:
+    #STABLE, DETERMINISTIC NORMALIZATION
+    return " ".join((s or "").split())
+
+
+def sha256_bytes(b: bytes) -> str:
+    h = hashlib.sha256()
+    h.update(b)
+    return h.hexdigest()
+
+
+def sha256_text(s: str) -> str:
+    return sha256_bytes(s.encode("utf-8"))
+
+
+def file_sha256(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+# -----------------------------------------------------------------------------
+# FILE LOADING
+# -----------------------------------------------------------------------------
+# Streaming loaders yield (page_number, text) segments; page_number is None for
+# formats without pages. Segment boundaries must fall on whitespace.
+# PDFs go through extractors.iter_pdf_pages (fastest installed backend first).
+TXT_SEGMENT_BYTES = 1024 * 1024
+
+
+def iter_txt_segments(path: str) -> Iterator[Tuple[None, str]]:
+    """Whole lines in ~TXT_SEGMENT_BYTES blocks, so a split never lands inside a word."""
+    with open(path, "r", encoding="utf-8") as f:
+        while True:
+            lines = f.readlines(TXT_SEGMENT_BYTES)
+            if not lines:
+                break
+            yield None, "".join(lines)
+
+
+def _split_at_whitespace(text: str) -> Tuple[str, str]:
+    """(head, tail) with tail the trailing partial word, so head ends on a word boundary."""
+    for i in range(len(text) - 1, -1, -1):
+        if text[i].isspace():
+            return text[: i + 1], text[i + 1 :]
+    return "", text
+
+
+class _HtmlText(HTMLParser):
+    """Visible text of an HTML document; block-level tags become line breaks."""
+
+    SKIP = {"script", "style", "noscript", "template", "head"}
+    BLOCK = {"p", "div", "br", "li", "tr", "td", "th", "h1", "h2", "h3", "h4", "h5", "h6",
+             "section", "article", "header", "footer", "pre", "blockquote", "table", "ul", "ol"}
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self._skip = 0
+        self._parts: List[str] = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIP:
+            self._skip += 1
+        elif tag in self.BLOCK:
+            self._parts.append("\n")
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIP:
+            self._skip = max(0, self._skip - 1)
+        elif tag in self.BLOCK:
+            self._parts.append("\n")
+
+    def handle_data(self, data):
+        if not self._skip:
+            self._parts.append(data)
+
+    def take(self) -> str:
+        text, self._parts = "".join(self._parts), []
+        return text
+
+
+def iter_html_segments(path: str) -> Iterator[Tuple[None, str]]:
+    """Visible text of an .html file, parsed in TXT_SEGMENT_BYTES blocks."""
+    parser = _HtmlText()
+    tail = ""
+    with open(path, "r", encoding="utf-8", errors="replace") as f:
+        for block in iter(lambda: f.read(TXT_SEGMENT_BYTES), ""):
+            parser.feed(block)
+            # A word may continue in the next block: hold it back
+            head, tail = _split_at_whitespace(tail + parser.take())
+            if head:
+                yield None, head
+    parser.close()
+    text = tail + parser.take()
+    if text:
+        yield None, text
+
+
+_W_NS = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+
+
+def iter_docx_segments(path: str) -> Iterator[Tuple[None, str]]:
+    """Paragraph text of a .docx (word/document.xml), streamed with iterparse; no python-docx needed."""
+    parts: List[str] = []
+    size = 0
+    with zipfile.ZipFile(path) as z, z.open("word/document.xml") as f:
+        for _, el in ElementTree.iterparse(f, events=("end",)):
+            if el.tag == _W_NS + "t":
+                parts.append(el.text or "")
+                size += len(el.text or "")
+            elif el.tag == _W_NS + "tab":
+                parts.append("\t")
+            elif el.tag == _W_NS + "p":
+                parts.append("\n")
+                el.clear()
+                if size >= TXT_SEGMENT_BYTES:
+                    yield None, "".join(parts)
+                    parts, size = [], 0
+    if parts:
+        yield None, "".join(parts)
+
+
+# extension -> (extractor name, segment loader); PDFs are handled by extractors.py
+LOADERS: Dict[str, Tuple[str, Callable[[str], Iterator[Tuple[None, str]]]]] = {
+    **{ext: ("text", iter_txt_segments) for ext in (
+        ".txt", ".md", ".markdown", ".rst", ".csv", ".tsv", ".log", ".json", ".yaml", ".yml",
+    )},
+    ".html": ("html", iter_html_segments),
+    ".htm": ("html", iter_html_segments),
+    ".docx": ("docx", iter_docx_segments),
+}
+SUPPORTED_EXTENSIONS: Tuple[str, ...] = (".pdf",) + tuple(LOADERS)
+
+
+def iter_file_pages(path: str, used: Optional[set] = None) -> Iterator[Tuple[Optional[int], str]]:
+    """`used` collects the extractor names that read the file ("text" for plain text)."""
+    ext = os.path.splitext(path)[1].lower()
+    if ext == ".pdf":
+        return iter_pdf_pages(path, used=used)
+    if ext not in LOADERS:
+        raise ValueError(f"Unsupported file type: {path}")
+    name, loader = LOADERS[ext]
+    if used is not None:
+        used.add(name)
+    return loader(path)
+
+
+def load_pdf_file(path: str) -> str:
+    return "\n".join(text for _, text in iter_pdf_pages(path) if text)
+
+
+def load_txt_file(path: str) -> str:
+    with open(path, "r", encoding="utf-8") as f:
+        return f.read()
+
+
+def load_file(path: str) -> str:
+    low = path.lower()
+    if low.endswith(".txt"):
+        return load_txt_file(path)
+    if low.endswith(".pdf"):
+        return load_pdf_file(path)
+    return "".join(text for _, text in iter_file_pages(path))
+
+
+# -----------------------------------------------------------------------------
+# CHUNKING
+# -----------------------------------------------------------------------------
+def chunk_text(text: str, chunk_size: int = CHUNK_SIZE, overlap: int = CHUNK_OVERLAP) -> List[str]:
+    text = normalize_text(text)
+    chunks: List[str] = []
+    i = 0
+    n = len(text)
+    step = max(1, chunk_size - max(0, overlap))  #SAFETY FOR OVERLAP>=CHUNK
+    while i < n:
+        end = min(i + chunk_size, n)
+        chunks.append(text[i:end])
+        i += step
+    return chunks
+
+
+# -----------------------------------------------------------------------------
+# CHUNKER STRATEGIES
+# -----------------------------------------------------------------------------
+# A strategy maps (page_number, text) segments to (chunk, page) pairs, streaming.
+# Its chunk size / overlap are in the strategy's own unit (chars or tokens).
+# Changing CHUNK_STRATEGY only affects files ingested (or changed) afterwards.
+class Chunker(NamedTuple):
+    name: str
+    chunk: Callable[..., Iterator[Tuple[str, Optional[int]]]]
+    size: int      # default chunk size
+    overlap: int   # default overlap
+    unit: str      # "chars" or "tokens"
+
+
+CHUNKERS: Dict[str, Chunker] = {}
+
+
+def register_chunker(name: str, size: int, overlap: int, unit: str = "chars"):
+    def decorator(fn):
+        CHUNKERS[name] = Chunker(name, fn, size, overlap, unit)
+        return fn
+    return decorator
+
+
+def get_chunker(name: str = CHUNK_STRATEGY) -> Chunker:
+    try:
+        return CHUNKERS[name]
+    except KeyError:
+        raise ValueError(f"Unknown chunk strategy {name!r}; expected one of {sorted(CHUNKERS)}") from None
+
+
+@register_chunker("chars", CHUNK_SIZE, CHUNK_OVERLAP)
+def iter_chunks(
+    pages: Iterable[Tuple[Optional[int], str]],
+    chunk_size: int = CHUNK_SIZE,
+    overlap: int = CHUNK_OVERLAP,
+) -> Iterator[Tuple[str, Optional[int]]]:
+    """
+    Streaming chunk_text over (page_number, text) segments, yielding (chunk, page)
+    with the page the chunk starts on. Segments are normalized one at a time and
+    joined by a single space, so the chunks (and their hashes) are exactly those of
+    chunk_text on the whole document; only the unconsumed tail is kept in memory,
+    and the overlap carries across page boundaries.
+    """
+    step = max(1, chunk_size - max(0, overlap))
+    buf = ""      # text not yet fully consumed by chunks
+    buf_pos = 0   # document offset of buf[0]
+    pos = 0       # document offset of the next chunk
+    marks: deque = deque()  # (document offset, page) where each segment's text starts
+
+    def page_at(offset: int) -> Optional[int]:
+        while len(marks) > 1 and marks[1][0] <= offset:
+            marks.popleft()
+        return marks[0][1] if marks else None
+
+    for page, raw in pages:
+        text = normalize_text(raw)
+        if not text:
+            continue
+        if buf_pos + len(buf):
+            buf += " "
+        marks.append((buf_pos + len(buf), page))
+        buf += text
+        end = buf_pos + len(buf)
+        while pos + chunk_size <= end:
+            yield buf[pos - buf_pos : pos - buf_pos + chunk_size], page_at(pos)
+            pos += step
+        if pos > buf_pos:
+            cut = min(pos, end) - buf_pos
+            buf, buf_pos = buf[cut:], buf_pos + cut
+
+    end = buf_pos + len(buf)
+    while pos < end:
+        yield buf[pos - buf_pos : pos - buf_pos + chunk_size], page_at(pos)
+        pos += step
+
+
+
+def _pack(lengths: np.ndarray, size: int, overlap: int, sep: int) -> List[Tuple[int, int]]:
+    """
+    Greedy [start, end) windows over unit lengths, joined by `sep`: each window is
+    as long as fits in `size`, the next one starts at the trailing units that fit
+    in `overlap`. One cumulative sum + a binary search per window, not per unit.
+    A unit longer than `size` gets a window of its own.
+    """
+    n = len(lengths)
+    cum = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(lengths + sep, out=cum[1:])
+    windows: List[Tuple[int, int]] = []
+    start = 0
+    while start < n:
+        end = int(np.searchsorted(cum, cum[start] + size + sep, side="right")) - 1
+        end = min(n, max(end, start + 1))
+        windows.append((start, end))
+        if end == n:
+            break
+        start = max(start + 1, int(np.searchsorted(cum, cum[end] - overlap - sep, side="left")))
+    return windows
+
+
+_PARAGRAPH_BREAK = re.compile(r"\n\s*\n")
+_SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
+
+
+def _split_paragraphs(raw: str) -> List[str]:
+    return [p for p in (normalize_text(x) for x in _PARAGRAPH_BREAK.split(raw)) if p]
+
+
+def _split_sentences(raw: str) -> List[str]:
+    return [x for p in _split_paragraphs(raw) for x in _SENTENCE_END.split(p) if x]
+
+
+def _split_words(raw: str) -> List[str]:
+    return normalize_text(raw).split()
+
+
+def _split_long(units: List[str], size: int) -> List[str]:
+    """Break units longer than `size` chars at word boundaries (a longer word is sliced)."""
+    out: List[str] = []
+    for unit in units:
+        if len(unit) <= size:
+            out.append(unit)
+            continue
+        words = unit.split(" ")
+        for s, e in _pack(np.array([len(w) for w in words]), size, 0, 1):
+            piece = " ".join(words[s:e])
+            out.extend(piece[i : i + size] for i in range(0, len(piece), size))
+    return out
+
+
+def _char_lengths(units: Sequence[str]) -> np.ndarray:
+    return np.fromiter((len(u) for u in units), dtype=np.int64, count=len(units))
+
+
+_TOKENIZER = None
+_TOKEN_COUNTS: Dict[str, int] = {}  # word -> tokens, per process
+_TOKEN_COUNTS_MAX = 1_000_000
+
+
+def _tokenizer():
+    global _TOKENIZER
+    if _TOKENIZER is None:
+        #LAZY IMPORT: ONLY THE "tokens" STRATEGY NEEDS IT (FAST RUST TOKENIZER, NO TORCH)
+        from tokenizers import Tokenizer
+
+        tok = Tokenizer.from_pretrained(CHUNK_TOKENIZER)
+        tok.no_truncation()
+        tok.no_padding()
+        _TOKENIZER = tok
+    return _TOKENIZER
+
+
+def token_counts(words: Sequence[str]) -> np.ndarray:
+    """
+    Tokens per whitespace-separated word (no special tokens). WordPiece pre-splits
+    on whitespace, so a chunk's token count is the sum over its words. Words not
+    seen before in this process are encoded in one batch call.
+    """
+    if len(_TOKEN_COUNTS) > _TOKEN_COUNTS_MAX:
+        _TOKEN_COUNTS.clear()
+    new = [w for w in set(words) if w not in _TOKEN_COUNTS]
+    if new:
+        for w, enc in zip(new, _tokenizer().encode_batch(new, add_special_tokens=False)):
+            _TOKEN_COUNTS[w] = len(enc.ids)
+    return np.fromiter((_TOKEN_COUNTS[w] for w in words), dtype=np.int64, count=len(words))
+
+
+def _iter_packed(
+    pages: Iterable[Tuple[Optional[int], str]],
+    split: Callable[[str], List[str]],
+    measure: Callable[[Sequence[str]], np.ndarray],
+    sep: int,
+    carry_join: str,
+    chunk_size: int,
+    overlap: int,
+) -> Iterator[Tuple[str, Optional[int]]]:
+    """
+    Streaming driver for the unit-packing strategies: split segments into units
+    (sentences, paragraphs, words), pack them with _pack and yield the chunks that
+    can no longer grow. The last unit of a segment may continue on the next page,
+    so it is re-split together with the next segment (keeping its start page).
+    """
+    units: List[str] = []
+    unit_pages: List[Optional[int]] = []
+    lengths: List[np.ndarray] = []
+    pending = 0
+    carry, carry_page = "", None
+    flush_at = 16 * max(1, chunk_size)
+
+    def pack(final: bool) -> Iterator[Tuple[str, Optional[int]]]:
+        nonlocal units, unit_pages, lengths, pending
+        lens = np.concatenate(lengths) if lengths else np.zeros(0, dtype=np.int64)
+        windows = _pack(lens, chunk_size, overlap, sep)
+        if not final and windows:
+            keep_from = windows.pop()[0]  # may still grow
+        else:
+            keep_from = len(units)
+        for s, e in windows:
+            yield " ".join(units[s:e]), unit_pages[s]
+        units, unit_pages = units[keep_from:], unit_pages[keep_from:]
+        lengths = [lens[keep_from:]]
+        pending = int(lengths[0].sum() + len(units) * sep)
+
+    for page, raw in pages:
+        first_page = page
+        if carry:
+            raw, first_page = carry + carry_join + raw, carry_page
+        new = split(raw)
+        if not new:
+            continue
+        carry = new.pop()
+        carry_page = first_page if not new else page
+        if not new:
+            continue
+        units.extend(new)
+        unit_pages.append(first_page)
+        unit_pages.extend([page] * (len(new) - 1))
+        lens = measure(new)
+        lengths.append(lens)
+        pending += int(lens.sum()) + len(new) * sep
+        if pending >= flush_at:
+            yield from pack(final=False)
+
+    if carry:
+        units.append(carry)
+        unit_pages.append(carry_page)
+        lengths.append(measure([carry]))
+    yield from pack(final=True)
+
+
+@register_chunker("sentences", CHUNK_SIZE, CHUNK_OVERLAP)
+def iter_sentence_chunks(
+    pages: Iterable[Tuple[Optional[int], str]],
+    chunk_size: int = CHUNK_SIZE,
+    overlap: int = CHUNK_OVERLAP,
+) -> Iterator[Tuple[str, Optional[int]]]:
+    """Whole sentences up to `chunk_size` chars; the overlap is whole trailing sentences."""
+    return _iter_packed(
+        pages, lambda raw: _split_long(_split_sentences(raw), chunk_size), _char_lengths, 1, " ",
+        chunk_size, overlap,
+    )
+
+
+@register_chunker("paragraphs", CHUNK_SIZE, CHUNK_OVERLAP)
+def iter_paragraph_chunks(
+    pages: Iterable[Tuple[Optional[int], str]],
+    chunk_size: int = CHUNK_SIZE,
+    overlap: int = CHUNK_OVERLAP,
+) -> Iterator[Tuple[str, Optional[int]]]:
+    """
+    Whole paragraphs (blank-line separated) up to `chunk_size` chars; a longer
+    paragraph falls back to its sentences.
+    """
+    def split(raw: str) -> List[str]:
+        out: List[str] = []
+        for p in _split_paragraphs(raw):
+            out.extend([p] if len(p) <= chunk_size else _split_long(_SENTENCE_END.split(p), chunk_size))
+        return out
+
+    # A paragraph cut by a page break continues on the next page: carry it with "\n"
+    return _iter_packed(pages, split, _char_lengths, 1, "\n", chunk_size, overlap)
+
+
+@register_chunker("tokens", CHUNK_TOKENS, CHUNK_TOKEN_OVERLAP, unit="tokens")
+def iter_token_chunks(
+    pages: Iterable[Tuple[Optional[int], str]],
+    chunk_size: int = CHUNK_TOKENS,
+    overlap: int = CHUNK_TOKEN_OVERLAP,
+) -> Iterator[Tuple[str, Optional[int]]]:
+    """
+    Whole words up to `chunk_size` tokens of the embedding model's tokenizer, so
+    no chunk is truncated by the model and none wastes its window.
+    """
+    return _iter_packed(pages, _split_words, token_counts, 0, " ", chunk_size, overlap)
+
+# -----------------------------------------------------------------------------
+# PROCESS-POOL ENTRY POINT
+# -----------------------------------------------------------------------------
+def parse_file(
+    path: str,
+    known_sha256: Optional[str] = None,
+    strategy: str = CHUNK_STRATEGY,
+    chunk_size: Optional[int] = None,
+    overlap: Optional[int] = None,
+) -> Tuple[str, Optional[List[Tuple[int, str, str, Optional[int]]]], Optional[str]]:
+    """
+    Hash, load and chunk one file (CPU-bound; runs in a worker process).
+    Returns (sha256, chunks, extractor) with chunks as (chunk_index, chunk_text,
+    chunk_sha256, page) and extractor the backend(s) that read it, e.g. "pypdfium2"
+    or "pypdfium2+pdfplumber"; or (sha256, None, None) when the content still
+    matches `known_sha256`.
+    Pages are chunked as they are extracted; the full text is never held at once.
+    chunk_size / overlap default to the strategy's own (see CHUNKERS).
+    """
+    content_hash = file_sha256(path)
+    if content_hash == known_sha256:
+        return content_hash, None, None
+    chunker = get_chunker(strategy)
+    used: set = set()
+    chunks = chunker.chunk(
+        iter_file_pages(path, used),
+        chunker.size if chunk_size is None else chunk_size,
+        chunker.overlap if overlap is None else overlap,
+    )
+    rows = [(idx, t, sha256_text(t), page) for idx, (t, page) in enumerate(chunks)]
+    return content_hash, rows, "+".join(sorted(used)) or None
@@ -0,0 +1,194 @@
+# scanner.py
+# =============================================================================
+# RECURSIVE DIRECTORY SCAN (os.scandir) + PERSISTENT INGEST MANIFEST
+# =============================================================================
+# - iter_files walks DOCUMENTS_DIR recursively with os.scandir: entry types come
+#   from the directory listing and each file is stat'ed once (DirEntry.stat()).
+#   INGEST_INCLUDE / INGEST_EXCLUDE are comma-separated globs on the path relative
+#   to the folder ("/" separators); an excluded directory is not entered at all.
+# - Manifest is a local JSON mirror of the documents table ({path: size, mtime,
+#   sha256}) saved with the table's watermark (row count, latest processed_at).
+#   While the watermark still matches, a scan compares stat results against the
+#   manifest instead of pulling one row per document from the database.
+import fnmatch
+import json
+import os
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+from dotenv import load_dotenv
+
+from parsing import SUPPORTED_EXTENSIONS
+
+#LOAD ENV
+load_dotenv()
+
+
+def _globs(value: str) -> List[str]:
+    return [g.strip() for g in value.split(",") if g.strip()]
+
+
+INGEST_INCLUDE = _globs(os.getenv("INGEST_INCLUDE", "*"))
+INGEST_EXCLUDE = _globs(os.getenv("INGEST_EXCLUDE", ".*,*/.*"))  # hidden files and directories
+INGEST_MANIFEST = os.getenv("INGEST_MANIFEST", "ingest_manifest.json")  # "" = off
+
+
+def _matches(rel: str, patterns: Sequence[str]) -> bool:
+    return any(fnmatch.fnmatch(rel, p) for p in patterns)
+
+
+def dir_excluded(rel: str, exclude: Optional[Sequence[str]] = None) -> bool:
+    """Is the directory at `rel` (relative to the folder, "/" separators) pruned?"""
+    return _matches(rel, INGEST_EXCLUDE if exclude is None else exclude)
+
+
+def wanted(
+    rel: str,
+    include: Optional[Sequence[str]] = None,
+    exclude: Optional[Sequence[str]] = None,
+    extensions: Tuple[str, ...] = SUPPORTED_EXTENSIONS,
+) -> bool:
+    """Would iter_files yield the file at `rel` (ignoring excluded parent directories)?"""
+    include = INGEST_INCLUDE if include is None else include
+    exclude = INGEST_EXCLUDE if exclude is None else exclude
+    return (
+        rel.lower().endswith(extensions) and not _matches(rel, exclude) and _matches(rel, include)
+    )
+
+
+def in_scope(folder: str, path: str) -> bool:
+    """Would a scan of `folder` yield `path`? (explicit paths: uploads, watcher batches)"""
+    rel = os.path.relpath(path, folder).replace(os.sep, "/")
+    if rel == "." or rel.startswith("../"):
+        return False
+    parts = rel.split("/")
+    if any(dir_excluded("/".join(parts[:i])) for i in range(1, len(parts))):
+        return False
+    return wanted(rel)
+
+
+def iter_files(
+    folder: str,
+    include: Optional[Sequence[str]] = None,
+    exclude: Optional[Sequence[str]] = None,
+    extensions: Tuple[str, ...] = SUPPORTED_EXTENSIONS,
+    prefix: str = "",
+) -> Iterator[Tuple[str, os.stat_result]]:
+    """
+    (path, stat) of every supported file under `folder`; symlinked directories
+    aren't followed. `prefix` is folder's own relative path + "/" when walking a
+    subtree of the scanned root, so globs keep matching from the root.
+    """
+    include = INGEST_INCLUDE if include is None else include
+    exclude = INGEST_EXCLUDE if exclude is None else exclude
+    if not os.path.isdir(folder):
+        return
+    stack = [(folder, prefix)]
+    while stack:
+        path, rel = stack.pop()
+        try:
+            it = os.scandir(path)
+        except OSError as e:
+            print(f"[scan] WARN: cannot read {path}: {e}")
+            continue
+        with it:
+            for entry in it:
+                entry_rel = rel + entry.name
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        if not dir_excluded(entry_rel, exclude):
+                            stack.append((entry.path, entry_rel + "/"))
+                        continue
+                    if not wanted(entry_rel, include, exclude, extensions) or not entry.is_file():
+                        continue
+                    yield entry.path, entry.stat()
+                except OSError:
+                    continue  # removed while scanning
+
+
+def iter_dirs(
+    folder: str, exclude: Optional[Sequence[str]] = None, prefix: str = ""
+) -> Iterator[Tuple[str, str]]:
+    """(path, rel + "/") of `folder` and every directory below it that iter_files would enter."""
+    if not os.path.isdir(folder):
+        return
+    stack = [(folder, prefix)]
+    while stack:
+        path, rel = stack.pop()
+        yield path, rel
+        try:
+            with os.scandir(path) as it:
+                for entry in it:
+                    entry_rel = rel + entry.name
+                    if entry.is_dir(follow_symlinks=False) and not dir_excluded(entry_rel, exclude):
+                        stack.append((entry.path, entry_rel + "/"))
+        except OSError:
+            continue
+
+
+# -----------------------------------------------------------------------------
+# MANIFEST
+# -----------------------------------------------------------------------------
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+_MANIFEST_VERSION = 1
+
+
+def _to_us(dt: datetime) -> int:
+    # Exact: timestamptz and fromtimestamp() both carry microseconds
+    return (dt - _EPOCH) // timedelta(microseconds=1)
+
+
+def _from_us(us: int) -> datetime:
+    return _EPOCH + timedelta(microseconds=us)
+
+
+class Manifest:
+    """
+    {path: {"sha256", "size_bytes", "mtime"}} (the shape of db.get_document_index)
+    for one documents table, plus the watermark it was last in sync with.
+    """
+
+    def __init__(self, path: str, table: str):
+        self.path = path
+        self.table = table
+        self.files: Dict[str, dict] = {}
+        self.watermark: Optional[list] = None
+
+    @classmethod
+    def load(cls, path: str, table: str) -> "Manifest":
+        manifest = cls(path, table)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return manifest
+        except (OSError, ValueError) as e:
+            print(f"[scan] WARN: ignoring unreadable manifest {path}: {e}")
+            return manifest
+        if data.get("version") != _MANIFEST_VERSION or data.get("table") != table:
+            return manifest
+        manifest.watermark = data.get("watermark")
+        manifest.files = {
+            p: {"size_bytes": size, "mtime": _from_us(mtime), "sha256": sha}
+            for p, (size, mtime, sha) in data.get("files", {}).items()
+        }
+        return manifest
+
+    def record(self, doc: Tuple) -> None:
+        """Note a document written to the DB; doc = (path, filename, size_bytes, mtime, sha256, ...)."""
+        path, _, size_bytes, mtime, sha256 = doc[:5]
+        self.files[path] = {"size_bytes": size_bytes, "mtime": mtime, "sha256": sha256}
+
+    def save(self) -> None:
+        data = {
+            "version": _MANIFEST_VERSION,
+            "table": self.table,
+            "watermark": self.watermark,
+            "files": {
+                p: [e["size_bytes"], _to_us(e["mtime"]), e["sha256"]] for p, e in self.files.items()
+            },
+        }
+        # Write-then-rename so a crash mid-save never leaves a torn manifest
+        with open(self.path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(data, f, separators=(",", ":"))
+        os.replace(self.path + ".tmp", self.path)
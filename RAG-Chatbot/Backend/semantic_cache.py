@@ -0,0 +1,172 @@
+# semantic_cache.py
+# =============================================================================
+# SEMANTIC ANSWER CACHE FOR THE CHAT ENDPOINTS
+# =============================================================================
+# Near-duplicate questions ("what is X?" / "What's X") otherwise each pay for an
+# LLM call. An entry stores (query embedding, retrieved chunk ids, document ids,
+# context, answer); a new query whose embedding is within ANSWER_CACHE_THRESHOLD
+# cosine similarity of a cached one reuses the answer only if the caller's own
+# top-k retrieval returns the same chunk ids. Embeddings alone can't tell apart
+# questions that differ in an error code, version or name; their retrieval can.
+# Off by default (ANSWER_CACHE=1 to enable). Answers without context aren't cached.
+# - Eviction: LRU, bounded both by entry count and by approximate bytes.
+# - Invalidation: invalidate_documents() drops every entry (in every cache) that
+#   was answered from a re-ingested document.
+import os
+from collections import OrderedDict
+from typing import Dict, Iterable, List, NamedTuple, Optional, Sequence
+
+import numpy as np
+
+import metrics
+
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE", "0") == "1"
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.95"))  # cosine similarity
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "1000"))              # entries per scope
+ANSWER_CACHE_MAX_MB = float(os.getenv("ANSWER_CACHE_MAX_MB", "64"))          # approx. bytes per scope
+
+ANSWER_CACHE_REQUESTS = metrics.Counter(
+    "answer_cache_requests_total", "Semantic answer cache lookups", ["scope", "result"]
+)
+ANSWER_CACHE_ENTRIES = metrics.Gauge("answer_cache_entries", "Cached answers", ["scope"])
+ANSWER_CACHE_BYTES = metrics.Gauge("answer_cache_bytes", "Approximate size of cached answers", ["scope"])
+
+_CACHES: List["SemanticAnswerCache"] = []
+
+
+class CachedAnswer(NamedTuple):
+    key: int
+    answer: str
+    context: str
+    chunk_ids: tuple
+    document_ids: frozenset
+    similarity: float
+
+
+class _Entry(NamedTuple):
+    embedding: np.ndarray  # unit-normalized float32
+    answer: str
+    context: str
+    chunk_ids: tuple
+    document_ids: frozenset
+    nbytes: int
+
+
+def _unit(vector: Sequence[float]) -> np.ndarray:
+    v = np.asarray(vector, dtype=np.float32)
+    norm = float(np.linalg.norm(v))
+    return v / norm if norm > 0 else v
+
+
+class SemanticAnswerCache:
+    """Nearest-neighbour answer cache for one chat backend (`scope`, e.g. "groq")."""
+
+    def __init__(
+        self,
+        scope: str,
+        threshold: float = ANSWER_CACHE_THRESHOLD,
+        max_entries: int = ANSWER_CACHE_SIZE,
+        max_bytes: int = int(ANSWER_CACHE_MAX_MB * 2**20),
+    ):
+        self.scope = scope
+        self.threshold = threshold
+        self.max_entries = max(1, max_entries)
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[int, _Entry]" = OrderedDict()
+        self._next_key = 0
+        self._bytes = 0
+        # Stacked embeddings for one matrix-vector product per lookup; rebuilt
+        # lazily after inserts/evictions (those only happen on LLM-call misses)
+        self._matrix: Optional[np.ndarray] = None
+        self._keys: List[int] = []
+        _CACHES.append(self)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _update_gauges(self) -> None:
+        ANSWER_CACHE_ENTRIES.set(len(self._entries), scope=self.scope)
+        ANSWER_CACHE_BYTES.set(self._bytes, scope=self.scope)
+
+    def _remove(self, key: int) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry.nbytes
+            self._matrix = None
+
+    def lookup(self, embedding: Sequence[float]) -> Optional[CachedAnswer]:
+        """Most similar cached answer at or above the threshold, else None."""
+        if not self._entries:
+            ANSWER_CACHE_REQUESTS.inc(scope=self.scope, result="miss")
+            return None
+        if self._matrix is None:
+            self._keys = list(self._entries)
+            self._matrix = np.stack([self._entries[k].embedding for k in self._keys])
+        sims = self._matrix @ _unit(embedding)
+        best = int(np.argmax(sims))
+        if float(sims[best]) < self.threshold:
+            ANSWER_CACHE_REQUESTS.inc(scope=self.scope, result="miss")
+            return None
+        key = self._keys[best]
+        entry = self._entries[key]
+        self._entries.move_to_end(key)
+        return CachedAnswer(key, entry.answer, entry.context, entry.chunk_ids, entry.document_ids, float(sims[best]))
+
+    def record_hit(self) -> None:
+        """Count a served hit (after the caller matched its retrieved chunks)."""
+        ANSWER_CACHE_REQUESTS.inc(scope=self.scope, result="hit")
+
+    def discard(self, key: int) -> None:
+        """Drop an entry whose chunk ids don't match the new query's retrieval."""
+        ANSWER_CACHE_REQUESTS.inc(scope=self.scope, result="stale")
+        self._remove(key)
+        self._update_gauges()
+
+    def put(
+        self,
+        embedding: Sequence[float],
+        answer: str,
+        context: str,
+        chunk_ids: Iterable[int],
+        document_ids: Iterable[int],
+    ) -> None:
+        chunk_ids = tuple(chunk_ids)
+        if not chunk_ids or not context:
+            return  # nothing ties an answer without context to the documents
+        emb = _unit(embedding)
+        nbytes = emb.nbytes + len(answer.encode("utf-8")) + len(context.encode("utf-8"))
+        if nbytes > self.max_bytes:
+            return
+        key = self._next_key
+        self._next_key += 1
+        self._entries[key] = _Entry(
+            emb, answer, context, chunk_ids, frozenset(d for d in document_ids if d is not None),
+            nbytes,
+        )
+        self._bytes += nbytes
+        self._matrix = None
+        while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+        self._update_gauges()
+
+    def invalidate_documents(self, document_ids: Iterable[int]) -> int:
+        ids = set(document_ids)
+        stale = [k for k, e in self._entries.items() if e.document_ids & ids]
+        for k in stale:
+            self._remove(k)
+        self._update_gauges()
+        return len(stale)
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._bytes = 0
+        self._matrix = None
+        self._update_gauges()
+
+
+def invalidate_documents(document_ids: Iterable[int]) -> Dict[str, int]:
+    """Drop entries answered from any of `document_ids`, in every cache. Returns counts per scope."""
+    ids = list(document_ids)
+    if not ids:
+        return {}
+    return {cache.scope: cache.invalidate_documents(ids) for cache in _CACHES}
@@ -2,233 +2,290 @@
 # =============================================================================
 #FILE SCANNER + CHUNKER + EMBEDDER WITH DEDUPE LOGIC
 # =============================================================================
+import asyncio
 import os
-import hashlib
-from datetime import datetime, timezone
+import time
 from typing import Iterator, List, Tuple, Optional
 
-import pdfplumber
-from sentence_transformers import SentenceTransformer
 from dotenv import load_dotenv
 
+from embedder import EmbeddingCache, EmbeddingService
+from scanner import iter_files
+
+#LOADERS / CHUNKER / HASHES LIVE IN parsing.py (IMPORTED BY INGEST WORKER PROCESSES)
+from parsing import (
+    CHUNK_SIZE,
+    CHUNK_OVERLAP,
+    CHUNK_STRATEGY,
+    CHUNKERS,
+    SUPPORTED_EXTENSIONS,
+    get_chunker,
+    normalize_text,
+    sha256_bytes,
+    sha256_text,
+    file_sha256,
+    load_pdf_file,
+    load_txt_file,
+    load_file,
+    iter_file_pages,
+    chunk_text,
+    iter_chunks,
+)
+
 #LOAD ENV
 load_dotenv()
 
 # ====== PARAMETERS (OVERRIDABLE VIA .env) ======
 MODEL_NAME = os.getenv("EMBED_MODEL", "thenlper/gte-large")  # 1024-dim
-CHUNK_SIZE = int(os.getenv("CHUNK_SIZE", "500"))
-CHUNK_OVERLAP = int(os.getenv("CHUNK_OVERLAP", "50"))
 DOCUMENTS_DIR = os.getenv("DOCUMENTS_DIR", "documents")
 EMBED_BATCH = int(os.getenv("EMBED_BATCH", "128"))
+EMBED_THREADS = int(os.getenv("EMBED_THREADS", "2"))  # encode() threads shared by queries + ingest
+EMBED_BATCH_WINDOW_MS = float(os.getenv("EMBED_BATCH_WINDOW_MS", "2"))  # coalesce queries; 0 = off
+EMBED_MAX_BATCH = int(os.getenv("EMBED_MAX_BATCH", "32"))  # flush early once this many are waiting
+EMBED_CACHE_SIZE = int(os.getenv("EMBED_CACHE_SIZE", "10000"))  # query embeddings kept; 0 = no cache
+EMBED_CACHE_TTL = float(os.getenv("EMBED_CACHE_TTL", "86400"))  # seconds; 0 = never expire
+EMBED_CACHE_SNAPSHOT = os.getenv("EMBED_CACHE_SNAPSHOT", "")  # path prefix for warm restarts; "" = off
+HYBRID_SEARCH = os.getenv("HYBRID_SEARCH", "0") == "1"  # lexical + vector retrieval for RAG context
+
+# ====== LOAD MODEL ONCE (ON FIRST USE) ======
+#NOT AT IMPORT: SPAWNED INGEST WORKERS RE-IMPORT THE ENTRY MODULE (main.py -> utils)
+#AND MUST NOT EACH LOAD THE MODEL. THE APP PRELOADS IT IN lifespan.
+model = None
+MODEL_DIM = None
+
+
+def get_model():
+    global model, MODEL_DIM
+    if model is None:
+        from sentence_transformers import SentenceTransformer
+
+        loaded = SentenceTransformer(MODEL_NAME)
+        MODEL_DIM = getattr(loaded, "get_sentence_embedding_dimension", lambda: None)() or len(
+            loaded.encode("dim_probe")
+        )
 
-# ====== LOAD MODEL ONCE ======
-model = SentenceTransformer(MODEL_NAME)
-MODEL_DIM = getattr(model, "get_sentence_embedding_dimension", lambda: None)() or len(
-    model.encode("dim_probe")
-)
-
-#HARD CHECK TO AVOID DIMENSION MISMATCH WITH DB
-env_embed_dim = int(os.getenv("EMBED_DIM", str(MODEL_DIM)))
-if env_embed_dim != MODEL_DIM:
-    # YOU CAN SILENCE THIS IF YOU GUARANTEE MATCH IN DB INIT.
-    print(
-        f"[utils] WARNING: EMBED_DIM ({env_embed_dim}) != model_dim ({MODEL_DIM}). "
-        "Ensure db.py uses the same dimension in VECTOR(n)."
-    )
-
-
-# -----------------------------------------------------------------------------
-# TEXT NORMALIZATION + HASHES
-# -----------------------------------------------------------------------------
-def normalize_text(s: str) -> str:
-    #STABLE, DETERMINISTIC NORMALIZATION
-    return " ".join((s or "").split())
-
-
-def sha256_bytes(b: bytes) -> str:
-    h = hashlib.sha256()
-    h.update(b)
-    return h.hexdigest()
-
-
-def sha256_text(s: str) -> str:
-    return sha256_bytes(s.encode("utf-8"))
+        #HARD CHECK TO AVOID DIMENSION MISMATCH WITH DB
+        env_embed_dim = int(os.getenv("EMBED_DIM", str(MODEL_DIM)))
+        if env_embed_dim != MODEL_DIM:
+            # YOU CAN SILENCE THIS IF YOU GUARANTEE MATCH IN DB INIT.
+            print(
+                f"[utils] WARNING: EMBED_DIM ({env_embed_dim}) != model_dim ({MODEL_DIM}). "
+                "Ensure db.py uses the same dimension in VECTOR(n)."
+            )
+        model = loaded
+    return model
 
 
-def file_sha256(path: str) -> str:
-    h = hashlib.sha256()
-    with open(path, "rb") as f:
-        for chunk in iter(lambda: f.read(1024 * 1024), b""):
-            h.update(chunk)
-    return h.hexdigest()
+def _encode(texts, **kwargs):
+    return get_model().encode(texts, **kwargs)
 
 
 # -----------------------------------------------------------------------------
-# FILE LOADING
+# FILE SCANNING
 # -----------------------------------------------------------------------------
-def load_pdf_file(path: str) -> str:
-    parts: List[str] = []
-    with pdfplumber.open(path) as pdf:
-        for page in pdf.pages:
-            page_text = page.extract_text() or ""
-            if page_text:
-                parts.append(page_text)
-    return "\n".join(parts)
-
-
-def load_txt_file(path: str) -> str:
-    with open(path, "r", encoding="utf-8") as f:
-        return f.read()
-
-
 def yield_files(folder: str = DOCUMENTS_DIR) -> Iterator[str]:
-    #YIELD ONLY SUPPORTED FILE TYPES
-    if not os.path.isdir(folder):
-        return
-    for fname in os.listdir(folder):
-        path = os.path.join(folder, fname)
-        if not os.path.isfile(path):
-            continue
-        low = fname.lower()
-        if low.endswith(".txt") or low.endswith(".pdf"):
-            yield path
-
-
-# -----------------------------------------------------------------------------
-# CHUNKING
-# -----------------------------------------------------------------------------
-def chunk_text(text: str, chunk_size: int = CHUNK_SIZE, overlap: int = CHUNK_OVERLAP) -> List[str]:
-    text = normalize_text(text)
-    chunks: List[str] = []
-    i = 0
-    n = len(text)
-    step = max(1, chunk_size - max(0, overlap))  #SAFETY FOR OVERLAP>=CHUNK
-    while i < n:
-        end = min(i + chunk_size, n)
-        chunks.append(text[i:end])
-        i += step
-    return chunks
+    #YIELD ONLY SUPPORTED FILE TYPES, RECURSIVELY (INGEST_INCLUDE / INGEST_EXCLUDE GLOBS APPLY)
+    for path, _ in iter_files(folder):
+        yield path
 
 
 # -----------------------------------------------------------------------------
 # EMBEDDING
 # -----------------------------------------------------------------------------
 def embed_text(s: str) -> List[float]:
-    return model.encode(s).tolist()
+    return _encode(s).tolist()
 
 
 def embed_texts_batched(texts: List[str], batch_size: int = EMBED_BATCH) -> List[List[float]]:
     out: List[List[float]] = []
     for i in range(0, len(texts), batch_size):
         batch = texts[i : i + batch_size]
-        out.extend(model.encode(batch).tolist())
+        out.extend(_encode(batch).tolist())
     return out
 
 
+#ASYNC VARIANTS: ENCODE RUNS ON THE SERVICE'S THREAD POOL, NEVER ON THE EVENT LOOP
+query_cache = EmbeddingCache(MODEL_NAME, EMBED_CACHE_SIZE, EMBED_CACHE_TTL) if EMBED_CACHE_SIZE > 0 else None
+embedding_service = EmbeddingService(
+    _encode,
+    max_workers=EMBED_THREADS,
+    batch_size=EMBED_BATCH,
+    batch_window=EMBED_BATCH_WINDOW_MS / 1000,
+    max_batch=EMBED_MAX_BATCH,
+    cache=query_cache,
+)
+
+
+def load_query_cache() -> int:
+    #WARM START FROM THE ON-DISK SNAPSHOT (IF CONFIGURED)
+    if query_cache is None or not EMBED_CACHE_SNAPSHOT:
+        return 0
+    try:
+        return query_cache.load(EMBED_CACHE_SNAPSHOT)
+    except (OSError, ValueError, KeyError) as e:
+        print(f"[utils] WARN: could not load query cache snapshot: {e}")
+        return 0
+
+
+def save_query_cache() -> int:
+    if query_cache is None or not EMBED_CACHE_SNAPSHOT:
+        return 0
+    try:
+        return query_cache.save(EMBED_CACHE_SNAPSHOT)
+    except OSError as e:
+        print(f"[utils] WARN: could not save query cache snapshot: {e}")
+        return 0
+
+
+async def aembed_text(s: str) -> List[float]:
+    return await embedding_service.embed(s)
+
+
+async def aembed_texts_batched(texts: List[str], kind: str = "batch") -> List[List[float]]:
+    return await embedding_service.embed_many(texts, kind=kind)
+
+
 # -----------------------------------------------------------------------------
 # HIGH-LEVEL: FILE -> CHUNKS + EMBEDDINGS (+ CHUNK HASH)
 # -----------------------------------------------------------------------------
 def process_file_to_chunks_and_embeddings(
     file_path: str,
-    chunk_size: int = CHUNK_SIZE,
-    overlap: int = CHUNK_OVERLAP,
-) -> List[Tuple[int, str, List[float], str]]:
+    chunk_size: Optional[int] = None,
+    overlap: Optional[int] = None,
+    strategy: str = CHUNK_STRATEGY,
+) -> List[Tuple[int, str, List[float], str, Optional[int]]]:
     """
-    Returns list of (chunk_index, chunk_text, embedding, chunk_sha256)
+    Returns list of (chunk_index, chunk_text, embedding, chunk_sha256, page)
     """
-    if file_path.lower().endswith(".txt"):
-        text = load_txt_file(file_path)
-    elif file_path.lower().endswith(".pdf"):
-        text = load_pdf_file(file_path)
-    else:
-        raise ValueError(f"Unsupported file type: {file_path}")
-
-    chunks = chunk_text(text, chunk_size, overlap)
-    embeddings = embed_texts_batched(chunks, EMBED_BATCH)
-
-    results: List[Tuple[int, str, List[float], str]] = []
-    for idx, (t, emb) in enumerate(zip(chunks, embeddings)):
+    chunker = get_chunker(strategy)
+    chunks = list(chunker.chunk(
+        iter_file_pages(file_path),
+        chunker.size if chunk_size is None else chunk_size,
+        chunker.overlap if overlap is None else overlap,
+    ))
+    embeddings = embed_texts_batched([t for t, _ in chunks], EMBED_BATCH)
+
+    results: List[Tuple[int, str, List[float], str, Optional[int]]] = []
+    for idx, ((t, page), emb) in enumerate(zip(chunks, embeddings)):
         chash = sha256_text(t)
-        results.append((idx, t, emb, chash))
+        results.append((idx, t, emb, chash, page))
     return results
 
 
 # -----------------------------------------------------------------------------
 # INDEXING PIPELINE (SKIPS UNCHANGED FILES, RE-INGESTS CHANGED ONES)
 # -----------------------------------------------------------------------------
-async def index_documents_once(pool, folder: str = DOCUMENTS_DIR) -> None:
+#ONE INDEXING RUN AT A TIME: /ingest/, /upload/ AND THE WATCHER MAY OVERLAP
+_index_lock = asyncio.Lock()
+
+
+async def index_documents_once(pool, folder: str = DOCUMENTS_DIR, paths: Optional[List[str]] = None) -> dict:
     #LAZY IMPORT TO AVOID CIRCULAR DEPENDENCIES
-    from db import (
-        get_document_by_path,
-        upsert_document_metadata,
-        delete_chunks_for_document,
-        insert_chunks,
-    )
+    from ingest import index_folder, index_paths
 
-    for path in yield_files(folder):
-        stat = os.stat(path)
-        filename = os.path.basename(path)
-        size_bytes = stat.st_size
-        mtime_dt = datetime.fromtimestamp(stat.st_mtime, tz=timezone.utc)
-        content_hash = file_sha256(path)
-
-        existing = await get_document_by_path(pool, path)
-
-        #SKIP UNCHANGED FILES
-        if existing and existing["sha256"] == content_hash:
-            # print(f"[indexer] SKIP unchanged: {path}")
-            continue
-
-        #UPSERT DOC METADATA (NEW OR UPDATED)
-        await upsert_document_metadata(
-            pool,
-            path=path,
-            filename=filename,
-            size_bytes=size_bytes,
-            mtime_dt=mtime_dt,
-            sha256=content_hash,
-        )
+    from db import get_document_ids
+    from semantic_cache import invalidate_documents
 
-        #IF CHANGED, CLEAR OLD CHUNKS FOR CLEAN REBUILD
-        if existing and existing["sha256"] != content_hash:
-            await delete_chunks_for_document(pool, path)
+    #SCAN (ONE DB QUERY) -> PARSE (PROCESS POOL) -> EMBED (BATCHED) -> WRITE (BULK)
+    #paths: ONLY THESE FILES (WATCHER / UPLOAD), NO FOLDER WALK
+    async with _index_lock:
+        stats = await (index_folder(pool, folder) if paths is None else index_paths(pool, paths, folder))
 
-        #PROCESS + INSERT (DEDUPED BY UNIQUE CONSTRAINTS)
-        rows = process_file_to_chunks_and_embeddings(path, CHUNK_SIZE, CHUNK_OVERLAP)
-        _ = await insert_chunks(pool, path, filename, size_bytes, mtime_dt, content_hash, rows)
+    #CACHED CHAT ANSWERS BUILT FROM RE-INGESTED DOCUMENTS ARE NO LONGER VALID
+    if stats.get("replaced_paths"):
+        dropped = invalidate_documents(await get_document_ids(pool, stats["replaced_paths"]))
+        if any(dropped.values()):
+            print(f"[indexer] invalidated cached answers: {dropped}")
+    return stats
 
 
 def load_documents(folder: str = DOCUMENTS_DIR):
-    """Return a list of full-text docs from .txt/.pdf in the folder."""
-    docs = []
-    if not os.path.isdir(folder):
-        return docs
-    for path in yield_files(folder):
-        if path.lower().endswith(".txt"):
-            docs.append(load_txt_file(path))
-        elif path.lower().endswith(".pdf"):
-            docs.append(load_pdf_file(path))
-    return docs
+    """Return a list of full-text docs from the supported files under the folder."""
+    return [load_file(path) for path in yield_files(folder)]
 
 # -----------------------------------------------------------------------------
 # RAG CONTEXT BUILDER (USES TOP-K SIMILAR CHUNKS)
 # -----------------------------------------------------------------------------
-async def get_rag_context(query: str, pool, top_k: int = 5, probes: int = 10) -> str:
+async def _retrieve(
+    query: str, q_emb: List[float], pool, top_k: int, probes: int, hybrid: bool, timings: dict
+) -> list:
+    """Top-k (chunk_id, document_id, content, distance or rrf score); fills search timings."""
     # LAZY IMPORT TO AVOID CYCLES
-    from db import fetch_similar
-    
+    from db import fetch_similar, fetch_hybrid
+
+    if hybrid:
+        #LEXICAL + VECTOR, FUSED WITH RECIPROCAL RANK FUSION
+        results, search_timings = await fetch_hybrid(
+            pool, query, q_emb, limit=top_k, probes=probes, with_ids=True
+        )
+        timings.update(search_timings)
+        return results
+    t0 = time.perf_counter()
+    results = await fetch_similar(pool, q_emb, limit=top_k, probes=probes, with_ids=True)
+    timings["vector_ms"] = round((time.perf_counter() - t0) * 1000, 3)
+    return results
+
+
+async def get_rag_context_with_timings(
+    query: str, pool, top_k: int = 5, probes: int = 10, hybrid: bool = HYBRID_SEARCH
+) -> Tuple[str, dict]:
+    """Context string plus per-stage timings in ms (embed, and lexical/vector/fusion if hybrid)."""
     if pool is None:
         print("Database pool is None, cannot fetch RAG context")
-        return ""
-        
+        return "", {}
+
+    try:
+        t0 = time.perf_counter()
+        q_emb = await aembed_text(query)
+        timings = {"embed_ms": round((time.perf_counter() - t0) * 1000, 3)}
+        results = await _retrieve(query, q_emb, pool, top_k, probes, hybrid, timings)
+        return "\n".join(content for _, _, content, _ in results), timings
+    except Exception as e:
+        print(f"Error fetching RAG context: {str(e)}")
+        return "", {}
+
+
+async def get_rag_context(query: str, pool, top_k: int = 5, probes: int = 10) -> str:
+    context, _ = await get_rag_context_with_timings(query, pool, top_k=top_k, probes=probes)
+    return context
+
+
+# -----------------------------------------------------------------------------
+# CHAT WITH SEMANTIC ANSWER CACHE
+# -----------------------------------------------------------------------------
+async def answer_with_cache(
+    cache, llm, query: str, pool, top_k: int = 5, probes: int = 10
+) -> Tuple[str, str, bool]:
+    """
+    (answer, context, cached) for `query`, answered by `llm(context, query)`.
+    Retrieval always runs (one ANN query); a cached answer is served only if its
+    query is within the cache's cosine threshold AND it was answered from exactly
+    the chunks this query retrieves, so it saves the LLM call only.
+    """
+    #LIKE get_rag_context: A DB / EMBEDDING FAILURE MEANS AN ANSWER WITHOUT CONTEXT
+    #(NOT CACHED), NEVER A FAILED CHAT
     try:
-        q_emb = embed_text(query)
-        results = await fetch_similar(pool, q_emb, limit=top_k, probes=probes)
-        # results: List[(content, distance)]
-        return "\n".join(content for content, _ in results)
+        q_emb = await aembed_text(query)
+        results = await _retrieve(query, q_emb, pool, top_k, probes, HYBRID_SEARCH, {})
     except Exception as e:
         print(f"Error fetching RAG context: {str(e)}")
-        return ""
+        return await llm("", query), "", False
+
+    hit = cache.lookup(q_emb)
+    if hit is not None:
+        if results and set(hit.chunk_ids) == {cid for cid, _, _, _ in results}:
+            cache.record_hit()
+            return hit.answer, hit.context, True
+        cache.discard(hit.key)
+
+    context = "\n".join(content for _, _, content, _ in results)
+    answer = await llm(context, query)
+    cache.put(
+        q_emb, answer, context,
+        chunk_ids=[cid for cid, _, _, _ in results],
+        document_ids=[did for _, did, _, _ in results],
+    )
+    return answer, context, False
 
 
 # -----------------------------------------------------------------------------
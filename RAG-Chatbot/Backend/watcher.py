@@ -0,0 +1,301 @@
+# watcher.py
+# =============================================================================
+# CONTINUOUS INCREMENTAL INGEST: WATCH DOCUMENTS_DIR, DEBOUNCE, INGEST CHANGED PATHS
+# =============================================================================
+# - inotify (Linux, via libc/ctypes, no extra dependency): one watch per directory
+#   iter_files would enter; IN_CLOSE_WRITE / IN_MOVED_TO mark a file as changed,
+#   so a file is picked up once its writer closes it, not on every write().
+#   New directories get watches as they appear; their existing files are queued.
+#   IN_Q_OVERFLOW (the kernel dropped events) falls back to one folder scan.
+# - poll: elsewhere, or when inotify is unavailable / out of watches
+#   (fs.inotify.max_user_watches): stat the tree every WATCH_POLL_INTERVAL seconds
+#   and diff (size, mtime) against the previous pass. No hashing, no DB.
+# Changed paths collect until WATCH_DEBOUNCE seconds pass without a new event
+# (or WATCH_MAX_DELAY after the first one, for a folder that never goes quiet),
+# then go to the ingest callback as one batch, i.e. utils.index_documents_once
+# with paths=..., which stats and ingests only those files.
+# Deleted files are ignored, as in a folder scan.
+import asyncio
+import ctypes
+import ctypes.util
+import errno
+import os
+import struct
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from dotenv import load_dotenv
+
+from scanner import dir_excluded, iter_dirs, iter_files, wanted
+
+#LOAD ENV
+load_dotenv()
+
+WATCH_DOCUMENTS = os.getenv("WATCH_DOCUMENTS", "0") == "1"
+WATCH_BACKEND = os.getenv("WATCH_BACKEND", "auto")  # auto | inotify | poll
+WATCH_DEBOUNCE = float(os.getenv("WATCH_DEBOUNCE", "1.0"))         # seconds of quiet before ingesting
+WATCH_MAX_DELAY = float(os.getenv("WATCH_MAX_DELAY", "10.0"))      # ingest at least this often while busy
+WATCH_POLL_INTERVAL = float(os.getenv("WATCH_POLL_INTERVAL", "5.0"))
+# One folder scan at startup for changes made while the server was down
+WATCH_INITIAL_SCAN = os.getenv("WATCH_INITIAL_SCAN", "1") == "1"
+
+# paths to ingest, or None for a full folder scan
+IngestCallback = Callable[[Optional[List[str]]], Awaitable]
+
+
+# -----------------------------------------------------------------------------
+# INOTIFY
+# -----------------------------------------------------------------------------
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_MOVE_SELF = 0x00000800
+_IN_Q_OVERFLOW = 0x00004000
+_IN_IGNORED = 0x00008000
+_IN_ONLYDIR = 0x01000000
+_IN_ISDIR = 0x40000000
+_IN_NONBLOCK = os.O_NONBLOCK
+_IN_CLOEXEC = getattr(os, "O_CLOEXEC", 0o2000000)
+_WATCH_MASK = _IN_CLOSE_WRITE | _IN_MOVED_TO | _IN_CREATE | _IN_MOVE_SELF | _IN_ONLYDIR
+_EVENT = struct.Struct("iIII")  # wd, mask, cookie, len; then len bytes of NUL-padded name
+
+
+class _Inotify:
+    name = "inotify"
+
+    def __init__(self, watcher: "DocumentWatcher"):
+        self._watcher = watcher
+        self._fd = -1
+        self._libc = None
+        self._dirs: Dict[int, Tuple[str, str]] = {}  # wd -> (directory path, rel + "/")
+
+    async def start(self) -> None:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        if not hasattr(libc, "inotify_init1"):
+            raise OSError(errno.ENOSYS, "inotify is not available")
+        fd = libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+        if fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, f"inotify_init1: {os.strerror(err)}")
+        self._libc, self._fd = libc, fd
+        try:
+            # A large tree means many syscalls: keep them off the event loop
+            await asyncio.to_thread(self._watch_tree, self._watcher.folder, "")
+        except OSError:
+            self.close()
+            raise
+        asyncio.get_running_loop().add_reader(self._fd, self._read)
+
+    def close(self) -> None:
+        if self._fd < 0:
+            return
+        try:
+            asyncio.get_running_loop().remove_reader(self._fd)
+        except RuntimeError:
+            pass
+        os.close(self._fd)
+        self._fd = -1
+        self._dirs.clear()
+
+    def _watch_tree(self, path: str, prefix: str) -> None:
+        """Watch `path` and every directory below it that iter_files would enter."""
+        for d, rel in iter_dirs(path, prefix=prefix):
+            wd = self._libc.inotify_add_watch(self._fd, os.fsencode(d), _WATCH_MASK)
+            if wd < 0:
+                err = ctypes.get_errno()
+                if err in (errno.ENOENT, errno.ENOTDIR):
+                    continue  # gone again before we got to it
+                raise OSError(err, f"inotify_add_watch {d}: {os.strerror(err)}")
+            self._dirs[wd] = (d, rel)
+
+    def _read(self) -> None:
+        try:
+            data = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = _EVENT.unpack_from(data, offset)
+            offset += _EVENT.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+            offset += length
+            self._event(wd, mask, name)
+
+    def _event(self, wd: int, mask: int, name: str) -> None:
+        if mask & _IN_Q_OVERFLOW:
+            self._watcher.notify(None)
+            return
+        if mask & (_IN_IGNORED | _IN_MOVE_SELF):
+            # Directory deleted or moved away: its old path no longer holds
+            if mask & _IN_MOVE_SELF:
+                self._libc.inotify_rm_watch(self._fd, wd)
+            self._dirs.pop(wd, None)
+            return
+        parent = self._dirs.get(wd)
+        if parent is None or not name:
+            return
+        path, rel = os.path.join(parent[0], name), parent[1] + name
+        if mask & _IN_ISDIR:
+            if mask & (_IN_CREATE | _IN_MOVED_TO) and not dir_excluded(rel):
+                try:
+                    self._watch_tree(path, rel + "/")
+                except OSError as e:
+                    self._watcher.fall_back(e)
+                    return
+                # Files written (or moved in with it) before the watch existed
+                for file_path, _ in iter_files(path, prefix=rel + "/"):
+                    self._watcher.notify(file_path)
+            return
+        if mask & (_IN_CLOSE_WRITE | _IN_MOVED_TO) and wanted(rel):
+            self._watcher.notify(path)
+
+
+# -----------------------------------------------------------------------------
+# POLLING
+# -----------------------------------------------------------------------------
+class _Poll:
+    name = "poll"
+
+    def __init__(self, watcher: "DocumentWatcher"):
+        self._watcher = watcher
+        self._snapshot: Dict[str, Tuple[int, int]] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    def _scan(self) -> Dict[str, Tuple[int, int]]:
+        return {path: (st.st_size, st.st_mtime_ns) for path, st in iter_files(self._watcher.folder)}
+
+    async def start(self) -> None:
+        self._snapshot = await asyncio.to_thread(self._scan)
+        self._task = asyncio.create_task(self._loop())
+
+    def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _loop(self) -> None:
+        while True:
+            await asyncio.sleep(self._watcher.poll_interval)
+            try:
+                snapshot = await asyncio.to_thread(self._scan)
+            except Exception as e:
+                print(f"[watch] WARN: poll failed: {e}")
+                continue
+            for path, sig in snapshot.items():
+                if self._snapshot.get(path) != sig:
+                    self._watcher.notify(path)
+            self._snapshot = snapshot
+
+
+# -----------------------------------------------------------------------------
+# WATCHER
+# -----------------------------------------------------------------------------
+class DocumentWatcher:
+    """
+    Watch `folder` and hand debounced batches of changed paths to `ingest`
+    (None = rescan the whole folder). start() / stop() from the app lifespan.
+    """
+
+    def __init__(
+        self,
+        folder: str,
+        ingest: IngestCallback,
+        backend: str = WATCH_BACKEND,
+        debounce: float = WATCH_DEBOUNCE,
+        max_delay: float = WATCH_MAX_DELAY,
+        poll_interval: float = WATCH_POLL_INTERVAL,
+    ):
+        if backend not in ("auto", "inotify", "poll"):
+            raise ValueError(f"Unknown WATCH_BACKEND {backend!r}; expected auto, inotify or poll")
+        self.folder = folder
+        self.backend = backend
+        self.debounce = debounce
+        self.max_delay = max(max_delay, debounce)
+        self.poll_interval = poll_interval
+        self._ingest = ingest
+        self._source = None
+        self._pending: Set[str] = set()
+        self._rescan = False
+        self._changed = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._fallback: Optional[asyncio.Task] = None  # _Poll.start() after fall_back
+
+    async def start(self, initial_scan: bool = WATCH_INITIAL_SCAN) -> None:
+        if self.backend in ("auto", "inotify"):
+            try:
+                self._source = _Inotify(self)
+                await self._source.start()
+            except OSError as e:
+                if self.backend == "inotify":
+                    raise
+                print(f"[watch] inotify unavailable ({e}); polling every {self.poll_interval}s")
+                self._source = None
+        if self._source is None:
+            self._source = _Poll(self)
+            await self._source.start()
+        self._task = asyncio.create_task(self._run())
+        if initial_scan:
+            self.notify(None)
+        print(f"[watch] watching {self.folder} ({self._source.name}, debounce {self.debounce}s)")
+
+    async def stop(self) -> None:
+        if self._fallback is not None and not self._fallback.done():
+            self._fallback.cancel()
+        if self._source is not None:
+            self._source.close()
+            self._source = None
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def notify(self, path: Optional[str]) -> None:
+        """Record a changed file; None = events were lost, rescan the folder."""
+        if path is None:
+            self._rescan = True
+        else:
+            self._pending.add(path)
+        self._changed.set()
+
+    def fall_back(self, error: OSError) -> None:
+        """inotify ran out of watches mid-run: switch to polling and rescan once."""
+        print(f"[watch] WARN: inotify failed ({error}); switching to polling every {self.poll_interval}s")
+        if self._source is not None:
+            self._source.close()
+        self._source = _Poll(self)
+        self._fallback = asyncio.create_task(self._source.start())
+        self._fallback.add_done_callback(self._fallback_done)
+        self.notify(None)
+
+    def _fallback_done(self, task: asyncio.Task) -> None:
+        if not task.cancelled() and task.exception() is not None:
+            print(
+                f"[watch] WARN: could not start polling ({task.exception()}); "
+                "changes are picked up only by POST /ingest/ until restart"
+            )
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            await self._changed.wait()
+            deadline = loop.time() + self.max_delay
+            # Quiet period: every new event restarts it, up to the deadline
+            while True:
+                self._changed.clear()
+                timeout = min(self.debounce, deadline - loop.time())
+                if timeout <= 0:
+                    break
+                try:
+                    await asyncio.wait_for(self._changed.wait(), timeout)
+                except asyncio.TimeoutError:
+                    break
+            paths = None if self._rescan else sorted(self._pending)
+            self._pending, self._rescan = set(), False
+            self._changed.clear()
+            try:
+                await self._ingest(paths)
+            except Exception as e:
+                # A later event or POST /ingest/ retries; the watcher keeps running
+                print(f"[watch] WARN: ingest of {'folder' if paths is None else len(paths)} failed: {e}")